@@ -6,6 +6,12 @@ Code to run more post-processing jobs for a forecast day.
 It is designed only to run for a single forecast, and expects to find the
 history files organized into one-day folders.
 
+A day folder is ready when it has the sentinel file Lfun.his_done_name, which
+driver_roms3.py writes after copying the history files (ignoring one older than
+the newest history file, left from an earlier copy), or when all its history
+files are there and are no longer changing size. The jobs are started as soon as
+the days they need are ready, and they run at the same time.
+
 Testing on mac:
 run driver_post2.py -gtx wgh2_t0_xn0b -r backfill -d 2023.09.14 -ro 0 -test True
 
@@ -74,8 +80,13 @@ else:
     sys.exit()
 print((' Post-processing %s for %s' % (Ldir['run_type'], Ldir['date_string'])).center(60,'-'))
 
-# check that all history files are in place
-maxcount=360; sleeptime=60 # will keep looking for 6 hours, e.g. 2 PM to 8 PM
+# Check for history files and run the jobs.
+# We learn that a day folder of history files is complete from the sentinel
+# file that driver_roms3.py writes after it has copied them. For output that got
+# here some other way we also accept a day when all its files are there and their
+# sizes have not changed since the last check. Each job starts as soon as all the
+# days it needs are ready, and the jobs run at the same time.
+maxwait = 6*3600; sleeptime=10 # will keep looking for 6 hours, e.g. 2 PM to 8 PM
     
 ds0 = Ldir['date_string']
 dt0 = datetime.strptime(ds0, Lfun.ds_fmt)
@@ -87,38 +98,37 @@ elif Ldir['run_type'] == 'forecast':
     ds1 = dt1.strftime(Lfun.ds_fmt)
 his_fn_list = Lfun.get_fn_list('hourly', Ldir, ds0, ds1)
 
-all_found = False
-ntries = 0
-while all_found == False:
-    for his_fn in his_fn_list:
-        if his_fn.is_file():
-            all_found = True
-            
-        elif not his_fn.is_file():
-            all_found = False
-            break
-    if all_found:
-        print('All files found. Beginning post-processing.\n')
-        sys.stdout.flush()
-        sleep(60) # make sure all copying is able to finish
-        break
-        
-    ntries += 1
-    if ntries >= maxcount:
-        print('Never found all history files.')
-        sys.exit()
-    else:
-        sleep(sleeptime)
-
-tt0 = time()
-# loop over all jobs
+# organize the history files by day folder (note that the first one is
+# ocean_his_0025.nc from the day before)
+day_dict = dict()
+for his_fn in his_fn_list:
+    if his_fn.parent not in day_dict.keys():
+        day_dict[his_fn.parent] = []
+    day_dict[his_fn.parent].append(his_fn)
+
+def day_is_ready(day_dir, fn_list, size_dict):
+    if not all([fn.is_file() for fn in fn_list]):
+        return False
+    done_fn = day_dir / Lfun.his_done_name
+    if done_fn.is_file():
+        # a sentinel older than the newest history file is left over from an
+        # earlier copy, so we ignore it
+        if done_fn.stat().st_mtime >= max([fn.stat().st_mtime for fn in fn_list]):
+            return True
+    sizes = [fn.stat().st_size for fn in fn_list]
+    ready = (day_dir in size_dict.keys()) and (size_dict[day_dir] == sizes)
+    size_dict[day_dir] = sizes
+    return ready
+
+# the jobs, and the day folders each one needs
 if Ldir['testing'] == True:
     job_list = ['daymovie2']
 else:
     job_list = ['daymovie2','layers2']
+# These both make a single product for the whole forecast, so they need all the days.
+job_days_dict = {job: list(day_dict.keys()) for job in job_list}
 
-for job in job_list:
-    
+def start_job(job):
     # make clean output directories (often just a place for Info)
     out_dir = Ldir['LOo'] / 'post' / Ldir['gtagex'] / ('f' + Ldir['date_string']) / job
     Lfun.make_dir(out_dir, clean=True)
@@ -134,16 +144,24 @@ for job in job_list:
                 '-gtx', Ldir['gtagex'], '-ro', str(Ldir['roms_out_num']),
                 '-r', Ldir['run_type'], '-d', Ldir['date_string'],
                 '-job', job, '-test', str(Ldir['testing'])]
-    proc = Po(cmd_list, stdout=Pi, stderr=Pi)
-    stdout, stderr = proc.communicate()
-    with open(out_dir / 'Info' / 'screen_output.txt', 'w') as fout:
-        fout.write(stdout.decode())
-    if len(stderr) > 0:
-        with open(out_dir / 'Info' / 'subprocess_error.txt', 'w') as ffout:
-            ffout.write(stderr.decode())
-            
+    # The screen output goes straight to files, because the jobs run at the
+    # same time and a full PIPE would stall them.
+    fout = open(out_dir / 'Info' / 'screen_output.txt', 'w')
+    ferr = open(out_dir / 'Info' / 'subprocess_error.txt', 'w')
+    proc = Po(cmd_list, stdout=fout, stderr=ferr)
+    print(' - started %s at %s' % (job, datetime.now().strftime('%H:%M:%S')))
+    sys.stdout.flush()
+    return {'proc':proc, 'out_dir':out_dir, 'fout':fout, 'ferr':ferr}
+
+def finish_job(job, jd):
+    jd['fout'].close()
+    jd['ferr'].close()
+    err_fn = jd['out_dir'] / 'Info' / 'subprocess_error.txt'
+    if err_fn.stat().st_size == 0:
+        err_fn.unlink()
     # the screen output below is intended to end up in the log that the cron job makes
-    res_fn = out_dir / 'Info' / 'results.txt'
+    print(job.center(60, '-'))
+    res_fn = jd['out_dir'] / 'Info' / 'results.txt'
     if res_fn.is_file():
         with open(res_fn, 'r') as fout:
             for line in fout:
@@ -152,8 +170,37 @@ for job in job_list:
         print('ERROR: missing results.txt file')
     print('')
     sys.stdout.flush()
+
+tt0 = time()
+ready_dict = {day_dir: False for day_dir in day_dict.keys()}
+size_dict = dict()
+jd_dict = dict() # started jobs
+done_list = [] # finished jobs
+while len(done_list) < len(job_list):
+    # check for days that are newly ready
+    for day_dir in day_dict.keys():
+        if (not ready_dict[day_dir]) and day_is_ready(day_dir, day_dict[day_dir], size_dict):
+            ready_dict[day_dir] = True
+            print(' - %s ready at %s' % (day_dir.name, datetime.now().strftime('%H:%M:%S')))
+            sys.stdout.flush()
+    # start the jobs that can be started
+    for job in job_list:
+        if (job not in jd_dict.keys()) and all([ready_dict[dd] for dd in job_days_dict[job]]):
+            jd_dict[job] = start_job(job)
+    # wrap up the jobs that are finished
+    for job in jd_dict.keys():
+        if (job not in done_list) and (jd_dict[job]['proc'].poll() is not None):
+            finish_job(job, jd_dict[job])
+            done_list.append(job)
+    if len(done_list) == len(job_list):
+        break
+    if (time() - tt0 > maxwait) and (len(jd_dict) < len(job_list)):
+        print('Never found all history files.')
+        for job in jd_dict.keys():
+            if job not in done_list:
+                jd_dict[job]['proc'].wait()
+                finish_job(job, jd_dict[job])
+        sys.exit()
+    sleep(sleeptime)
     
 print('Total time for all post jobs = %0.1f sec' % (time()-tt0))
-    
-    
-
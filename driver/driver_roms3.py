@@ -455,9 +455,12 @@ while dt <= dt1:
         if args.move_his:
             tt0 = time()
             # Copy history files to the remote machine and clean up
-            # (i) make sure the output directory exists
+            # (i) make sure the output directory exists, and remove any sentinel file
+            # left by an earlier copy of this day (e.g. from yesterday's forecast) so
+            # that it only ever marks the completed copy from this run
             cmd_list = ['ssh', remote_user + '@' + remote_machine,
-                'mkdir -p ' + remote_dir0 + '/LO_roms/' + Ldir['gtagex']]
+                'mkdir -p ' + remote_dir0 + '/LO_roms/' + Ldir['gtagex'] + ' && rm -f '
+                + remote_dir0 + '/LO_roms/' + Ldir['gtagex'] + '/' + f_string + '/' + Lfun.his_done_name]
             for rrr in range(10):
                 proc = subprocess.Popen(cmd_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
                 stdout, stderr = proc.communicate()
@@ -477,6 +480,14 @@ while dt <= dt1:
                 else:
                     sleep(20) # try again
             messages(stdout, stderr, 'Copy ROMS output to ' + remote_machine, args.verbose)
+            if len(stderr) == 0:
+                # Write a sentinel file on the remote machine so that post-processing
+                # (e.g. driver_post2.py) knows all the history files for this day are complete.
+                cmd_list = ['ssh', remote_user + '@' + remote_machine,
+                    'touch ' + remote_dir0 + '/LO_roms/' + Ldir['gtagex'] + '/' + f_string + '/' + Lfun.his_done_name]
+                proc = subprocess.Popen(cmd_list, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                stdout, stderr = proc.communicate()
+                messages(stdout, stderr, 'Write ' + Lfun.his_done_name + ' on ' + remote_machine, args.verbose)
             # (iii) delete roms_out_dir and forcing files from several days in the past
             dt_prev = dt - timedelta(days=4)
             f_string_prev = 'f' + dt_prev.strftime(Lfun.ds_fmt)
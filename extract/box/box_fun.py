@@ -0,0 +1,143 @@
+"""
+Functions for box extractions, used by extract_box_chunks.py.
+
+The history files are worked through in blocks of Nblock times. The files in a
+block are spread over a pool of Nproc worker processes, and each worker does
+everything for one time: subset the box, interpolate u and v to the rho grid,
+and find z_rho and z_w. The block is then appended to the output NetCDF file,
+which has an unlimited ocean_time dimension and is compressed as it is written.
+This means only one block is ever held in memory, no matter how long the
+extraction is.
+
+NOTE: the pool uses the "fork" start method so that the worker functions can
+be used from scripts that do all their work at the top level, like the rest
+of LO.
+"""
+
+import sys
+import multiprocessing as mp
+import numpy as np
+import xarray as xr
+import netCDF4 as nc
+
+from lo_tools import zrfun
+
+# state for each worker process, set by the pool initializer
+W = dict()
+
+def get_isel_dict(ilon0, ilon1, ilat0, ilat1, N, surf=False, bot=False):
+    """
+    Make the dict to use with Dataset.isel() to get a box. The limits are
+    indices on the rho grid and are INCLUSIVE, and the u and v grids are
+    the ones inside the rho grid, as in the standard ROMS organization.
+    """
+    isel_dict = {'xi_rho':slice(ilon0, ilon1+1), 'eta_rho':slice(ilat0, ilat1+1),
+        'xi_u':slice(ilon0, ilon1), 'eta_u':slice(ilat0, ilat1+1),
+        'xi_v':slice(ilon0, ilon1+1), 'eta_v':slice(ilat0, ilat1)}
+    # using an integer index drops the dimension
+    if surf:
+        isel_dict['s_rho'] = N-1
+    elif bot:
+        isel_dict['s_rho'] = 0
+    return isel_dict
+
+def uv_to_rho(uu, Maskr, tag):
+    """
+    Interpolate a field on the u or v grid (tag = 'u' or 'v') to the rho grid,
+    assuming zero values where masked, and leaving a masked ring around the
+    outermost edge. The last two axes are (eta, xi) and there can be any number
+    of leading axes. Maskr is True over water.
+    """
+    uu = np.nan_to_num(uu, nan=0)
+    NR, NC = Maskr.shape
+    uuu = np.nan * np.ones(uu.shape[:-2] + (NR, NC))
+    if tag == 'u':
+        uuu[...,1:-1,1:-1] = (uu[...,1:-1,1:] + uu[...,1:-1,:-1])/2
+    elif tag == 'v':
+        uuu[...,1:-1,1:-1] = (uu[...,1:,1:-1] + uu[...,:-1,1:-1])/2
+    uuu[...,~Maskr] = np.nan
+    return uuu
+
+def extract_one_time(fn, vn_list, isel_dict, S, do_uv_to_rho, do_z):
+    """
+    Extract the box from one history file. Returns a Dataset with ocean_time
+    left as a number (decode_times=False) so that it can be appended to the
+    output file as is.
+    """
+    ds = xr.open_dataset(fn, decode_times=False)
+    box = ds[vn_list].isel(isel_dict, missing_dims='ignore').load()
+    if do_uv_to_rho:
+        Maskr = ds.mask_rho.isel(isel_dict, missing_dims='ignore').values == 1
+        for vn in vn_list:
+            dims = box[vn].dims
+            if 'ocean_time' not in dims:
+                continue
+            for tag in ['u', 'v']:
+                if ('xi_' + tag) in dims:
+                    new_dims = tuple([dd.replace('_'+tag, '_rho') for dd in dims])
+                    box[vn] = (new_dims, uv_to_rho(box[vn].values, Maskr, tag), box[vn].attrs)
+    if do_z:
+        h = ds.h.isel(isel_dict, missing_dims='ignore').values
+        zeta = box.zeta[0,:,:].values
+        NR, NC = h.shape
+        z_rho, z_w = zrfun.get_z(h, zeta, S)
+        # get_z() squeezes singleton dimensions so we reshape
+        box['z_rho'] = (('ocean_time', 's_rho', 'eta_rho', 'xi_rho'),
+            z_rho.reshape(1, S['N'], NR, NC))
+        box['z_w'] = (('ocean_time', 's_w', 'eta_rho', 'xi_rho'),
+            z_w.reshape(1, S['N']+1, NR, NC))
+        box.z_rho.attrs = {'units':'m', 'long_name': 'vertical position on s_rho grid, positive up'}
+        box.z_w.attrs = {'units':'m', 'long_name': 'vertical position on s_w grid, positive up'}
+    ds.close()
+    return box
+
+def init_worker(vn_list, isel_dict, S, do_uv_to_rho, do_z):
+    W['args'] = (vn_list, isel_dict, S, do_uv_to_rho, do_z)
+
+def do_worker(fn):
+    return extract_one_time(fn, *W['args'])
+
+def write_block(out_fn, box, nt0):
+    """
+    Write a block of times to out_fn, starting at time index nt0. The
+    first block creates the file, and later ones are appended.
+    """
+    if nt0 == 0:
+        enc_dict = dict()
+        for vn in box.data_vars:
+            if 'ocean_time' in box[vn].dims:
+                # one time per chunk, so appending does not touch earlier chunks
+                enc_dict[vn] = {'zlib':True, 'complevel':1, '_FillValue':1e20,
+                    'chunksizes':(1,) + box[vn].shape[1:]}
+        box.to_netcdf(out_fn, unlimited_dims=['ocean_time'], encoding=enc_dict)
+    else:
+        nt1 = nt0 + box.sizes['ocean_time']
+        ds = nc.Dataset(out_fn, 'a')
+        for vn in box.variables:
+            if 'ocean_time' in box[vn].dims:
+                # masked values are written as _FillValue
+                ds[vn][nt0:nt1] = np.ma.masked_invalid(box[vn].values)
+        ds.close()
+
+def extract_box(fn_list, vn_list, isel_dict, S, out_fn,
+        do_uv_to_rho=False, do_z=False, Nproc=10, Nblock=24):
+    """
+    Extract a box from all the history files in fn_list, writing the result
+    to out_fn one block of Nblock times at a time.
+    """
+    NT = len(fn_list)
+    print('Times to extract = %d' % (NT))
+    sys.stdout.flush()
+    nt0 = 0
+    with mp.get_context('fork').Pool(Nproc, initializer=init_worker,
+            initargs=(vn_list, isel_dict, S, do_uv_to_rho, do_z)) as pool:
+        for bb in range(0, NT, Nblock):
+            box_list = pool.map(do_worker, fn_list[bb:bb+Nblock])
+            box = xr.concat(box_list, dim='ocean_time', data_vars='minimal',
+                coords='minimal', compat='override')
+            write_block(out_fn, box, nt0)
+            nt0 += box.sizes['ocean_time']
+            print(str(nt0), end=', ')
+            sys.stdout.flush()
+    print('')
+    return nt0
@@ -81,4 +81,70 @@ def get_his_fn_from_dt(Ldir, dt):
         his_num = ('0000' + str(dt.hour + 1))[-4:]
     date_string = dt.strftime(Ldir['ds_fmt'])
     fn = Ldir['roms_out'] / Ldir['gtagex'] / ('f' + date_string) / ('ocean_his_' + his_num + '.nc')
-    return fn
\ No newline at end of file
+    return fn
+
+def get_npzd(fn):
+    # Check on which bio variables to get, from a history file.
+    ds = xr.open_dataset(fn)
+    if 'NH4' in ds.data_vars:
+        npzd = 'new'
+    elif 'NO3' in ds.data_vars:
+        npzd = 'old'
+    else:
+        npzd = 'none'
+    ds.close()
+    return npzd
+
+def get_vn_list(npzd):
+    # The variables to extract, as a list (the same as used in get_cast()).
+    vn_list = ['AKs','salt','temp','h']
+    if npzd == 'new':
+        vn_list += ['phytoplankton','chlorophyll','zooplankton','SdetritusN','LdetritusN',
+            'oxygen','alkalinity','TIC','NO3','NH4']
+    elif npzd == 'old':
+        vn_list += ['phytoplankton','zooplankton','detritus','Ldetritus',
+            'oxygen','alkalinity','TIC','NO3']
+    return vn_list
+
+def get_cast_ji(G, lon, lat):
+    """
+    Vectorized version of the index finding in get_cast(), for arrays of
+    cast positions. Returns integer arrays (iy, ix), and a boolean array
+    that is False for casts that are out of bounds or on the land mask.
+    """
+    Lon = G['lon_rho'][0,:]
+    Lat = G['lat_rho'][:,0]
+    lon = np.asarray(lon, dtype=float)
+    lat = np.asarray(lat, dtype=float)
+    # same as zfun.find_nearest_ind() for each cast
+    ix = np.abs(Lon.reshape(1,-1) - lon.reshape(-1,1)).argmin(axis=1)
+    iy = np.abs(Lat.reshape(1,-1) - lat.reshape(-1,1)).argmin(axis=1)
+    good = ((lon >= Lon[0]) & (lon <= Lon[-1]) & (lat >= Lat[0]) & (lat <= Lat[-1])
+        & (G['mask_rho'][iy,ix] == 1))
+    return iy, ix, good
+
+def get_casts_one_file(fn, iy, ix, vn_list):
+    """
+    Extract all the casts that use one history file, with a single vectorized
+    gather for each variable. Returns a dict of arrays packed (cast, z) or (cast,),
+    and ocean_time as a datetime64.
+    """
+    ds = xr.open_dataset(fn)
+    ot = ds.ocean_time.values[0]
+    jj = xr.DataArray(iy, dims='cid')
+    ii = xr.DataArray(ix, dims='cid')
+    C = dict()
+    for vn in vn_list:
+        da = ds[vn]
+        if 'ocean_time' in da.dims:
+            da = da.isel(ocean_time=0)
+        C[vn] = da.isel(eta_rho=jj, xi_rho=ii).transpose('cid', ...).values
+    ds.close()
+    return C, ot
+
+def do_casts_worker(item):
+    # For use with a process pool: item = (fn, iy, ix, vn_list, ind)
+    # where ind is passed back so the results can be put in the right place.
+    fn, iy, ix, vn_list, ind = item
+    C, ot = get_casts_one_file(fn, iy, ix, vn_list)
+    return ind, C, ot
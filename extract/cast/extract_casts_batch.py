@@ -0,0 +1,138 @@
+"""
+This is code for doing cast extractions, for all the casts of a source, otype,
+and year, saving the results in a single NetCDF file.
+
+Unlike extract_casts_fast.py, which runs cast_worker.py (and ncks) once for each
+cast, this groups the casts by the history file they use, opens each history file
+only once, and gets all the casts from it with a single vectorized gather. The
+history files are spread over -Nproc worker processes.
+
+The output is one NetCDF file:
+LO_output/extract/[gtagex]/cast/[source]_[otype]_[year].nc
+with variables packed (cid, s_rho), (cid, s_w), or (cid), where cid is the
+cast ID from the info_df. Casts that have no history file, or are out of bounds
+or on land, are left out. z_rho and z_w are calculated with zeta = 0, as
+in get_cast().
+
+Test on mac in ipython:
+run extract_casts_batch -gtx cas6_v0_live -source ecology -otype ctd -year 2019 -test True
+
+"""
+
+import sys
+import multiprocessing as mp
+import pandas as pd
+import xarray as xr
+import numpy as np
+from time import time
+
+from lo_tools import Lfun, zfun, zrfun
+from lo_tools import extract_argfun as exfun
+import cast_functions as cfun
+
+Ldir = exfun.intro() # this handles the argument passing
+
+year_str = str(Ldir['year'])
+
+out_dir = Ldir['LOo'] / 'extract' / Ldir['gtagex'] / 'cast'
+Lfun.make_dir(out_dir)
+out_fn = out_dir / (Ldir['source'] + '_' + Ldir['otype'] + '_' + year_str + '.nc')
+out_fn.unlink(missing_ok=True)
+
+info_fn = Ldir['LOo'] / 'obs' / Ldir['source'] / Ldir['otype'] / ('info_' + year_str + '.p')
+if not info_fn.is_file():
+    print('No info file: ' + str(info_fn))
+    sys.exit()
+
+tt0 = time()
+info_df = pd.read_pickle(info_fn)
+# find the history file for each cast, and drop casts without one
+info_df['his_fn'] = [cfun.get_his_fn_from_dt(Ldir, dt) for dt in info_df['time']]
+info_df = info_df[[fn.is_file() for fn in info_df['his_fn']]]
+if Ldir['testing']:
+    info_df = info_df.iloc[:5]
+if len(info_df) == 0:
+    print('No history files for these casts')
+    sys.exit()
+
+# get indices for all casts, and drop bad ones
+fn0 = info_df['his_fn'].iloc[0]
+G, S, T = zrfun.get_basic_info(fn0)
+iy, ix, good = cfun.get_cast_ji(G, info_df['lon'].to_numpy(), info_df['lat'].to_numpy())
+for cid in info_df.index[~good]:
+    print('ERROR: out of bounds or on land mask ' + str(int(cid)))
+info_df = info_df[good]
+iy = iy[good]
+ix = ix[good]
+NC = len(info_df)
+print('Casts to extract = %d' % (NC))
+sys.stdout.flush()
+
+vn_list = cfun.get_vn_list(cfun.get_npzd(fn0))
+
+# group the casts by history file
+item_list = []
+fn_arr = info_df['his_fn'].to_numpy()
+for fn in pd.unique(fn_arr):
+    ind = np.nonzero(fn_arr == fn)[0]
+    item_list.append((fn, iy[ind], ix[ind], vn_list, ind))
+print('History files to open = %d' % (len(item_list)))
+sys.stdout.flush()
+
+# preallocate the output arrays
+N = S['N']
+ds0 = xr.open_dataset(fn0)
+C_all = dict()
+for vn in vn_list:
+    if 's_w' in ds0[vn].dims:
+        C_all[vn] = np.nan * np.ones((NC, N+1))
+    elif 's_rho' in ds0[vn].dims:
+        C_all[vn] = np.nan * np.ones((NC, N))
+    else:
+        C_all[vn] = np.nan * np.ones(NC)
+ds0.close()
+ot_all = np.zeros(NC, dtype='datetime64[ns]')
+
+# do the extraction
+with mp.get_context('fork').Pool(Ldir['Nproc']) as pool:
+    counter = 0
+    for ind, C, ot in pool.imap_unordered(cfun.do_casts_worker, item_list):
+        for vn in vn_list:
+            C_all[vn][ind] = C[vn]
+        ot_all[ind] = ot
+        counter += 1
+        if np.mod(counter, 100) == 0:
+            print(str(counter), end=', ')
+            sys.stdout.flush()
+print(str(len(item_list)))
+
+# add z-coordinates, with zeta = 0, for all casts at once
+z_rho, z_w = zrfun.get_z(C_all['h'], np.zeros(NC), S)
+z_rho = z_rho.reshape(N, NC).T
+z_w = z_w.reshape(N+1, NC).T
+
+# package the results
+ds = xr.Dataset(coords={'cid': info_df.index.to_numpy().astype(int),
+    's_rho': S['s_rho'], 's_w': S['s_w']})
+ds['ocean_time'] = (('cid',), ot_all)
+ds['lon_rho'] = (('cid',), G['lon_rho'][iy, ix])
+ds['lat_rho'] = (('cid',), G['lat_rho'][iy, ix])
+for vn in vn_list:
+    if C_all[vn].ndim == 1:
+        ds[vn] = (('cid',), C_all[vn])
+    elif C_all[vn].shape[1] == N+1:
+        ds[vn] = (('cid', 's_w'), C_all[vn])
+    else:
+        ds[vn] = (('cid', 's_rho'), C_all[vn])
+ds['z_rho'] = (('cid', 's_rho'), z_rho)
+ds['z_w'] = (('cid', 's_w'), z_w)
+ds.z_rho.attrs['long_name'] = 'vertical position on s_rho grid, positive up, zero at surface'
+ds.z_rho.attrs['units'] = 'm'
+ds.z_w.attrs['long_name'] = 'vertical position on s_w grid, positive up, zero at surface'
+ds.z_w.attrs['units'] = 'm'
+ds.salt.attrs['units'] = 'g kg-1'
+ds.to_netcdf(out_fn)
+ds.close()
+
+print('Took %0.2f sec' % (time()-tt0))
+print('Path to file:\n%s' % (str(out_fn)))
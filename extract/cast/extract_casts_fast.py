@@ -5,6 +5,9 @@ capability.
 
 Refactored 2022_07 to conform to the new cast data format.
 
+See extract_casts_batch.py for a faster version that opens each history file
+only once and saves all the casts in a single NetCDF file.
+
 Test on mac in ipython:
 run extract_casts_fast -gtx cas6_v0_live -source ecology -otype ctd -year 2019 -test True
 
@@ -1,6 +1,13 @@
+"""
+Compress a single history file in place, with the default settings
+in compress_fun.compress_file().
+
+Usage:
+python compress_a_file.py [path to file]
+"""
+
 import sys
-from time import time
-import xarray as xr
+import compress_fun
 
 arg_list = sys.argv
 if len(arg_list) != 2:
@@ -10,10 +17,5 @@ if len(arg_list) != 2:
 fn = arg_list[1]
 
 # compress that copy in place
-tt0 = time()
-ds = xr.load_dataset(fn)
-enc_dict = {'zlib':True, 'complevel':1}
-Enc_dict = {vn:enc_dict for vn in ds.data_vars if 'ocean_time' in ds[vn].dims}
-ds.to_netcdf(fn, encoding=Enc_dict)
-ds.close()
-print('- %0.1f sec to compress %s/%s' % (time()-tt0, fn.split('/')[-2], fn.split('/')[-1]))
+size0, size1, dt = compress_fun.compress_file(fn)
+print('- %0.1f sec to compress %s/%s' % (dt, fn.split('/')[-2], fn.split('/')[-1]))
@@ -0,0 +1,139 @@
+"""
+Functions for compressing ROMS history files, used by compress_history_files.py
+and compress_a_file.py.
+
+A file is rewritten one variable at a time, and large variables are copied one
+time and vertical level at a time, so memory use stays small no matter how
+big the file is. The copy is written to a temporary file next to the original,
+which then replaces it.
+
+Only variables with an ocean_time dimension are compressed (the grid variables
+are small). These are chunked by time and vertical level, which is how most of
+the extractors read them.
+
+Compression choices:
+codec = zlib (the default, which is what we have always used), zstd, bzip2,
+    blosc_lz4, blosc_zstd, etc. (anything netCDF4 supports)
+complevel = compression level, 1-9 for zlib
+quant = lossy quantization, which usually makes the files much smaller:
+    None = no quantization
+    'lsd' = keep a fixed number of decimal places (least_significant_digit)
+    'bitround' = keep a fixed number of significant bits
+    The precision for each variable comes from QUANT_DICT, based on the units given
+    by zrfun.get_varinfo(). Variables not in QUANT_DICT are not quantized.
+"""
+
+import os
+import sys
+from time import time
+import numpy as np
+import netCDF4 as nc
+
+from lo_tools import zrfun
+
+# Precision to keep for quantization, based on the units in varinfo.yaml:
+# lsd = number of decimal places (e.g. 3 => 0.001)
+# nsb = number of significant bits (e.g. 12 => about 1 part in 4000)
+QUANT_DICT = {
+    'Celsius': {'lsd':3, 'nsb':14},
+    'nondimensional': {'lsd':3, 'nsb':14}, # salt
+    'meter': {'lsd':3, 'nsb':12},
+    'meter second-1': {'lsd':4, 'nsb':12},
+    'millimole_nitrogen meter-3': {'lsd':3, 'nsb':12},
+    'millimole_oxygen meter-3': {'lsd':2, 'nsb':12},
+    'millimole_carbon meter-3': {'lsd':2, 'nsb':14},
+    'milliequivalent meter-3': {'lsd':2, 'nsb':14},
+    'milligrams_chlorophyll meter-3': {'lsd':3, 'nsb':12},
+    'millibar': {'lsd':2, 'nsb':16},
+    'watt meter-2': {'lsd':2, 'nsb':12},
+    'newton meter-2': {'lsd':5, 'nsb':12},
+    }
+
+def get_quant_info(vn, quant):
+    """
+    Returns a dict of createVariable() arguments to quantize variable vn,
+    empty if we are not quantizing it.
+    """
+    if quant is None:
+        return dict()
+    try:
+        vinfo = zrfun.get_varinfo(vn)
+        units = vinfo['units']
+    except Exception:
+        # not in varinfo.yaml (e.g. derived fields), or no varinfo available
+        return dict()
+    if units not in QUANT_DICT.keys():
+        return dict()
+    if quant == 'lsd':
+        return {'least_significant_digit':QUANT_DICT[units]['lsd']}
+    elif quant == 'bitround':
+        return {'significant_digits':QUANT_DICT[units]['nsb'], 'quantize_mode':'BitRound'}
+    else:
+        print('Error in compress_fun.get_quant_info(), unknown quant: ' + str(quant))
+        sys.exit()
+
+def check_codec(codec):
+    """
+    Returns True if this netCDF4 library can write with codec.
+    """
+    ds = nc.Dataset('check_codec.nc', 'w', diskless=True)
+    if codec in ['zlib', None]:
+        out = True
+    elif codec == 'szip':
+        out = ds.has_szip_filter()
+    elif codec == 'zstd':
+        out = ds.has_zstd_filter()
+    elif codec == 'bzip2':
+        out = ds.has_bzip2_filter()
+    elif codec.startswith('blosc'):
+        out = ds.has_blosc_filter()
+    else:
+        out = False
+    ds.close()
+    return out
+
+def compress_file(fn, codec='zlib', complevel=1, quant=None):
+    """
+    Compress the NetCDF file fn in place.
+    Returns (size before [bytes], size after [bytes], elapsed time [sec]).
+    """
+    tt0 = time()
+    fn = str(fn)
+    temp_fn = fn + '_temp'
+    size0 = os.path.getsize(fn)
+    ds0 = nc.Dataset(fn)
+    ds1 = nc.Dataset(temp_fn, 'w', format='NETCDF4')
+    ds1.setncatts({att:ds0.getncattr(att) for att in ds0.ncattrs()})
+    for dn in ds0.dimensions:
+        dim = ds0.dimensions[dn]
+        ds1.createDimension(dn, None if dim.isunlimited() else len(dim))
+    for vn in ds0.variables:
+        v0 = ds0[vn]
+        atts = {att:v0.getncattr(att) for att in v0.ncattrs() if att != '_FillValue'}
+        fill_value = getattr(v0, '_FillValue', None)
+        if ('ocean_time' in v0.dimensions) and (v0.ndim > 1):
+            kwargs = {'compression':codec, 'complevel':complevel}
+            if v0.ndim > 2:
+                # chunk by time and vertical level
+                kwargs['chunksizes'] = tuple([1]*(v0.ndim-2)) + v0.shape[-2:]
+            if v0.dtype.kind == 'f':
+                kwargs.update(get_quant_info(vn, quant))
+        else:
+            kwargs = dict()
+        v1 = ds1.createVariable(vn, v0.dtype, v0.dimensions, fill_value=fill_value, **kwargs)
+        v1.setncatts(atts)
+        if v0.ndim > 2:
+            # copy one time and level at a time
+            for ind in np.ndindex(v0.shape[:-2]):
+                v1[ind] = v0[ind]
+        else:
+            v1[...] = v0[...]
+    ds0.close()
+    ds1.close()
+    os.replace(temp_fn, fn)
+    size1 = os.path.getsize(fn)
+    return size0, size1, time()-tt0
+
+def do_worker(item):
+    fn, codec, complevel, quant = item
+    return fn, compress_file(fn, codec=codec, complevel=complevel, quant=quant)
@@ -9,7 +9,21 @@ Test on mac:
 run compress_history_files -gtx cas6_v3_lo8b -ro 2 -0 2019.07.04 -1 2019.07.04
 python compress_history_files.py -gtx cas6_v3_lo8b -ro 2 -0 2019.07.04 -1 2019.07.04
 
-Performance: took 3 minutes to compress 1 day of cas6 on my laptop.  This is 18 hours per year,
+Options:
+-codec zlib (default), zstd, bzip2, blosc_lz4, blosc_zstd, etc.
+-level compression level (default 1)
+-quant None (default, lossless), lsd, or bitround (lossy, see compress_fun.py)
+
+e.g. to try zstd with bit rounding on one day:
+run compress_history_files -gtx cas6_v3_lo8b -ro 2 -0 2019.07.04 -1 2019.07.04 -codec zstd -level 3 -quant bitround
+
+Each file is rewritten one variable at a time by compress_fun.compress_file(), so the
+memory used does not depend on the file size, and -Nproc files are done at once by a pool
+of worker processes. At the end it reports the total size before and after, and the
+throughput.
+
+Performance (original version, which used compress_a_file.py in a subprocess for each
+file, and loaded the whole file): took 3 minutes to compress 1 day of cas6 on my laptop.  This is 18 hours per year,
 however that was with Nproc = 4.  With Nproc = 10 on perigee it took 8 hours for a year of
 history files with no NPZD.  Using Nproc = 100 did not speed things up, but it did make
 perigee a bit sluggish on the command line.  Overall I think 5 sec per file might be typical
@@ -19,14 +33,11 @@ perigee a bit sluggish on the command line.  Overall I think 5 sec per file migh
 
 import sys
 import argparse
+import multiprocessing as mp
 from lo_tools import Lfun
-from subprocess import Popen as Po
-from subprocess import PIPE as Pi
-from time import time
-import numpy as np
-import xarray as xr
 from time import time
 from datetime import datetime, timedelta
+import compress_fun
 
 print(' compress history files '.center(60,'='))
 
@@ -38,7 +49,11 @@ parser.add_argument('-ro', '--roms_out_num', type=int) # 2 = Ldir['roms_out2'],
 # select time period and frequency
 parser.add_argument('-0', '--ds0', type=str) # e.g. 2019.07.04
 parser.add_argument('-1', '--ds1', type=str) # e.g. 2019.07.06
-# Optional: set max number of subprocesses to run at any time
+# Optional: compression choices
+parser.add_argument('-codec', type=str, default='zlib')
+parser.add_argument('-level', type=int, default=1)
+parser.add_argument('-quant', type=str, default='None') # None, lsd, or bitround
+# Optional: set number of worker processes
 parser.add_argument('-Nproc', type=int, default=10)
 # Optional: for testing
 parser.add_argument('-test', '--testing', default=False, type=Lfun.boolean_string)
@@ -67,26 +82,32 @@ fn_list = []
 for this_ds in ds_list:
     fn_list = fn_list + Lfun.get_fn_list('allhours', Ldir, this_ds, this_ds)
 
+if Ldir['quant'] == 'None':
+    Ldir['quant'] = None
+elif Ldir['quant'] not in ['lsd', 'bitround']:
+    print('Error: unknown quant ' + Ldir['quant'])
+    sys.exit()
+if not compress_fun.check_codec(Ldir['codec']):
+    print('Error: codec not available ' + Ldir['codec'])
+    sys.exit()
+
 # do the compression
 N = len(fn_list)
-proc_list = []
+item_list = [(fn, Ldir['codec'], Ldir['level'], Ldir['quant']) for fn in fn_list]
+size0_tot = 0
+size1_tot = 0
 tt0 = time()
-for ii in range(N):
-    fn = fn_list[ii]
-    cmd_list = ['python', 'compress_a_file.py', str(fn)]
-    proc = Po(cmd_list, stdout=Pi, stderr=Pi)
-    proc_list.append(proc)
-    # complete Nproc jobs before filling proc_list again
-    if ((np.mod(ii,Ldir['Nproc']) == 0) and (ii > 0)) or (ii == N-1):
-        for proc in proc_list:
-            # make sure everyone is finished before continuing
-            stdout, stderr = proc.communicate()
-            if len(stdout) > 0:
-                print(stdout.decode().replace('\n',''))
-            if len(stderr) > 0:
-                print(stderr.decode())
-            sys.stdout.flush()
-        proc_list = []
-    ii += 1
-print('Total time to compress %d files = %0.1f sec' % (N, time()-tt0))
-    
+with mp.get_context('fork').Pool(Ldir['Nproc']) as pool:
+    for fn, (size0, size1, dt) in pool.imap_unordered(compress_fun.do_worker, item_list):
+        size0_tot += size0
+        size1_tot += size1
+        print('- %0.1f sec to compress %s/%s: %0.1f MB => %0.1f MB' %
+            (dt, fn.parent.name, fn.name, size0/1e6, size1/1e6))
+        sys.stdout.flush()
+dt_tot = time()-tt0
+print('Total time to compress %d files = %0.1f sec' % (N, dt_tot))
+if N > 0:
+    print('Total size: %0.1f MB => %0.1f MB (ratio = %0.2f)' %
+        (size0_tot/1e6, size1_tot/1e6, size0_tot/max(size1_tot,1)))
+    print('Throughput = %0.1f MB/sec, %0.2f sec per file' %
+        (size0_tot/1e6/dt_tot, dt_tot/N))
@@ -1,6 +1,13 @@
 """
 Driver to make tidally averaged files.
 
+This goes through the hourly history files only once, for the whole date range,
+keeping running sums of the Godin filter for the days whose windows are in
+progress (see lowpass_fun.py). The variables are split among -Nproc worker
+processes, and each day's lowpassed.nc is written as soon as its window is complete.
+This replaced using lp_worker.py to do each day separately, which read every
+history file about three times.
+
 Test on mac:
 run extract_lowpass -gtx cas6_v0_live -ro 0 -0 2019.07.04 -1 2019.07.05 -test True -Nproc 4
 run extract_lowpass -gtx cas6_v0_live -ro 0 -0 2019.07.04 -1 2019.07.04 -test False -Nproc 4
@@ -22,9 +29,8 @@ import pandas as pd
 import xarray as xr
 import numpy as np
 from datetime import datetime, timedelta
-from subprocess import Popen as Po
-from subprocess import PIPE as Pi
-from time import time
+from time import time, sleep
+import lowpass_fun
 
 from lo_tools import Lfun, zfun, zrfun
 from lo_tools import extract_argfun as exfun
@@ -36,6 +42,7 @@ ds0 = Ldir['ds0']
 ds1 = Ldir['ds1']
 dt0 = datetime.strptime(ds0, Lfun.ds_fmt)
 dt1 = datetime.strptime(ds1, Lfun.ds_fmt)
+ndays = (dt1 - dt0).days + 1
 
 # get the S dict for future use
 S_fn = Ldir['roms_out'] / Ldir['gtagex'] / ('f' + ds0) / 'ocean_his_0002.nc'
@@ -44,63 +51,64 @@ S_ds = xr.open_dataset(S_fn)
 h = S_ds.h
 lon_psi = S_ds.lon_psi
 lat_psi = S_ds.lat_psi
+
+if Ldir['testing']:
+    vn_list = ['zeta','salt']
+else:
+    vn_list = ['zeta','salt','temp','u','v','w',
+    'NO3','phytoplankton','zooplankton',
+    'detritus','Ldetritus','oxygen',
+    'TIC','alkalinity',
+    'Pair','Uwind','Vwind','shflux','ssflux','latent','sensible','lwrad','swrad',
+    'sustr','svstr','bustr','bvstr']
+# drop any that are not in the history files
+vn_list = [vn for vn in vn_list if vn in S_ds.data_vars]
+# split the variables into groups, one for each worker, spreading out the 3-D ones
+vn_3d = [vn for vn in vn_list if len(S_ds[vn].dims) == 4]
+vn_2d = [vn for vn in vn_list if len(S_ds[vn].dims) != 4]
+group_list = [(vn_3d + vn_2d)[ii::Ldir['Nproc']] for ii in range(Ldir['Nproc'])]
+group_list = [group for group in group_list if len(group) > 0]
 S_ds.close()
 
-# loop over all days
-dt00 = dt0
-while dt00 <= dt1:
+# all the hourly files we need: from hour 0 of the first day to hour 24 of
+# the day after the last day
+fn_list = Lfun.get_fn_list('hourly', Ldir, ds0,
+    (dt1 + timedelta(days=2)).strftime(Lfun.ds_fmt))
+
+# temporary file output location
+temp_out_dir = Ldir['LOo'] / 'extract' / Ldir['gtagex'] / 'lowpass' / ('temp_' + ds0 + '_' + ds1)
+Lfun.make_dir(temp_out_dir, clean=True)
+
+# start the workers, each of which goes through all the history files once
+tt00 = time()
+pool = lowpass_fun.get_pool(len(group_list))
+res_list = []
+for gg, group in enumerate(group_list):
+    res_list.append(pool.apply_async(lowpass_fun.stream_lowpass,
+        (fn_list, ndays, group, gg, temp_out_dir)))
+
+# and finish each day as soon as all the workers have done it
+for kk in range(ndays):
+    tt0 = time()
+    dt00 = dt0 + timedelta(days=kk)
     ds00 = dt00.strftime(Lfun.ds_fmt)
     print('\n'+ds00)
-    # temporary file output location
-    temp_out_dir = Ldir['LOo'] / 'extract' / Ldir['gtagex'] / 'lowpass' / ('temp_' + ds00)
-    Lfun.make_dir(temp_out_dir, clean=True)
+    sys.stdout.flush()
     # final file output location
     dt_out = dt00 + timedelta(days=1)
     ds_out = dt_out.strftime(Lfun.ds_fmt)
     out_dir = Ldir['roms_out'] / Ldir['gtagex'] / ('f' + ds_out)
-
-    # Start of chunks loop for this day.
-    tt0 = time()
-    cca = np.arange(71)
-    # Always split the job into Nproc parts. It won't get any faster
-    # by using more chunks.
-    ccas = np.array_split(cca, Ldir['Nproc'])
-    if Ldir['testing']:
-        ccas = ccas[:2]
-    fnum = 0
-    proc_list = []
-    N = len(ccas)
-    for this_cca in ccas:
-        cc0 = this_cca[0]
-        cc1 = this_cca[-1]
-        # print(' - Working on index range %d:%d' % (cc0, cc1))
-        # sys.stdout.flush()
-        cmd_list = ['python', 'lp_worker.py',
-                    '-gtx', Ldir['gtagex'], '-ro', str(Ldir['roms_out_num']),
-                    '-0', ds00, '-ii0', str(cc0), '-ii1', str(cc1),
-                    '-fnum', str(fnum), '-test', str(Ldir['testing'])]
-        proc = Po(cmd_list, stdout=Pi, stderr=Pi)
-        proc_list.append(proc)
-        # Nproc controls how many ncks subprocesses we allow to stack up
-        # before we require them all to finish.
-        if ((np.mod(fnum,Ldir['Nproc']) == 0) and (fnum > 0)) or (fnum == N-1):
-            for proc in proc_list:
-                stdout, stderr = proc.communicate()
-                if len(stderr) > 0:
-                    print(stderr.decode())
-            # make sure everyone is finished before continuing
-            proc_list = []
-        fnum += 1
     
-    # add up the chunks into a single file
-    for fnum in range(N):
-        fstr = ('000' + str(fnum))[-2:]
-        fn = temp_out_dir / ('lp_temp_' + fstr + '.nc')
-        ds = xr.open_dataset(fn)
-        if fnum == 0:
-            lp_full = ds.copy()
-        else:
-            lp_full = (lp_full + ds).compute()
+    temp_fn_list = [lowpass_fun.get_temp_fn(temp_out_dir, kk, gg) for gg in range(len(group_list))]
+    while not all([fn.is_file() for fn in temp_fn_list]):
+        for res in res_list:
+            if res.ready() and not res.successful():
+                res.get() # this raises the error from the worker
+        sleep(1)
+    
+    # add up the groups into a single file
+    lp_full = xr.merge([xr.load_dataset(fn) for fn in temp_fn_list])
+    lp_full = lp_full[vn_list]
     # add a time dimension
     lp_full = lp_full.expand_dims('ocean_time')
     lp_full['ocean_time'] = (('ocean_time'), pd.DatetimeIndex([dt_out + timedelta(days=0.5)]))
@@ -125,9 +133,13 @@ while dt00 <= dt1:
     lp_full.close()
     
     # tidying up
-    Lfun.make_dir(temp_out_dir, clean=True)
-    temp_out_dir.rmdir()
+    for fn in temp_fn_list:
+        fn.unlink()
     
     print(' - Time to make tidal average = %0.1f minutes' % ((time()-tt0)/60))
-    
-    dt00 = dt00 + timedelta(days=1)
+    sys.stdout.flush()
+
+pool.close()
+pool.join()
+temp_out_dir.rmdir()
+print('\nTotal time = %0.1f minutes' % ((time()-tt00)/60))
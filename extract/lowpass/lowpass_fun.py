@@ -0,0 +1,81 @@
+"""
+Functions for making tidally averaged files with a streaming Godin filter,
+used by extract_lowpass.py.
+
+Each day's lowpassed.nc is a Godin-weighted sum of the 71 hourly history files
+centered on noon of that day. The windows of consecutive days overlap by 47 hours,
+so instead of doing each day separately we go through the history files once, in
+order, and add each one into running sums for every day whose window it is in
+(at most three). When a day's window is complete its sum is saved and dropped.
+
+The work is split up by variable: each of Nproc worker processes handles a group
+of variables for all days, saving the result for each day and group to a temporary
+file as soon as it is complete. The calling code then puts the groups together.
+
+NOTE: the pool uses the "fork" start method so that the worker functions can
+be used from scripts that do all their work at the top level, like the rest
+of LO.
+"""
+
+import os
+import multiprocessing as mp
+import numpy as np
+import xarray as xr
+
+from lo_tools import zfun
+
+def get_pool(Nproc):
+    return mp.get_context('fork').Pool(Nproc)
+
+def get_windows(NT, ndays):
+    """
+    For an hourly list of NT history files that starts with hour 0 of the
+    first day (the ocean_his_0025.nc of the day before) the window for day k
+    is files[1 + 24*k : 72 + 24*k], so it is centered on noon of day k+1.
+    Returns an array of the first index of each window.
+    """
+    w0 = 1 + 24*np.arange(ndays)
+    if len(w0) > 0 and (w0[-1] + 71 > NT):
+        print('WARNING: not enough history files for all days')
+    return w0
+
+def get_temp_fn(temp_dir, kk, gg):
+    return temp_dir / ('lp_temp_%04d_%02d.nc' % (kk, gg))
+
+def stream_lowpass(fn_list, ndays, vn_list, gg, temp_dir):
+    """
+    Go through the hourly files in fn_list once, doing the Godin filter for
+    the variables in vn_list, for ndays consecutive days.
+    The result for day k is saved to get_temp_fn(temp_dir, k, gg).
+    """
+    gs = zfun.godin_shape() # length 71, sum = 1
+    w0 = get_windows(len(fn_list), ndays)
+    acc_dict = dict() # running sums, keyed by day index
+    for tt, fn in enumerate(fn_list):
+        # the days whose window includes this hour
+        kk_list = [kk for kk in range(ndays) if 0 <= tt - w0[kk] <= 70]
+        if len(kk_list) == 0:
+            continue
+        ds = xr.open_dataset(fn)
+        for vn in vn_list:
+            fld = ds[vn][0,...].values
+            for kk in kk_list:
+                if kk not in acc_dict.keys():
+                    acc_dict[kk] = dict()
+                if vn not in acc_dict[kk].keys():
+                    acc_dict[kk][vn] = np.zeros(fld.shape)
+                acc_dict[kk][vn] += gs[tt - w0[kk]] * fld
+        for kk in kk_list:
+            if tt - w0[kk] == 70:
+                # the window is complete so save it
+                lp = ds[vn_list].isel(ocean_time=0, drop=True)
+                lp = lp.copy(data={vn: acc_dict[kk][vn] for vn in vn_list})
+                for vn in vn_list:
+                    lp[vn].encoding = dict()
+                out_fn = get_temp_fn(temp_dir, kk, gg)
+                lp.to_netcdf(str(out_fn) + '_part')
+                # rename so the calling code never sees a partly written file
+                os.rename(str(out_fn) + '_part', out_fn)
+                del acc_dict[kk]
+        ds.close()
+    return gg
@@ -0,0 +1,262 @@
+"""
+Functions for mooring extractions, used by extract_moor.py and
+multi_mooring_driver.py.
+
+Each history file is opened once, and the values at all the moorings are
+gathered from it using precomputed (j,i) indices on the rho, u, and v grids.
+The files are spread over a pool of Nproc worker processes, and the results
+go into preallocated (time, mooring, z) arrays. z_rho and z_w are then found
+for all moorings and times in a single call to zrfun.get_z().
+
+This replaces running one ncks subprocess per history file, followed by ncrcat,
+and it means that many moorings cost about the same as one.
+
+NOTE: the pool uses the "fork" start method so that the worker functions can
+be used from scripts that do all their work at the top level, like the rest
+of LO.
+"""
+
+import sys
+import multiprocessing as mp
+import numpy as np
+import xarray as xr
+
+from lo_tools import zrfun, zfun
+
+# state for each worker process, set by the pool initializer
+W = dict()
+
+def find_good(G, ilat, ilon, mask):
+    """
+    Look for a good point on the given mask, near (ilat, ilon).
+    Returns (Ilat, Ilon), or None if there is no good point.
+    """
+    if mask == 'rho':
+        # look on all four sides
+        jig_list = [[0,0],[1,0],[-1,0],[0,1],[0,-1]]
+    elif mask == 'u':
+        # just look to west
+        jig_list = [[0,0],[0,-1]]
+    elif mask == 'v':
+        # just look to south
+        jig_list = [[0,0],[-1,0]]
+    for jig in jig_list:
+        Ilat = ilat + jig[0]
+        Ilon = ilon + jig[1]
+        if G['mask_'+mask][Ilat,Ilon] == 1:
+            print('   - %s: (%d, %d) => (%d, %d), jig = [%d, %d]' %
+                (mask, ilat, ilon, Ilat, Ilon, jig[0], jig[1]))
+            return Ilat, Ilon
+    print('ERROR: no good nearby point found on mask for ' + mask)
+    return None
+
+def get_moor_ji(G, lon, lat, get_uv=True):
+    """
+    Find the indices to use for a mooring at (lon, lat).
+    Returns a dict with (j, i) tuples for 'rho' and optionally 'u' and 'v',
+    or None if the mooring is out of bounds or on land.
+    """
+    Lon = G['lon_rho'][0,:]
+    Lat = G['lat_rho'][:,0]
+    # error checking
+    if (lon < Lon[0]) or (lon > Lon[-1]):
+        print('ERROR: lon out of bounds')
+        return None
+    if (lat < Lat[0]) or (lat > Lat[-1]):
+        print('ERROR: lat out of bounds')
+        return None
+    # get indices
+    ilon = zfun.find_nearest_ind(Lon, lon)
+    ilat = zfun.find_nearest_ind(Lat, lat)
+    ji = dict()
+    ji['rho'] = find_good(G, ilat, ilon, 'rho')
+    if ji['rho'] is None:
+        return None
+    if get_uv:
+        for tag in ['u', 'v']:
+            ji[tag] = find_good(G, ji['rho'][0], ji['rho'][1], tag)
+            if ji[tag] is None:
+                return None
+    return ji
+
+def get_vn_list(ds, Ldir):
+    """
+    Returns the list of variables to extract, based on the flags in Ldir,
+    and dropping any that are not in the history file Dataset ds.
+    """
+    # check to see if we are working with the old or new NPZDOC variables
+    if 'NH4' in ds.data_vars:
+        # updated ROMS
+        bio_list = ['NO3','NH4','phytoplankton','zooplankton','SdetritusN','LdetritusN',
+            'SdetritusC','LdetritusC','oxygen','alkalinity','TIC','rho']
+    else:
+        # original version
+        bio_list = ['NO3','phytoplankton','zooplankton','detritus','Ldetritus',
+            'oxygen','alkalinity','TIC','rho']
+    vn_list = ['h','zeta']
+    if Ldir['get_tsa']:
+        vn_list += ['salt','temp','AKs','AKv']
+    if Ldir['get_vel']:
+        vn_list += ['u','v','w','ubar','vbar']
+    if Ldir['get_bio']:
+        vn_list += bio_list
+    if Ldir['get_surfbot']:
+        vn_list += ['Pair','Uwind','Vwind','shflux','ssflux','latent','sensible',
+            'lwrad','swrad','sustr','svstr','bustr','bvstr']
+    # The choice below is a custom job that is not part of get_all.
+    if Ldir['get_pressure']: # fields used for 1-D pressure analysis
+        vn_list += ['salt','temp','u','v','Pair','Uwind','Vwind']
+    # drop duplicates and missing variables
+    out_list = []
+    for vn in vn_list:
+        if (vn in ds.data_vars) and (vn not in out_list):
+            out_list.append(vn)
+    return out_list
+
+def get_var_info(ds, vn):
+    """
+    Returns (grid tag, vertical dimension or None) for a variable in a history file.
+    """
+    dims = ds[vn].dims
+    if 'eta_u' in dims:
+        tag = 'u'
+    elif 'eta_v' in dims:
+        tag = 'v'
+    else:
+        tag = 'rho'
+    zdim = None
+    for dd in ['s_rho', 's_w']:
+        if dd in dims:
+            zdim = dd
+    return tag, zdim
+
+def extract_one_time(fn, JI, VI):
+    """
+    Extract the time-dependent variables at all moorings from one history file.
+
+    JI = dict of (jj, ii) index vectors for each grid tag, one entry per mooring
+    VI = dict of (tag, zdim) for each variable, from get_var_info()
+
+    Returns ocean_time [sec] and a dict of arrays packed (mooring, z) or (mooring,).
+    """
+    ds = xr.open_dataset(fn, decode_times=False)
+    ot = ds.ocean_time.values[0]
+    V = dict()
+    for vn in VI.keys():
+        tag, zdim = VI[vn]
+        jj, ii = JI[tag]
+        da = ds[vn].isel(ocean_time=0)
+        # gather all the moorings in a single read, packed (mooring, z)
+        V[vn] = da.isel({da.dims[-2]: xr.DataArray(jj, dims='moor'),
+            da.dims[-1]: xr.DataArray(ii, dims='moor')}).transpose('moor', ...).values
+    ds.close()
+    return ot, V
+
+def init_worker(JI, VI):
+    W['args'] = (JI, VI)
+
+def do_worker(item):
+    tt, fn = item
+    ot, V = extract_one_time(fn, *W['args'])
+    return tt, ot, V
+
+def extract_moorings(fn_list, ji_list, vn_list, Nproc=10):
+    """
+    Extract the variables in vn_list at a list of moorings from all the files
+    in fn_list.
+
+    ji_list = list of dicts from get_moor_ji(), one per mooring
+
+    Returns a list of xarray Datasets, one per mooring, in the same order as ji_list,
+    with all variables having dimensions ('ocean_time', 's_rho'),
+    ('ocean_time', 's_w'), or just 'ocean_time' (except h, which is a single number).
+    z_rho and z_w are added.
+    """
+    NT = len(fn_list)
+    NM = len(ji_list)
+    ds = xr.open_dataset(fn_list[0], decode_times=False)
+    S = zrfun.get_basic_info(fn_list[0], only_S=True)
+    # index vectors for each grid, with one entry per mooring
+    JI = dict()
+    for tag in ji_list[0].keys():
+        JI[tag] = (np.array([ji[tag][0] for ji in ji_list]),
+            np.array([ji[tag][1] for ji in ji_list]))
+    # things that do not change with time
+    VI = dict()
+    for vn in vn_list:
+        if 'ocean_time' in ds[vn].dims:
+            VI[vn] = get_var_info(ds, vn)
+    jj, ii = JI['rho']
+    h = ds.h.values[jj, ii]
+    # preallocate the time series arrays
+    A = dict()
+    for vn in VI.keys():
+        tag, zdim = VI[vn]
+        if zdim is None:
+            A[vn] = np.nan * np.ones((NT, NM), dtype=ds[vn].dtype)
+        else:
+            A[vn] = np.nan * np.ones((NT, NM, ds.sizes[zdim]), dtype=ds[vn].dtype)
+    ot = np.nan * np.ones(NT)
+    # do the extraction
+    print('Times to extract =  %d' % (NT))
+    item_list = list(enumerate(fn_list))
+    with mp.get_context('fork').Pool(Nproc, initializer=init_worker, initargs=(JI, VI)) as pool:
+        counter = 0
+        for tt, this_ot, V in pool.imap_unordered(do_worker, item_list, chunksize=4):
+            ot[tt] = this_ot
+            for vn in V.keys():
+                A[vn][tt] = V[vn]
+            if np.mod(counter, 100) == 0:
+                print(str(counter), end=', ')
+                sys.stdout.flush()
+            counter += 1
+    print(str(NT))
+    sys.stdout.flush()
+    # vertical positions for all moorings and times at once
+    # zeta is a stack of times so these are packed (t, z, mooring), and
+    # passing out= means get_z() does not squeeze singleton dimensions
+    z_rho, z_w = zrfun.get_z(h, A['zeta'], S, out=(np.empty((NT, S['N'], NM)),
+        np.empty((NT, S['N']+1, NM))))
+    # decode the time axis
+    time_da = xr.decode_cf(xr.Dataset({'ocean_time': ('ocean_time', ot, ds.ocean_time.attrs)})).ocean_time
+    # package each mooring as a Dataset
+    ds_list = []
+    for mm in range(NM):
+        dsm = xr.Dataset(coords={'ocean_time': time_da})
+        for cn in ['s_rho', 's_w']:
+            if cn in ds.coords:
+                dsm.coords[cn] = ds[cn]
+        for tag in JI.keys():
+            for cn in ['lon_', 'lat_']:
+                if (cn + tag) in ds.variables:
+                    dsm.coords[cn + tag] = ((), ds[cn + tag].values[JI[tag][0][mm], JI[tag][1][mm]],
+                        ds[cn + tag].attrs)
+        for vn in vn_list:
+            if vn == 'h':
+                dsm[vn] = ((), h[mm], ds[vn].attrs)
+            elif vn in VI.keys():
+                zdim = VI[vn][1]
+                if zdim is None:
+                    dsm[vn] = (('ocean_time',), A[vn][:,mm], ds[vn].attrs)
+                else:
+                    dsm[vn] = (('ocean_time', zdim), A[vn][:,mm,:], ds[vn].attrs)
+        # the returned z arrays have vertical position first, so we
+        # transpose to put time first for the mooring, to be consistent with
+        # all other variables
+        dsm['z_rho'] = (('ocean_time', 's_rho'), z_rho[:,:,mm])
+        dsm['z_w'] = (('ocean_time', 's_w'), z_w[:,:,mm])
+        dsm.z_rho.attrs['units'] = 'm'
+        dsm.z_w.attrs['units'] = 'm'
+        dsm.z_rho.attrs['long name'] = 'vertical position on s_rho grid, positive up'
+        dsm.z_w.attrs['long name'] = 'vertical position on s_w grid, positive up'
+        # add units to salt
+        if 'salt' in dsm.data_vars:
+            dsm.salt.attrs['units'] = 'g kg-1'
+        # update the time long name
+        dsm.ocean_time.attrs['long_name'] = 'Time [UTC]'
+        # global attributes from the history file, and update format attribute
+        dsm.attrs = ds.attrs.copy()
+        dsm.attrs['format'] = 'netCDF-4'
+        ds_list.append(dsm)
+    ds.close()
+    return ds_list
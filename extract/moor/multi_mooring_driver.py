@@ -1,7 +1,7 @@
 """
 This is a driver for doing multiple mooring extractions.  It reads in
-a dict from LO_user/extract/moor/job_lists.py and uses this to run extract_moor.py as a
-series of subprocesses.
+a dict from LO_user/extract/moor/job_lists.py and extracts all of the moorings
+in a single pass through the history files, using moor_fun.extract_moorings().
 
 2021.11.24 Now it should move the output to a folder named after the job.
 
@@ -14,15 +14,15 @@ NOTE: naming the log as "*.log" means that is it automatically ignored by git (a
 """
 
 # imports
-from lo_tools import Lfun
+from lo_tools import Lfun, zrfun
 
 import sys
 import argparse
-from subprocess import Popen as Po
-from subprocess import PIPE as Pi
 import os
 from time import time
 import shutil
+import xarray as xr
+import moor_fun
 
 pid = os.getpid()
 print(' multi_mooring_driver '.center(60,'='))
@@ -47,7 +47,7 @@ parser.add_argument('-get_surfbot', type=Lfun.boolean_string, default=False)
 parser.add_argument('-get_pressure', type=Lfun.boolean_string, default=False)
 # OR select all of them
 parser.add_argument('-get_all', type=Lfun.boolean_string, default=False)
-# Optional: set max number of subprocesses to run at any time
+# Optional: set number of worker processes
 parser.add_argument('-Nproc', type=int, default=10)
 # Optional: for testing
 parser.add_argument('-test', '--testing', default=False, type=Lfun.boolean_string)
@@ -105,10 +105,6 @@ sta_dict = job_lists.get_sta_dict(Ldir['job'])
 #         new_sta_dict[sn] = sta_dict[sn]
 #     sta_dict = new_sta_dict
 
-# make place for log files
-log_dir = Ldir['LOo'] / 'extract' / Ldir['gtagex'] / 'moor' / 'logs'
-Lfun.make_dir(log_dir)
-
 # make place to copy the results of this job
 out_dir = Ldir['LOo'] / 'extract' / Ldir['gtagex'] / 'moor'
 jout_dir = out_dir / Ldir['job']
@@ -116,56 +112,44 @@ Lfun.make_dir(jout_dir)
 
 print('Results will go to %s' % (str(jout_dir)))
 
-ii = 1
-jout_fn_list = []
-njobs = len(sta_dict.keys())
+tt0 = time()
+
+# get indices for all the moorings
+in_dir0 = Ldir['roms_out'] / Ldir['gtagex']
+G = zrfun.get_basic_info(in_dir0 / ('f' + Ldir['ds0']) / 'ocean_his_0002.nc', only_G=True)
+get_uv = Ldir['get_vel'] or Ldir['get_surfbot'] or Ldir['get_pressure']
+sn_list = []
+ji_list = []
 for sn in sta_dict.keys():
-    tt0 = time()
-    print('Working on %s (%d of %d)' % (sn, ii, njobs), end='')
-    sys.stdout.flush()
-    x = ' ' + str(sta_dict[sn][0])
-    y = ' ' + str(sta_dict[sn][1])
-    cmd_list = ['python','extract_moor.py',
-        '-gtx', Ldir['gtagex'], '-ro', str(Ldir['roms_out_num']),
-        '-0', Ldir['ds0'], '-1', Ldir['ds1'], '-lt', Ldir['list_type'],
-        '-sn', sn, '-lon', x, '-lat', y, '-Nproc', str(Ldir['Nproc']),
-        '-get_tsa', str(Ldir['get_tsa']), '-get_vel', str(Ldir['get_vel']),
-        '-get_bio', str(Ldir['get_bio']), '-get_surfbot', str(Ldir['get_surfbot']),
-        '-get_pressure', str(Ldir['get_pressure'])]
-    proc = Po(cmd_list, stdout=Pi, stderr=Pi)
-    stdout, stderr = proc.communicate()
-    
-    if Ldir['testing']:
-        if len(stdout) > 0:
-            print(stdout.decode())
-        if len(stderr) > 0:
-            print(stderr.decode())
-        sys.stdout.flush()
-    
-    # copy or move the results to a folder named for the job
-    moor_fn = out_dir / (sn + '_' + Ldir['ds0'] + '_' + Ldir['ds1'] + '.nc')
+    print('Finding indices for %s' % (sn))
+    ji = moor_fun.get_moor_ji(G, sta_dict[sn][0], sta_dict[sn][1], get_uv=get_uv)
+    if ji is None:
+        print(' - error making %s' % (sn))
+    else:
+        sn_list.append(sn)
+        ji_list.append(ji)
+sys.stdout.flush()
+if len(ji_list) == 0:
+    print('ERROR: no moorings to extract')
+    sys.exit()
+
+fn_list = Lfun.get_fn_list(Ldir['list_type'], Ldir, Ldir['ds0'], Ldir['ds1'])
+
+ds = xr.open_dataset(fn_list[0])
+vn_list = moor_fun.get_vn_list(ds, Ldir)
+ds.close()
+
+# do the extraction for all moorings at once
+ds_list = moor_fun.extract_moorings(fn_list, ji_list, vn_list, Nproc=Ldir['Nproc'])
+
+# save the results in a folder named for the job
+for sn, ds in zip(sn_list, ds_list):
     job_moor_fn = jout_dir / (sn + '_' + Ldir['ds0'] + '_' + Ldir['ds1'] + '.nc')
-    try:
-        if Ldir['testing']:
-            # when testing we keep the original extraction to make it easier to plot
-            shutil.copyfile(moor_fn, job_moor_fn)
-        else:
-            shutil.move(moor_fn, job_moor_fn)
-    except FileNotFoundError:
-        print(' - error making %s' % (job_moor_fn.name))
-    
-    # write screen output to logs
-    sout_fn = log_dir / (sn + '_screen_output.txt')
-    serr_fn = log_dir / (sn + '_subprocess_error.txt')
-    sout_fn.unlink(missing_ok=True)
-    serr_fn.unlink(missing_ok=True)
-    if len(stdout) > 0:
-        with open(sout_fn, 'w') as fout:
-            fout.write(stdout.decode())
-    if len(stderr) > 0:
-        with open(serr_fn, 'w') as ffout:
-            ffout.write(stderr.decode())
-    print(': completed in %d sec' % (time()-tt0))
-    sys.stdout.flush()
-    ii += 1
-print('DONE')
\ No newline at end of file
+    ds.to_netcdf(job_moor_fn)
+    if Ldir['testing']:
+        # when testing we also keep the original extraction to make it easier to plot
+        moor_fn = out_dir / (sn + '_' + Ldir['ds0'] + '_' + Ldir['ds1'] + '.nc')
+        shutil.copyfile(job_moor_fn, moor_fn)
+    ds.close()
+print('%d moorings completed in %d sec' % (len(sn_list), time()-tt0))
+print('DONE')
@@ -4,6 +4,9 @@ Based on his code, and modified by PM.
 
 PERFORMANCE: 9 sec for test.
 
+The bulk calculation for each day is independent, so when not testing these are
+done in parallel using -Nproc worker processes (default 10).
+
 To test on mac:
 run bulk_calc.py -gtx cas7_trapsV00_meV00 -ctag c0 -0 2017.07.04 -1 2017.07.06
 
@@ -19,6 +22,8 @@ import xarray as xr
 
 from lo_tools import Lfun, zfun
 import tef_fun_lorenz as tfl
+import tef_fun
+import extract_fun
 
 from lo_tools import extract_argfun as exfun
 Ldir = exfun.intro() # this handles the argument passing
@@ -46,6 +51,33 @@ tt00 = time()
 # the first day, and look at the details of the multi-layer bulk calculation,
 # both graphically and as screen output.
 
+# Otherwise the bulk calculation for all (section, day) pairs is spread over a pool
+# of Nproc worker processes. The days of a section are handed to the pool all at once,
+# and then we go on to load and filter the next section while they are being done.
+# The results for each section are saved when the next one has been handed off.
+
+nlay = 30
+
+def save_section(out_fn, time_lp, vn_list, vec_list, MLO, res):
+    # Finish the multi-layer output for a section and save it.
+    if res is not None:
+        for dd, ML in enumerate(res.get()):
+            for vn in vn_list:
+                MLO[vn][dd,:] = ML[vn]
+    # Pack results in a Dataset and then save to NetCDF
+    ds = xr.Dataset(coords={'time': time_lp,'layer': np.arange(nlay)})
+    for vn in vn_list:
+        ds[vn] = (('time','layer'), MLO[vn])
+    for vn in vec_list:
+        ds[vn] = (('time'), MLO[vn])
+    # save it to NetCDF
+    ds.to_netcdf(out_fn)
+    ds.close()
+
+if not Ldir['testing']:
+    pool = extract_fun.get_pool(Ldir['Nproc'], None, ())
+pending = None
+
 for snp in sect_list:
     tt0 = time()
     
@@ -94,103 +126,82 @@ for snp in sect_list:
     NT = len(time_lp)
     NS = len(sedges)
 
-    # calculate all transports integrated over salinity, e.g. Q(s) = integral(q ds)
-    omat = np.zeros((NT, NS))
-    Q_dict = dict()
-    for vn in vn_list:
-        Q_dict[vn] = omat.copy()
-        Q_dict[vn][:,:-1] = np.fliplr(np.cumsum(np.fliplr(TEF_lp[vn]), axis=1))
+    # calculate all transports integrated over salinity, e.g. Q(s) = integral(q ds),
+    # for all variables and times at once, packed (vn, t, s)
+    Q_arr = tef_fun.get_Q(np.stack([TEF_lp[vn] for vn in vn_list]))
+    Q_dict = {vn: Q_arr[vv,:,:] for vv, vn in enumerate(vn_list)}
 
     # prepare arrays to hold multi-layer output
-    nlay = 30
     nmat = np.nan * np.ones((NT, nlay))
     MLO = dict()
     for vn in vn_list:
         MLO[vn] = nmat.copy()
-    
-    if Ldir['testing']:
-        plt.close('all')
-        dd_list = [0]
-        print_info = True
-    else:
-        dd_list = range(NT)
-        print_info = False
-
-    for dd in dd_list:
-            
-        thisQ_dict = dict()
-        for vn in vn_list:
-            thisQ_dict[vn] = Q_dict[vn][dd,:]
-    
-        if print_info == True:
-            print('\n**** dd = %d ***' % (dd))
-                
-        out_tup = tfl.calc_bulk_values(sedges, thisQ_dict, vn_list, print_info=print_info)
-        in_dict, out_dict, div_sal, ind, minmax = out_tup
-        
-        if print_info == True:
-            print(' ind = %s' % (str(ind)))
-            print(' minmax = %s' % (str(minmax)))
-            print(' div_sal = %s' % (str(div_sal)))
-            print(' Q_in_m = %s' % (str(in_dict['q'])))
-            print(' s_in_m = %s' % (str(in_dict['salt'])))
-            print(' Q_out_m = %s' % (str(out_dict['q'])))
-            print(' s_out_m = %s' % (str(out_dict['salt'])))
-        
-            fig = plt.figure(figsize=(12,8))
-        
-            ax = fig.add_subplot(121)
-            ax.plot(Q_dict['q'][dd,:], sedges,'.k')
-            min_mask = minmax=='min'
-            max_mask = minmax=='max'
-            print(min_mask)
-            print(max_mask)
-            ax.plot(Q_dict['q'][dd,ind[min_mask]], sedges[ind[min_mask]],'*b')
-            ax.plot(Q_dict['q'][dd,ind[max_mask]], sedges[ind[max_mask]],'*r')
-            ax.grid(True)
-            ax.set_title('Q(s) Time index = %d' % (dd))
-            ax.set_ylim(-.1,36.1)
-            ax.set_ylabel('Salinity')
-        
-            ax = fig.add_subplot(122)
-            ax.plot(TEF_lp['q'][dd,:], sbins)
-            ax.grid(True)
-            ax.set_title('-dQ/ds')
-        
-        bulk_dict = dict()
-        for vn in vn_list:
-            bulk_dict[vn] = np.array(in_dict[vn] + out_dict[vn])
-        ii = np.argsort(bulk_dict['salt'])
-        if len(ii) > 0:
-            for vn in vn_list:
-                bulk_dict[vn] = bulk_dict[vn][ii]
-                NL = len(ii)
-                MLO[vn][dd, :NL] = bulk_dict[vn]
-                
     for vn in vec_list:
         MLO[vn] = TEF_lp[vn].copy()
-        
-    # Pack results in a Dataset and then save to NetCDF
-    ds = xr.Dataset(coords={'time': time_lp,'layer': np.arange(nlay)})
+    
+    if not Ldir['testing']:
+        # hand all the days to the pool
+        item_list = [(Q_arr[:,dd,:], sedges, vn_list, nlay) for dd in range(NT)]
+        chunksize = max(1, NT//(4*Ldir['Nproc']))
+        res = pool.map_async(tef_fun.do_bulk_worker, item_list, chunksize=chunksize)
+        # and save the previous section while they work
+        if pending is not None:
+            save_section(*pending)
+        pending = (out_fn, time_lp, vn_list, vec_list, MLO, res)
+        print('  elapsed time for section = %d seconds' % (time()-tt0))
+        sys.stdout.flush()
+        continue
+    
+    # testing: do the first day, with diagnostic output and a plot
+    plt.close('all')
+    dd = 0
+    thisQ_dict = dict()
     for vn in vn_list:
-        ds[vn] = (('time','layer'), MLO[vn])
-    for vn in vec_list:
-        ds[vn] = (('time'), MLO[vn])
-    # save it to NetCDF
-    ds.to_netcdf(out_dir / out_fn)
-    if Ldir['testing']:
-        pass
-    else:
-        ds.close()
+        thisQ_dict[vn] = Q_dict[vn][dd,:]
+    print('\n**** dd = %d ***' % (dd))
+    out_tup = tfl.calc_bulk_values(sedges, thisQ_dict, vn_list, print_info=True)
+    in_dict, out_dict, div_sal, ind, minmax = out_tup
+    print(' ind = %s' % (str(ind)))
+    print(' minmax = %s' % (str(minmax)))
+    print(' div_sal = %s' % (str(div_sal)))
+    print(' Q_in_m = %s' % (str(in_dict['q'])))
+    print(' s_in_m = %s' % (str(in_dict['salt'])))
+    print(' Q_out_m = %s' % (str(out_dict['q'])))
+    print(' s_out_m = %s' % (str(out_dict['salt'])))
+
+    fig = plt.figure(figsize=(12,8))
+
+    ax = fig.add_subplot(121)
+    ax.plot(Q_dict['q'][dd,:], sedges,'.k')
+    min_mask = minmax=='min'
+    max_mask = minmax=='max'
+    ax.plot(Q_dict['q'][dd,ind[min_mask]], sedges[ind[min_mask]],'*b')
+    ax.plot(Q_dict['q'][dd,ind[max_mask]], sedges[ind[max_mask]],'*r')
+    ax.grid(True)
+    ax.set_title('Q(s) Time index = %d' % (dd))
+    ax.set_ylim(-.1,36.1)
+    ax.set_ylabel('Salinity')
+
+    ax = fig.add_subplot(122)
+    ax.plot(TEF_lp['q'][dd,:], sbins)
+    ax.grid(True)
+    ax.set_title('-dQ/ds')
+
+    # fill MLO from the same calculation
+    ML = tef_fun.get_bulk_from_values(in_dict, out_dict, vn_list, nlay=nlay)
+    for vn in vn_list:
+        MLO[vn][dd,:] = ML[vn]
+
+    save_section(out_fn, time_lp, vn_list, vec_list, MLO, None)
     print('  elapsed time for section = %d seconds' % (time()-tt0))
     sys.stdout.flush()
     
-    if Ldir['testing']:
-        plt.show()
+    plt.show()
+
+if not Ldir['testing']:
+    if pending is not None:
+        save_section(*pending)
+    pool.close()
+    pool.join()
         
 print('\nTotal elapsed time = %d seconds' % (time()-tt00))
-
-
-
-
-
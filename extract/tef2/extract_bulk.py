@@ -0,0 +1,113 @@
+"""
+Code to go directly from history files to the multi-layer bulk TEF results for
+all sections in a collection, in a single pass.
+
+This gives the same results as running extract_sections.py, process_sections.py,
+and bulk_calc.py in sequence, but without ever writing the hourly (time, z, p)
+extractions or the salinity-binned (time, sbins) files. Each hour is binned
+into salinity classes as soon as it is extracted, and the tidal averaging is done
+with running Godin filter sums (see extract_fun.bulk_sections()).
+
+The output goes to the same place, and has the same format, as the output of
+bulk_calc.py, so you can go straight to bulk_plot.py.
+
+To test on mac:
+run extract_bulk.py -gtx cas7_trapsV00_meV00 -ctag c0 -get_bio True -0 2017.07.04 -1 2017.07.08
+
+Note that the date range must be at least 4 days long to get any tidally averaged results.
+
+Use -test True to use just 36 salinity bins.
+
+"""
+
+from lo_tools import Lfun, zrfun, zfun
+from lo_tools import extract_argfun as exfun
+Ldir = exfun.intro() # this handles the argument passing
+
+from time import time
+import sys
+import pandas as pd
+import xarray as xr
+import numpy as np
+import extract_fun
+import tef_fun
+
+gctag = Ldir['gridname'] + '_' + Ldir['collection_tag']
+tef2_dir = Ldir['LOo'] / 'extract' / 'tef2'
+
+sect_df_fn = tef2_dir / ('sect_df_' + gctag + '.p')
+sect_df = pd.read_pickle(sect_df_fn)
+
+fn_list = Lfun.get_fn_list('hourly', Ldir, Ldir['ds0'], Ldir['ds1'], his_num=Ldir['his_num'])
+
+out_dir0 = Ldir['LOo'] / 'extract' / Ldir['gtagex'] / 'tef2'
+out_dir = out_dir0 / ('bulk_' + Ldir['ds0'] + '_' + Ldir['ds1'])
+Lfun.make_dir(out_dir, clean=True)
+
+# define salinity bins
+if Ldir['testing']:
+    NS = 36 # number of salinity bins
+else:
+    NS = 1000 # number of salinity bins
+sedges, sbins = tef_fun.get_sbins(NS=NS)
+
+# static section info and the list of variables, found once
+SI = extract_fun.get_sect_info(sect_df, fn_list[0])
+S = zrfun.get_basic_info(fn_list[0], only_S=True)
+ds = xr.open_dataset(fn_list[0])
+vn_list = extract_fun.get_vn_list(ds, Ldir['get_bio'])
+ds.close()
+sect_list = list(sect_df.sn.unique())
+sect_list.sort()
+nsect = len(sect_list)
+sect_ind = np.zeros(SI['NP'], dtype=int)
+for ss, sn in enumerate(sect_list):
+    sect_ind[(sect_df.sn == sn).to_numpy()] = ss
+
+print('\nExtracting bulk TEF for ' + str(nsect) + ' sections:')
+print(str(out_dir))
+sys.stdout.flush()
+
+tt0 = time()
+nlay = 30
+ot, ilp, MLO_list, qnet, ssh = extract_fun.bulk_sections(fn_list, SI, vn_list, S,
+    sect_ind, nsect, sedges, Nproc=Ldir['Nproc'], nlay=nlay)
+print('Total processing time = %0.2f sec' % (time()-tt0))
+sys.stdout.flush()
+
+# decode the time axis using the units from the history files
+time_da = xr.decode_cf(xr.Dataset({'time': ('time', ot, {'units':SI['ot_units']})})).time
+time_lp = time_da.values[ilp]
+
+# Tidal averaging of the time series, done the same way as in bulk_calc.py.
+# Time is on axis 0, so we can do all sections at once.
+g = 9.8
+rho = 1025
+fnet = g * rho * ssh * qnet
+# Create the absolute value of the net transport (to make Qprism)
+# but first remove the low-passed transport (like Qr)
+qnet_lp = zfun.lowpass(qnet, f='godin', nanpad=False)
+qabs = np.abs(qnet - qnet_lp)
+pad = 36
+vec_dict = dict()
+for vn, vv in zip(['qnet', 'fnet', 'ssh', 'qabs'], [qnet, fnet, ssh, qabs]):
+    vec_dict[vn] = zfun.lowpass(vv, f='godin')[pad:-pad+1:24, :]
+# Add the qprism time series.
+# Conceptually, qprism is the maximum possible exchange flow if all
+# the flood tide made Qin and all the ebb tide made Qout.
+# If you go through the trigonometry you find that qprism = 1/2 <qabs>.
+vec_dict['qprism'] = vec_dict['qabs'].copy()/2
+vec_list = ['qnet', 'fnet', 'ssh', 'qabs', 'qprism']
+
+for ss, sn in enumerate(sect_list):
+    # Pack results in a Dataset and then save to NetCDF
+    ds = xr.Dataset(coords={'time': time_lp,'layer': np.arange(nlay)})
+    for vn in vn_list + ['q','salt2']:
+        ds[vn] = (('time','layer'), MLO_list[ss][vn])
+    for vn in vec_list:
+        ds[vn] = (('time'), vec_dict[vn][:,ss])
+    # save it to NetCDF
+    ds.to_netcdf(out_dir / (sn + '.nc'))
+    ds.close()
+
+print('\nTotal elapsed time = %d seconds' % (time()-tt0))
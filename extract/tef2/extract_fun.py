@@ -0,0 +1,437 @@
+"""
+Functions for extracting tef2 sections and segments from history files,
+used by extract_sections.py and extract_segments.py.
+
+The collection geometry and the indices used to gather values from the
+history files are made once and then handed to a pool of worker processes
+(Nproc of them). Each worker streams through history files and the results
+go directly into preallocated arrays:
+- for sections these are memory-mapped .npy files (time, z, p), one per variable,
+since a year of them can be bigger than memory.
+- for segments the results for each hour are small so they are just sent back
+to the calling code. Each segment is a row of a sparse membership matrix, so the
+volume integrals for all segments come from one matrix-vector product per variable.
+- for bulk_sections() the hourly results are binned into salinity classes by the
+workers and then tidally averaged on the fly, so nothing big is ever saved.
+
+This replaces launching one python subprocess per history file, and the
+temporary NetCDF files and ncrcat step that went with it.
+
+NOTE: the pool uses the "fork" start method so that the worker functions can
+be used from scripts that do all their work at the top level, like the rest
+of LO.
+"""
+
+import sys
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy import sparse
+
+from lo_tools import zrfun, zfun
+import tef_fun
+
+# state for each worker process, set by the pool initializers
+W = dict()
+
+def get_vn_list(ds, get_bio):
+    """
+    Returns the list of 3-D tracers to extract from the history file Dataset ds.
+    """
+    if get_bio:
+        if 'NH4' in ds.data_vars:
+            vn_list = tef_fun.vn_list.copy()
+        else:
+            # old roms version
+            vn_list = ['salt', 'temp', 'oxygen',
+                'NO3', 'phytoplankton', 'zooplankton', 'detritus', 'Ldetritus',
+                'TIC', 'alkalinity']
+    else:
+        vn_list = ['salt']
+    return vn_list
+
+def get_pool(Nproc, initializer, initargs):
+    return mp.get_context('fork').Pool(Nproc, initializer=initializer, initargs=initargs)
+
+# ---------------------------------- sections ----------------------------------
+
+def get_sect_info(sect_df, fn):
+    """
+    Gather everything about the section points that does not change with time.
+    Returns a dict SI of index vectors, the depth h and width dd [m] of each point,
+    and the units of ocean_time.
+    """
+    ds = xr.open_dataset(fn, decode_times=False)
+    ot_units = ds.ocean_time.units
+    # grid info
+    DX = 1/ds.pm.values
+    DY = 1/ds.pn.values
+    h = ds.h.values
+    N = len(ds.s_rho)
+    ds.close()
+    # Get spacing on u and v grids
+    dxv = DX[:-1,:] + np.diff(DX,axis=0)/2 # DX on the v-grid
+    dyu = DY[:,:-1] + np.diff(DY,axis=1)/2 # DY on the u-grid
+    # separate out u and v parts of sect_df
+    u_df = sect_df[sect_df.uv == 'u']
+    v_df = sect_df[sect_df.uv == 'v']
+    SI = dict()
+    for vn in ['jrp', 'irp', 'jrm', 'irm']:
+        SI[vn] = sect_df[vn].to_numpy()
+    SI['uj'] = u_df.j.to_numpy(); SI['ui'] = u_df.i.to_numpy()
+    SI['vj'] = v_df.j.to_numpy(); SI['vi'] = v_df.i.to_numpy()
+    SI['upm'] = u_df.pm.to_numpy().reshape(1,-1)
+    SI['vpm'] = v_df.pm.to_numpy().reshape(1,-1)
+    SI['uind'] = u_df.index.to_numpy()
+    SI['vind'] = v_df.index.to_numpy()
+    # get depth at section points
+    # note that we are interpolating from two rho-grid points onto the u- or v-grid
+    SI['h'] = (h[SI['jrp'], SI['irp']]  + h[SI['jrm'], SI['irm']])/2
+    # get width at section points
+    dd = np.nan * np.ones(SI['h'].shape)
+    dd[SI['vind']] = dxv[SI['vj'], SI['vi']]
+    dd[SI['uind']] = dyu[SI['uj'], SI['ui']]
+    SI['dd'] = dd
+    SI['NP'] = len(dd)
+    SI['NZ'] = N
+    SI['ot_units'] = ot_units
+    return SI
+
+def extract_sect_one_time(fn, SI, vn_list):
+    """
+    Extract zeta, tracers, and velocity normal to the section at all section
+    points from one history file. Returns a dict of arrays packed (z,p) or (p,),
+    and the ocean_time (seconds) as 'ot'.
+    """
+    ds = xr.open_dataset(fn, decode_times=False)
+    jrp = SI['jrp']; irp = SI['irp']; jrm = SI['jrm']; irm = SI['irm']
+    CC = dict()
+    CC['ot'] = ds.ocean_time.values[0]
+    # tracers and zeta
+    for vn in vn_list:
+        aa = ds[vn][0,:,:,:].values
+        CC[vn] = (aa[:, jrp, irp]  + aa[:, jrm, irm])/2
+    aa = ds.zeta[0,:,:].values
+    CC['zeta'] = (aa[jrp, irp]  + aa[jrm, irm])/2
+    # velocity
+    u = ds.u[0,:,:,:].values
+    v = ds.v[0,:,:,:].values
+    ds.close()
+    vel = np.nan * np.ones((SI['NZ'], SI['NP']))
+    vel[:,SI['uind']] = u[:, SI['uj'], SI['ui']] * SI['upm']
+    vel[:,SI['vind']] = v[:, SI['vj'], SI['vi']] * SI['vpm']
+    CC['vel'] = vel
+    return CC
+
+def init_sect_worker(SI, vn_list, mm_fn_dict):
+    W['SI'] = SI
+    W['vn_list'] = vn_list
+    W['mm'] = {vn: np.load(mm_fn_dict[vn], mmap_mode='r+') for vn in mm_fn_dict.keys()}
+
+def do_sect_worker(item):
+    # extract one history file and write it into time index ii of the arrays
+    ii, fn = item
+    CC = extract_sect_one_time(fn, W['SI'], W['vn_list'])
+    for vn in W['mm'].keys():
+        W['mm'][vn][ii] = CC[vn]
+        W['mm'][vn].flush()
+    return ii, CC['ot']
+
+def extract_sections(fn_list, SI, vn_list, temp_dir, Nproc=10):
+    """
+    Extract all sections from all history files in fn_list.
+
+    Returns ot (ocean_time in seconds, shape (NT,)) and a dict of memory-mapped
+    arrays for each variable, packed (t,z,p) for tracers and vel, and (t,p) for zeta.
+    These are saved in temp_dir.
+    """
+    NT = len(fn_list)
+    # do the first one here to find the array shapes and types
+    CC = extract_sect_one_time(fn_list[0], SI, vn_list)
+    mm_fn_dict = dict()
+    for vn in vn_list + ['zeta', 'vel']:
+        mm_fn_dict[vn] = temp_dir / (vn + '.npy')
+        mm = np.lib.format.open_memmap(mm_fn_dict[vn], mode='w+',
+            dtype=CC[vn].dtype, shape=(NT,) + CC[vn].shape)
+        mm[0] = CC[vn]
+        mm.flush()
+        del mm
+    ot = np.nan * np.ones(NT)
+    ot[0] = CC['ot']
+    item_list = [(ii, fn_list[ii]) for ii in range(1,NT)]
+    with get_pool(Nproc, init_sect_worker, (SI, vn_list, mm_fn_dict)) as pool:
+        counter = 1
+        for ii, this_ot in pool.imap_unordered(do_sect_worker, item_list, chunksize=4):
+            ot[ii] = this_ot
+            counter += 1
+            if np.mod(counter, 100) == 0:
+                print(str(counter), end=', ')
+                sys.stdout.flush()
+    print(str(NT))
+    sys.stdout.flush()
+    mm_dict = {vn: np.load(mm_fn_dict[vn], mmap_mode='r') for vn in mm_fn_dict.keys()}
+    return ot, mm_dict
+
+# ----------------------- sections straight to bulk ----------------------------
+
+def bin_sect_one_time(fn, SI, vn_list, S, sect_ind, nsect, sedges):
+    """
+    Extract all sections from one history file and bin the transports into
+    salinity classes, the same as process_sections.py does for one hour.
+
+    sect_ind is the section number (0 to nsect-1) of each section point.
+
+    Returns:
+    ot = ocean_time [sec]
+    qnet, ssh = arrays shaped (nsect,)
+    keys = the (section, salinity bin) keys, sect*NS + bin, that have any transport
+    vals = array shaped (len(vn_list)+2, len(keys)) of the binned transport
+        of ['q'] + vn_list + ['salt2'] for each key
+    """
+    NS = len(sedges) - 1
+    CC = extract_sect_one_time(fn, SI, vn_list)
+    zw = zrfun.get_z(SI['h'], CC['zeta'], S, only_w=True)
+    DZ = np.diff(zw, axis=0) # packed (z,p)
+    q = SI['dd'] * DZ * CC['vel']
+    # volume transport and sea surface height on each section
+    zeta = CC['zeta'].copy()
+    zeta[np.isnan(q[0,:])] = np.nan
+    qnet = np.nan * np.ones(nsect)
+    ssh = np.nan * np.ones(nsect)
+    for ss in range(nsect):
+        mask = sect_ind == ss
+        qnet[ss] = np.nansum(q[:,mask])
+        ssh[ss] = np.nanmean(zeta[mask])
+    # bin into (section, salinity) classes
+    kk = tef_fun.get_bin_index(CC['salt'], sedges)
+    key = kk + NS*sect_ind.reshape(1,-1)
+    valid = kk >= 0
+    keys, kinv = np.unique(key[valid], return_inverse=True)
+    qv = q[valid]
+    qv = np.where(np.isnan(qv), 0, qv)
+    QV_list = [qv]
+    for vn in vn_list:
+        QV_list.append(qv * CC[vn][valid])
+    QV_list.append(qv * (CC['salt'][valid] * CC['salt'][valid]))
+    vals = np.nan * np.ones((len(QV_list), len(keys)))
+    for vv, QV in enumerate(QV_list):
+        QV = np.where(np.isnan(QV), 0, QV)
+        vals[vv,:] = np.bincount(kinv, weights=QV, minlength=len(keys))
+    return CC['ot'], qnet, ssh, keys, vals
+
+def init_bin_worker(SI, vn_list, S, sect_ind, nsect, sedges):
+    W['args'] = (SI, vn_list, S, sect_ind, nsect, sedges)
+
+def do_bin_worker(fn):
+    return bin_sect_one_time(fn, *W['args'])
+
+def bulk_sections(fn_list, SI, vn_list, S, sect_ind, nsect, sedges, Nproc=10, nlay=30):
+    """
+    Go from history files straight to the multi-layer bulk TEF results for all sections,
+    never saving the hourly extractions or salinity-binned transports.
+
+    Each hour is extracted and binned by a pool of Nproc workers. The binned
+    transports are then added into running Godin filter sums for each of the
+    tidally averaged times that bulk_calc.py would save (noon of each day,
+    excluding the first and last days), and the multi-layer bulk calculation
+    is done as soon as the filter window for one of these times is complete.
+    Only a few days of binned transports are held in memory at once.
+
+    The hourly qnet and ssh are small, so they are kept and filtered at the end
+    in exactly the same way as in bulk_calc.py.
+
+    Returns:
+    ot = hourly ocean_time [sec], shaped (NT,)
+    ilp = the time indices of the tidally averaged times, shaped (NT_lp,)
+    MLO_list = list (one for each section) of dicts of the multi-layer results for
+        ['q'] + vn_list + ['salt2'], each shaped (NT_lp, nlay)
+    qnet, ssh = hourly time series shaped (NT, nsect)
+    """
+    NT = len(fn_list)
+    NS = len(sedges) - 1
+    lp_vn_list = ['q'] + vn_list + ['salt2']
+    NV = len(lp_vn_list)
+    filt = zfun.godin_shape()
+    npad = 35 # half width of the filter
+    # Tidal averaging and subsampling: this matches
+    # zfun.lowpass(x, f='godin')[pad:-pad+1:24, :] with pad = 36 in bulk_calc.py,
+    # which gives fields at Noon of each day (excluding the first and last days).
+    ilp = np.arange(NT)[36:-35:24]
+    NT_lp = len(ilp)
+    MLO_list = []
+    for ss in range(nsect):
+        MLO = dict()
+        for vn in lp_vn_list:
+            MLO[vn] = np.nan * np.ones((NT_lp, nlay))
+        MLO_list.append(MLO)
+    ot = np.nan * np.ones(NT)
+    qnet = np.nan * np.ones((NT, nsect))
+    ssh = np.nan * np.ones((NT, nsect))
+    # running filter sums, keyed by the index into ilp
+    acc_dict = dict()
+    with get_pool(Nproc, init_bin_worker, (SI, vn_list, S, sect_ind, nsect, sedges)) as pool:
+        # use the ordered imap so that windows are complete in time order
+        for tt, out_tup in enumerate(pool.imap(do_bin_worker, fn_list, chunksize=4)):
+            ot[tt], qnet[tt,:], ssh[tt,:], keys, vals = out_tup
+            for kk in np.nonzero(np.abs(ilp - tt) <= npad)[0]:
+                if kk not in acc_dict.keys():
+                    acc_dict[kk] = np.zeros((NV, nsect*NS))
+                acc_dict[kk][:,keys] += filt[npad + tt - ilp[kk]] * vals
+                if tt == ilp[kk] + npad:
+                    # the window is complete so do the bulk calculation
+                    acc = acc_dict.pop(kk).reshape(NV, nsect, NS)
+                    for ss in range(nsect):
+                        TEF_lp = dict()
+                        for vv, vn in enumerate(lp_vn_list):
+                            TEF_lp[vn] = acc[vv,ss,:]
+                        ML = tef_fun.get_bulk_one_time(TEF_lp, sedges, lp_vn_list, nlay=nlay)
+                        for vn in lp_vn_list:
+                            MLO_list[ss][vn][kk,:] = ML[vn]
+            if np.mod(tt+1, 100) == 0:
+                print(str(tt+1), end=', ')
+                sys.stdout.flush()
+    print(str(NT))
+    sys.stdout.flush()
+    return ot, ilp, MLO_list, qnet, ssh
+
+# ---------------------------------- segments ----------------------------------
+
+def get_seg_info(seg_info_dict):
+    """
+    Returns a dict of (jj, ii) index vectors on the rho-grid for each segment.
+    """
+    ji_dict = dict()
+    for seg in seg_info_dict.keys():
+        ji = np.array(seg_info_dict[seg]['ji_list'], dtype=int).reshape(-1,2)
+        ji_dict[seg] = (ji[:,0], ji[:,1])
+    return ji_dict
+
+def get_seg_vn_lists(ds, get_bio):
+    """
+    Returns the lists of 3-D and 2-D variables to extract for segments.
+    """
+    vn_list = [vn for vn in get_vn_list(ds, get_bio) if vn in ds.data_vars]
+    # add custom 3-D variables, like salt-squared
+    vn_list = vn_list + ['salt2']
+    # Other 2-D quantities we will want for budgets:
+    #
+    # EminusP
+    # standard_name:   surface_upward_water_flux
+    # long_name:       modeled surface net freshwater flux, (E-P)/rhow
+    # units:           meter second-1
+    # negative_value:  upward flux, freshening (net precipitation)
+    # positive_value:  downward flux, salting (net evaporation)
+    #
+    # salt_surf: Surface salinity, to use with EminusP
+    #
+    # shflux
+    # standard_name:   surface_downward_heat_flux_in_sea_water
+    # long_name:       surface net heat flux
+    # units:           watt meter-2
+    # negative_value:  upward flux, cooling
+    # positive_value:  downward flux, heating
+    two_d_list = []
+    if 'EminusP' in ds.data_vars:
+        two_d_list.append('EminusP')
+    two_d_list.append('salt_surf')
+    if 'sh_flux' in ds.data_vars:
+        two_d_list.append('shflux')
+    return vn_list, two_d_list
+
+def get_seg_matrix(ji_dict, G):
+    """
+    Returns a dict SM with:
+    'jj', 'ii' = index vectors of all the rho-grid columns that are in any segment
+    'M' = sparse (segment, column) matrix that is 1 where a column is in a segment
+    so that, for a vector x of some quantity in each of the columns,
+    M @ x is its sum over each segment.
+    """
+    seg_list = list(ji_dict.keys())
+    NR, NC = G['h'].shape
+    rows = np.concatenate([ss * np.ones(len(ji_dict[seg][0]), dtype=int)
+        for ss, seg in enumerate(seg_list)])
+    ind = np.concatenate([ji_dict[seg][0]*NC + ji_dict[seg][1] for seg in seg_list])
+    # only keep the columns that are in some segment
+    cols, col_ind = np.unique(ind, return_inverse=True)
+    M = sparse.csr_matrix((np.ones(len(ind)), (rows, col_ind)),
+        shape=(len(seg_list), len(cols)))
+    jj, ii = np.divmod(cols, NC)
+    SM = {'M':M, 'jj':jj, 'ii':ii}
+    return SM
+
+def extract_seg_one_time(fn, G, S, SM, vn_list, two_d_list):
+    """
+    Find the volume, area, volume-averaged 3-D tracers, and area-averaged 2-D
+    fields in each segment for one history file.
+    SM is the dict from get_seg_matrix().
+    Returns ocean_time (a datetime64) and an array packed (seg, variable), with
+    the variables in the order ['volume', 'area'] + vn_list + two_d_list.
+    """
+    M = SM['M']
+    jj = SM['jj']
+    ii = SM['ii']
+    NV = 2 + len(vn_list) + len(two_d_list)
+    A = np.nan * np.ones((M.shape[0], NV))
+    ds = xr.open_dataset(fn)
+    ot = ds.ocean_time.values[0]
+    # volume of each cell, for all the segment columns at once
+    h = G['h'][jj,ii]
+    DA = G['DX'][jj,ii] * G['DY'][jj,ii]
+    zeta = ds['zeta'][0,:,:].values[jj,ii]
+    z_w = zrfun.get_z(h, zeta, S, only_w=True).reshape((S['N']+1, -1))
+    DV = np.diff(z_w, axis=0) * DA
+    A[:,0] = M @ DV.sum(axis=0)
+    A[:,1] = M @ DA
+    # 3-D tracers
+    for vv, vn in enumerate(vn_list):
+        if vn == 'salt2':
+            fld = ds.salt[0,:,:,:].values[:,jj,ii]**2
+        else:
+            fld = ds[vn][0,:,:,:].values[:,jj,ii]
+        A[:,2+vv] = (M @ (fld * DV).sum(axis=0))/A[:,0]
+    # 2-D properties, e.g. for surface fluxes
+    for vv, vn in enumerate(two_d_list):
+        if vn == 'salt_surf':
+            fld = ds.salt[0,-1,:,:].values[jj,ii]
+        else:
+            fld = ds[vn][0,:,:].values[jj,ii]
+        A[:,2+len(vn_list)+vv] = (M @ (fld * DA))/A[:,1]
+    ds.close()
+    return ot, A
+
+def init_seg_worker(G, S, SM, vn_list, two_d_list):
+    W['args'] = (G, S, SM, vn_list, two_d_list)
+
+def do_seg_worker(item):
+    ii, fn = item
+    ot, A = extract_seg_one_time(fn, *W['args'])
+    return ii, ot, A
+
+def extract_segments(fn_list, G, S, ji_dict, vn_list, two_d_list, Nproc=10):
+    """
+    Extract all segments from all history files in fn_list.
+    Returns an xarray Dataset of variable(time, seg).
+    """
+    NT = len(fn_list)
+    seg_list = list(ji_dict.keys())
+    NV = 2 + len(vn_list) + len(two_d_list)
+    AA = np.nan * np.ones((NT, len(seg_list), NV))
+    ot_list = [None] * NT
+    item_list = list(enumerate(fn_list))
+    SM = get_seg_matrix(ji_dict, G)
+    with get_pool(Nproc, init_seg_worker, (G, S, SM, vn_list, two_d_list)) as pool:
+        counter = 0
+        for ii, ot, A in pool.imap_unordered(do_seg_worker, item_list, chunksize=4):
+            ot_list[ii] = ot
+            AA[ii,:,:] = A
+            counter += 1
+            if np.mod(counter, 100) == 0:
+                print(str(counter), end=', ')
+                sys.stdout.flush()
+    print(str(NT))
+    sys.stdout.flush()
+    ds = xr.Dataset(coords={'time': pd.Index(ot_list), 'seg': seg_list})
+    for vv, vn in enumerate(['volume', 'area'] + vn_list + two_d_list):
+        ds[vn] = (('time','seg'), AA[:,:,vv])
+    return ds
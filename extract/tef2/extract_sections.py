@@ -4,10 +4,10 @@ Code to extract tef2 sections.
 To test on mac:
 run extract_sections.py -gtx cas7_trapsV00_meV00 -ctag c0 -get_bio True -0 2017.07.04 -1 2017.07.06
 
-Doing this with subprocesses (Nproc = 10, on my mac) was about 2x as fast as doing
-it sequentially within this program. The less-than-expected speedup may be because
-each job only takes about a second, and there is overhead to spinning up new python
-jobs because of imports.
+The work is done by a pool of Nproc worker processes (see extract_fun.py). Each
+worker loads the section indices once and then streams through history files,
+writing its results directly into memory-mapped arrays in temp_dir. This avoids
+the overhead of starting a new python job for every hour, and the ncrcat step.
 
 Also, this is a memory-intensive calculation, so be careful about using Nproc > 10
 (10 is the default in extract_argfun).
@@ -20,14 +20,12 @@ from lo_tools import Lfun, zrfun, zfun
 from lo_tools import extract_argfun as exfun
 Ldir = exfun.intro() # this handles the argument passing
 
-from subprocess import Popen as Po
-from subprocess import PIPE as Pi
 from time import time
 import sys
 import pandas as pd
 import xarray as xr
 import numpy as np
-import pickle
+import extract_fun
 
 gctag = Ldir['gridname'] + '_' + Ldir['collection_tag']
 tef2_dir = Ldir['LOo'] / 'extract' / 'tef2'
@@ -46,71 +44,20 @@ Lfun.make_dir(temp_dir, clean=True)
 if Ldir['testing']:
     fn_list = fn_list[:3]
 
-# loop over all jobs
+# static section info and the list of variables, found once
+SI = extract_fun.get_sect_info(sect_df, fn_list[0])
+ds = xr.open_dataset(fn_list[0])
+vn_list = extract_fun.get_vn_list(ds, Ldir['get_bio'])
+ds.close()
+
+# do the extraction for all times, using Nproc worker processes
 tt0 = time()
-N = len(fn_list)
-proc_list = []
-for ii in range(N):
-    # Launch a job and add its process to a list.
-    fn = fn_list[ii]
-    ii_str = ('0000' + str(ii))[-5:]
-    out_fn = temp_dir / ('CC_' + ii_str + '.nc')
-    # use subprocesses
-    cmd_list = ['python3', 'extract_sections_one_time.py',
-            '-sect_df_fn', str(sect_df_fn),
-            '-in_fn',str(fn),
-            '-out_fn', str(out_fn),
-            '-get_bio', str(Ldir['get_bio'])]
-    proc = Po(cmd_list, stdout=Pi, stderr=Pi)
-    proc_list.append(proc)
-    # If we have accumulated Nproc jobs, or are at the end of the
-    # total number of jobs, then stop and make sure all the jobs
-    # in proc_list have finished, using the communicate method.
-    if ((np.mod(ii,Ldir['Nproc']) == 0) and (ii > 0)) or (ii == N-1):
-        for proc in proc_list:
-            stdout, stderr = proc.communicate()
-            if len(stdout) > 0:
-                print('\nSTDOUT:')
-                print(stdout.decode())
-                sys.stdout.flush()
-            if len(stderr) > 0:
-                print('\nSTDERR:')
-                print(stderr.decode())
-                sys.stdout.flush()
-        # Then initialize a new list.
-        proc_list = []
-    # Print screen output about progress.
-    if (np.mod(ii,10) == 0) and ii>0:
-        print(str(ii), end=', ')
-        sys.stdout.flush()
-    if (np.mod(ii,50) == 0) and (ii > 0):
-        print('') # line feed
-        sys.stdout.flush()
-    if (ii == N-1):
-        print(str(ii))
-        sys.stdout.flush()
-    
+ot, mm_dict = extract_fun.extract_sections(fn_list, SI, vn_list, temp_dir, Nproc=Ldir['Nproc'])
 print('Total processing time = %0.2f sec' % (time()-tt0))
+sys.stdout.flush()
 
-# concatenate the records into one file
-# This bit of code is a nice example of how to replicate a bash pipe
-pp1 = Po(['ls', str(temp_dir)], stdout=Pi)
-pp2 = Po(['grep','CC'], stdin=pp1.stdout, stdout=Pi)
-temp_fn = str(temp_dir)+'/all.nc'
-cmd_list = ['ncrcat','-p', str(temp_dir), '-O', temp_fn]
-proc = Po(cmd_list, stdin=pp2.stdout, stdout=Pi, stderr=Pi)
-stdout, stderr = proc.communicate()
-if len(stdout) > 0:
-    print('\nSTDOUT:')
-    print(stdout.decode())
-    sys.stdout.flush()
-if len(stderr) > 0:
-    print('\nSTDERR:')
-    print(stderr.decode())
-    sys.stdout.flush()
-        
 """
-Next we want to repackage these results into one NetCDF file per section, with all times.
+Next we want to package these results into one NetCDF file per section, with all times.
 
 We will mostly follow the structure of the output of LO/tef/extract_sections.py
 so that we can mostly recycle the subsequent processing code:
@@ -136,35 +83,37 @@ and "DZ" [m] is the vertical thickness of each cell.
     
 """
 
-# Get DZ for the full set of sections
-ds1 = xr.open_dataset(temp_fn)
+# decode the time axis using the units from the history files
+time_da = xr.decode_cf(xr.Dataset({'time': ('time', ot, {'units':SI['ot_units']})})).time
 S = zrfun.get_basic_info(fn_list[0], only_S=True)
-eta = ds1.zeta.values.squeeze() # packed (t, p)
-NT, NP = eta.shape
-hh = ds1.h.values.squeeze().reshape(1,NP) * np.ones((NT,1))
-zw = zrfun.get_z(hh, eta, S, only_w=True)
-dz = np.diff(zw, axis=0) # NOTE: this is packed (z,t,p)
-DZ = np.transpose(dz, (1,0,2)) # packed (t,z,p)
 # then make a Dataset for each section, add DZ to it, and save to NetCDF
 sect_list = list(sect_df.sn.unique())
 sect_list.sort()
 for sn in sect_list:
     """
-    A useful tool for pulling out a section is np.where() combined with the
-    xr Dataset method isel(), as is done here.
+    A useful tool for pulling out a section is np.where() combined with
+    fancy indexing of the (t,z,p) arrays along the p axis, as is done here.
     """
     ii = np.where(sect_df.sn == sn)[0]
-    this_ds = ds1.isel(p=ii)
+    this_ds = xr.Dataset(coords={'time': time_da})
+    this_ds['h'] = (('p'), SI['h'][ii])
+    this_ds['dd'] = (('p'), SI['dd'][ii])
+    eta = mm_dict['zeta'][:,ii] # packed (t, p)
+    this_ds['zeta'] = (('time','p'), eta)
+    for vn in vn_list + ['vel']:
+        this_ds[vn] = (('time','z','p'), mm_dict[vn][:,:,ii])
     # add DZ
-    this_DZ = DZ[:,:,ii]
-    this_ds['DZ'] = (('time','z','p'), this_DZ)
+    # eta is a stack of times, and passing out= means get_z() does not squeeze
+    # singleton dimensions (e.g. a one-point section), so zw is packed (t,z,p)
+    NT, NP = eta.shape
+    zw = zrfun.get_z(SI['h'][ii], eta, S, only_w=True, out=np.empty((NT, S['N']+1, NP)))
+    this_ds['DZ'] = (('time','z','p'), np.diff(zw, axis=1)) # packed (t,z,p)
     this_fn = out_dir / (sn + '.nc')
     this_ds.to_netcdf(this_fn)
-ds1.close()
+    this_ds.close()
+del mm_dict
 
 # clean up the temp dir
 if not Ldir['testing']:
     Lfun.make_dir(temp_dir, clean=True)
     temp_dir.rmdir()
-
-
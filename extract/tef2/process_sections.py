@@ -15,13 +15,12 @@ import numpy as np
 import pickle
 from time import time
 import pandas as pd
-from scipy.stats import binned_statistic
 
 from lo_tools import Lfun, zrfun, zfun
 from lo_tools import extract_argfun as exfun
 Ldir = exfun.intro() # this handles the argument passing
 
-# import tef_fun
+import tef_fun
 
 gctag = Ldir['gridname'] + '_' + Ldir['collection_tag']
 tef2_dir = Ldir['LOo'] / 'extract' / 'tef2'
@@ -82,48 +81,27 @@ for ext_fn in sect_list:
         NS = 36 # number of salinity bins
     else:
         NS = 1000 # number of salinity bins
-    S_low = 0
-    S_hi = 36
-    sedges = np.linspace(S_low, S_hi, NS+1)
-    sbins = sedges[:-1] + np.diff(sedges)/2
+    sedges, sbins = tef_fun.get_sbins(NS=NS)
 
     # TEF variables
-    Omat = np.zeros((NT, NS))
     TEF = dict()
-    for vn in QV.keys():
-        TEF[vn] = Omat.copy()
-    # other variables
-    omat = np.zeros(NT)
-    qnet = omat.copy()
-    fnet = omat.copy()
-    ssh = omat.copy()
     g = 9.8
     rho = 1025
-
-    # Process into salinity bins.
-    for tt in range(NT):
-        sf = V['salt'][tt,:,:].squeeze().flatten()
-        
-        for vn in QV.keys():
-            XF = QV[vn][tt,:,:].squeeze().flatten()
-            if vn == 'q':
-                # also keep track of volume transport
-                #qnet[tt] = XF.sum() #jx
-                qnet[tt] = np.nansum(XF) #jx
-                # and tidal energy flux
-                #zi = zeta[tt,:].squeeze()
-                zi = zeta[tt,:]
-                zi[np.isnan(QV[vn][tt,0,:])] = np.nan # jx, if q = NaN, zi = NaN
-                #ssh[tt] = zi.mean() #jx
-                ssh[tt] = np.nanmean(zi) #jx
-                fnet[tt] = g * rho * ssh[tt] * qnet[tt]
-                
-            # scipy.stats.binned_statistic(x, values, statistic='mean', bins=10, range=None)
-            XF[np.isnan(XF)] = 0 #jx
-            TEF[vn][tt,:] = binned_statistic(sf, XF, statistic='sum', bins=NS, range=(S_low,S_hi)).statistic
-            
-            if Ldir['testing'] and (tt==10) and (vn=='salt'):
-                print(TEF[vn][tt,:])
+    
+    # volume transport
+    qnet = np.nansum(q, axis=(1,2))
+    # and tidal energy flux
+    zeta[np.isnan(q[:,0,:])] = np.nan # jx, if q = NaN, zi = NaN
+    ssh = np.nanmean(zeta, axis=1)
+    fnet = g * rho * ssh * qnet
+
+    # Process into salinity bins. The bin index is found once for every
+    # (time, z, p) cell and then used for all the transport variables.
+    kk = tef_fun.get_bin_index(V['salt'], sedges)
+    for vn in QV.keys():
+        TEF[vn] = tef_fun.bin_sum(kk, QV[vn], NS)
+    if Ldir['testing']:
+        print(TEF['salt'][10,:])
     
     TEF['qnet'] = qnet
     TEF['fnet'] = fnet
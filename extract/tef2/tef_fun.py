@@ -114,6 +114,116 @@ def get_two_layer(in_dir, sect_name):
             
     return tef_df, vn_list, vec_list
 
+def get_sbins(NS=1000, S_low=0, S_hi=36):
+    """
+    Returns the edges and centers of the salinity bins used for TEF.
+    """
+    sedges = np.linspace(S_low, S_hi, NS+1)
+    sbins = sedges[:-1] + np.diff(sedges)/2
+    return sedges, sbins
+
+def get_bin_index(salt, sedges):
+    """
+    Returns an integer array the same shape as salt with the index of the salinity
+    bin each value falls in, or -1 if it is nan or out of range. The bins match
+    those of scipy.stats.binned_statistic(..., bins=NS, range=(S_low,S_hi)), where
+    values on the last edge go in the last bin.
+    """
+    NS = len(sedges) - 1
+    kk = np.digitize(salt, sedges) - 1
+    kk[salt == sedges[-1]] = NS - 1
+    kk[(kk < 0) | (kk >= NS)] = -1
+    return kk
+
+def bin_sum(kk, XF, NS):
+    """
+    Sum the values of XF in salinity bins, separately for each time.
+    
+    Input:
+    kk = bin index from get_bin_index(), shape (NT, ...)
+    XF = values to sum, same shape as kk (nan's are treated as zero)
+    
+    Output: array shaped (NT, NS)
+    
+    This is done for all times at once using np.bincount over composite
+    (time, bin) keys, which is much faster than binning each time separately.
+    """
+    NT = kk.shape[0]
+    key = kk.reshape(NT, -1) + NS*np.arange(NT).reshape(NT, 1)
+    valid = kk.reshape(NT, -1) >= 0
+    XF = XF.reshape(NT, -1)[valid]
+    XF = np.where(np.isnan(XF), 0, XF)
+    return np.bincount(key[valid], weights=XF, minlength=NT*NS).reshape(NT, NS)
+
+def get_Q(TEF_lp):
+    """
+    Returns transport integrated over salinity, e.g. Q(s) = integral(q ds),
+    from the top salinity bin down. Works on arrays of any shape, with salinity
+    bins on the last axis, so you can do all variables and times at once.
+    The output has one more element on the last axis (the salinity edges) and the
+    last one is zero.
+    """
+    sh = TEF_lp.shape
+    Q = np.zeros(sh[:-1] + (sh[-1]+1,))
+    Q[...,:-1] = np.cumsum(TEF_lp[...,::-1], axis=-1)[...,::-1]
+    return Q
+
+def get_bulk_from_Q(thisQ_dict, sedges, vn_list, nlay=30):
+    """
+    Do the multi-layer bulk calculation of Marvin Lorenz for one time.
+    
+    Input:
+    thisQ_dict = dict of transports integrated over salinity (from get_Q()) each
+        shaped (NS+1,), with keys in vn_list (which must include 'q' and 'salt')
+    sedges = salinity bin edges, shaped (NS+1,)
+    
+    Output: dict of arrays shaped (nlay,) for each item in vn_list, sorted by
+    salinity, and padded with nan's.
+    
+    This is the same as the calculation for each day in bulk_calc.py.
+    """
+    import tef_fun_lorenz as tfl
+    in_dict, out_dict, div_sal, ind, minmax = tfl.calc_bulk_values(sedges, thisQ_dict, vn_list)
+    return get_bulk_from_values(in_dict, out_dict, vn_list, nlay=nlay)
+
+def get_bulk_from_values(in_dict, out_dict, vn_list, nlay=30):
+    """
+    Pack the inflowing and outflowing layers from tef_fun_lorenz.calc_bulk_values()
+    into a dict of arrays shaped (nlay,) for each item in vn_list, sorted by
+    salinity, and padded with nan's.
+    """
+    MLO = dict()
+    for vn in vn_list:
+        MLO[vn] = np.nan * np.ones(nlay)
+    bulk_dict = dict()
+    for vn in vn_list:
+        bulk_dict[vn] = np.array(in_dict[vn] + out_dict[vn])
+    ii = np.argsort(bulk_dict['salt'])
+    NL = len(ii)
+    if NL > 0:
+        for vn in vn_list:
+            MLO[vn][:NL] = bulk_dict[vn][ii]
+    return MLO
+
+def get_bulk_one_time(TEF_lp, sedges, vn_list, nlay=30):
+    """
+    Like get_bulk_from_Q() but starting from a dict of tidally averaged
+    transports in salinity bins, each shaped (NS,).
+    """
+    thisQ_dict = dict()
+    for vn in vn_list:
+        thisQ_dict[vn] = get_Q(TEF_lp[vn])
+    return get_bulk_from_Q(thisQ_dict, sedges, vn_list, nlay=nlay)
+
+def do_bulk_worker(item):
+    """
+    For use with a process pool: item = (Q, sedges, vn_list, nlay) where Q is
+    shaped (len(vn_list), NS+1), and returns the output of get_bulk_from_Q().
+    """
+    Q, sedges, vn_list, nlay = item
+    thisQ_dict = {vn: Q[vv,:] for vv, vn in enumerate(vn_list)}
+    return get_bulk_from_Q(thisQ_dict, sedges, vn_list, nlay=nlay)
+
 # colors to associate with each channel (the keys in channel_ and seg_dict)
 clist = ['blue', 'red', 'olive', 'orange']
 
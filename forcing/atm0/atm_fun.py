@@ -6,6 +6,10 @@ import numpy as np
 import netCDF4 as nc
 import seawater as sw
 import matplotlib.path as mpath
+from scipy import sparse
+from scipy.spatial import Delaunay
+
+from lo_tools import index_functions as ifun
 
 invar_list = ['Q2', 'T2', 'PSFC', 'U10', 'V10','RAINCV', 'RAINNCV', 'SWDOWN', 'GLW']
 
@@ -154,6 +158,111 @@ def interp_to_roms(ov_dict, outvar_list, IMn, NR, NC):
         ovi_dict[ovn] = v[IMn].reshape((NR,NC))
     return ovi_dict
 
+def get_bilinear_weights(lon_src, lat_src, lon, lat):
+    """
+    Find the weights to do bilinear interpolation from a curvilinear (WRF) grid
+    lon_src, lat_src to the points lon, lat (e.g. the ROMS rho grid).
+
+    We use a Delaunay triangulation of the source points to find the fractional
+    (j, i) index position of each target point, and then do bilinear interpolation
+    in index space, which is the usual bilinear interpolation on a curvilinear grid.
+    Points outside the source grid use the nearest source point.
+
+    Returns ind, wt: (number of target points, 4) arrays of flat indices into the
+    source grid and the weights to use with them.
+    """
+    NRs, NCs = lon_src.shape
+    xy_src = np.array((lon_src.flatten(), lat_src.flatten())).T
+    xy = np.array((lon.flatten(), lat.flatten())).T
+    NP = xy.shape[0]
+    ind = np.zeros((NP, 4), dtype=int)
+    wt = np.zeros((NP, 4))
+    # fractional index position of points inside the source grid
+    tri = Delaunay(xy_src)
+    simp = tri.find_simplex(xy)
+    inside = simp >= 0
+    T = tri.transform[simp[inside]]
+    b = np.einsum('nij,nj->ni', T[:,:2,:], xy[inside,:] - T[:,2,:])
+    bary = np.concatenate((b, 1 - b.sum(axis=1, keepdims=True)), axis=1)
+    verts = tri.simplices[simp[inside]]
+    jj_src, ii_src = np.divmod(np.arange(NRs*NCs), NCs)
+    fj = (bary * jj_src[verts]).sum(axis=1)
+    fi = (bary * ii_src[verts]).sum(axis=1)
+    j0 = np.clip(np.floor(fj).astype(int), 0, NRs-2)
+    i0 = np.clip(np.floor(fi).astype(int), 0, NCs-2)
+    dj = fj - j0
+    di = fi - i0
+    ind[inside,:] = np.stack((j0*NCs + i0, j0*NCs + i0 + 1,
+        (j0+1)*NCs + i0, (j0+1)*NCs + i0 + 1), axis=1)
+    wt[inside,:] = np.stack(((1-dj)*(1-di), (1-dj)*di, dj*(1-di), dj*di), axis=1)
+    # nearest neighbor for the rest
+    if (~inside).any():
+        ind[~inside,:] = ifun.get_nearest(xy_src, xy[~inside,:], 'atm_outside')[:,None]
+        wt[~inside,0] = 1
+    return ind, wt
+
+def get_bilinear_matrix(lon_src, lat_src, lon, lat, name):
+    """
+    Returns a sparse matrix that does bilinear interpolation from the source grid
+    to the target points, when it multiplies a source field flattened to a column.
+    The weights are cached in LO_output/index_cache (see lo_tools/index_functions.py)
+    keyed on the grids, so they are only calculated once for each WRF-domain and
+    ROMS grid pair.
+    """
+    lon_src, lat_src, lon, lat = [np.ma.getdata(a) for a in (lon_src, lat_src, lon, lat)]
+    key = name + '_bilinear_' + ifun.get_hash(lon_src, lat_src, lon, lat)
+    A_dict = ifun.load_arrays(key)
+    if A_dict is None:
+        ind, wt = get_bilinear_weights(lon_src, lat_src, lon, lat)
+        ifun.save_arrays(key, {'ind':ind, 'wt':wt})
+    else:
+        ind = A_dict['ind']
+        wt = A_dict['wt']
+    NP = ind.shape[0]
+    rows = np.repeat(np.arange(NP), 4)
+    return sparse.csr_matrix((np.array(wt).flatten(), (rows, np.array(ind).flatten())),
+        shape=(NP, lon_src.size))
+
+def get_merged_matrix(A_list, M_list):
+    """
+    Combine the interpolation matrices for the nested WRF domains into one,
+    which multiplies the fields of all the domains stacked into a single column.
+
+    A_list = matrices from get_bilinear_matrix(), coarsest domain first
+    M_list = matching Boolean arrays on the ROMS grid of where each domain should be
+        used (None for the coarsest, which is used everywhere else)
+
+    Each ROMS point uses the finest domain whose mask includes it, which is the
+    same as filling with d2 and then overwriting with d3 and d4 where we have them.
+    """
+    NP = A_list[0].shape[0]
+    taken = np.zeros(NP, dtype=bool)
+    B_list = []
+    for A, M in zip(A_list[::-1], M_list[::-1]):
+        if M is None:
+            use = ~taken
+        else:
+            use = M.flatten() & ~taken
+        B_list.append(sparse.diags(use.astype(float)) @ A)
+        taken = taken | use
+    return sparse.hstack(B_list[::-1]).tocsr()
+
+def regrid_to_roms(ov_dict_list, outvar_list, A, NR, NC):
+    """
+    Interpolate all the variables in outvar_list from the WRF domains to the ROMS grid
+    with a single sparse matrix product.
+
+    ov_dict_list = list of dicts from gather_and_process_fields(), one per domain,
+        in the same order as the matrices used to make A with get_merged_matrix()
+    """
+    F = np.array([np.concatenate([np.array(ov_dict[ovn]).flatten() for ov_dict in ov_dict_list])
+        for ovn in outvar_list]).T
+    FF = A @ F
+    ovc_dict = dict()
+    for ii, ovn in enumerate(outvar_list):
+        ovc_dict[ovn] = FF[:,ii].reshape((NR,NC))
+    return ovc_dict
+
 def Z_wmo_RH(P,T,Q):
     # 5/21/2011 Nick Lederer, modified by Parker MacCready, and recoded
     # from matlab to python by PM 2019.05.16.  Tested against the matlab version
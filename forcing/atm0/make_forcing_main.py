@@ -33,7 +33,6 @@ import netCDF4 as nc
 import numpy as np
 import seawater as sw
 from scipy.interpolate import griddata
-from scipy.spatial import cKDTree
 
 from lo_tools import Lfun, zfun, zrfun
 
@@ -179,21 +178,13 @@ if planB == False:
         lon4 = lon4[:,:imax4]
         lat4 = lat4[:, :imax4]
 
-    # Prepare coordinate arrays for interpolation
-    XY = np.array((lon.flatten(), lat.flatten())).T # shape is (NR*NC, 2)
-    XY2 = np.array((lon2.flatten(), lat2.flatten())).T
+    # get sparse bilinear interpolation matrices to use with wrf grids to interpolate
+    # values from the wrf grids onto the ROMS grid (the weights are cached after the first day)
+    A2 = afun.get_bilinear_matrix(lon2, lat2, lon, lat, 'atm_d2')
     if do_d3:
-        XY3 = np.array((lon3.flatten(), lat3.flatten())).T
+        A3 = afun.get_bilinear_matrix(lon3, lat3, lon, lat, 'atm_d3')
     if do_d4:
-        XY4 = np.array((lon4.flatten(), lat4.flatten())).T
-
-    # get nearest neighbor trees to use with wrf grids to interpolate
-    # values from the wrf grids onto the ROMS grid
-    IM2 = cKDTree(XY2).query(XY); IM2 = IM2[1]
-    if do_d3:
-        IM3 = cKDTree(XY3).query(XY); IM3 = IM3[1]
-    if do_d4:
-        IM4 = cKDTree(XY4).query(XY); IM4 = IM4[1]
+        A4 = afun.get_bilinear_matrix(lon4, lat4, lon, lat, 'atm_d4')
     
     # Find coordinate rotation matrices to translate wrf velocity from
     # wrf grid directions to ROMS standard E+, N+
@@ -214,6 +205,10 @@ if planB == False:
         plat4_poly = np.concatenate((lat4[0,4:],lat4[:-5,-1],lat4[-5,4::-1],lat4[:-5:-1,4]))
         M4 = afun.get_indices_in_polygon(plon4_poly, plat4_poly, lon, lat)
     
+    # Matrices that interpolate and combine the grids in one step, made as needed
+    # for each combination of available d3 and d4 files, keyed by (do_this_d3, do_this_d4).
+    A_dict = dict()
+    
     # MAIN TASK: loop over all hours
 
     if Ldir['testing']:
@@ -252,12 +247,12 @@ if planB == False:
             planB = True
             break
             
-        ovi2_dict = afun.interp_to_roms(ov2_dict, outvar_list, IM2, NR, NC)
+        ov_dict_list = [ov2_dict]
     
         if do_this_d3:
             try:
                 ov3_dict = afun.gather_and_process_fields(fn3, imax3, ca3, sa3, outvar_list)
-                ovi3_dict = afun.interp_to_roms(ov3_dict, outvar_list, IM3, NR, NC)
+                ov_dict_list.append(ov3_dict)
             except:
                 print(' - could not process ' + str(fn3))
                 do_this_d3 = False
@@ -265,25 +260,27 @@ if planB == False:
         if do_this_d4:
             try:
                 ov4_dict = afun.gather_and_process_fields(fn4, imax4, ca4, sa4, outvar_list)
-                ovi4_dict = afun.interp_to_roms(ov4_dict, outvar_list, IM4, NR, NC)
+                ov_dict_list.append(ov4_dict)
             except:
                 print(' - could not process ' + str(fn4))
                 do_this_d4 = False
     
-        # combine the grids
-        ovc_dict = dict()
-        for ovn in outvar_list:
-            v2 = ovi2_dict[ovn]
-            v = v2.copy()
+        # interpolate and combine the grids, for all variables at once
+        if (do_this_d3, do_this_d4) not in A_dict.keys():
+            A_list = [A2]
+            M_list = [None]
             if do_this_d3:
-                v3 = ovi3_dict[ovn]
-                v[M3] = v3[M3]
+                A_list.append(A3)
+                M_list.append(M3)
             if do_this_d4:
-                v4 = ovi4_dict[ovn]
-                v[M4] = v4[M4]
-            if np.sum(np.isnan(v)) > 0:
+                A_list.append(A4)
+                M_list.append(M4)
+            A_dict[(do_this_d3, do_this_d4)] = afun.get_merged_matrix(A_list, M_list)
+        ovc_dict = afun.regrid_to_roms(ov_dict_list, outvar_list,
+            A_dict[(do_this_d3, do_this_d4)], NR, NC)
+        for ovn in outvar_list:
+            if np.sum(np.isnan(ovc_dict[ovn])) > 0:
                 print('** WARNING Nans in combined output ' + ovn)
-            ovc_dict[ovn] = v
     
         # save to NetCDF
         tt = d2i_dict[fn2]
@@ -8,6 +8,7 @@ from datetime import datetime, timedelta
 import numpy as np
 import time
 import pickle
+import multiprocessing as mp
 from scipy.spatial import cKDTree
 import seawater
 import subprocess
@@ -16,9 +17,13 @@ import requests
 import Ofun_CTD
 from lo_tools import Lfun, zfun, zrfun
 from lo_tools import hycom_functions as hfun
+from lo_tools import index_functions as ifun
 
 verbose = False
 
+# state for each worker process, set by the pool initializers
+W = dict()
+
 def get_data_ncks(h_out_dir, dt0, dt1, testing_ncks):
     """
     Plan A for forecast case: get hycom fields in one pile using ncks, and them split it up
@@ -454,6 +459,9 @@ def extrap_nearest_to_masked(X, Y, fld, fld0=0):
         * If it is all unmasked then return the data.    
     If input is not a masked array:        
         * Return the array.    
+    The nearest neighbor indices are cached (see lo_tools/index_functions.py),
+    keyed on the good and missing points, so for a given HYCOM grid and land mask
+    the tree is only ever made once.
     """
     # first make sure nans are masked
     if np.ma.is_masked(fld) == False:
@@ -468,101 +476,158 @@ def extrap_nearest_to_masked(X, Y, fld, fld0=0):
     else:
         # do the extrapolation using nearest neighbor
         fldf = fld.copy() # initialize the "filled" field
-        xyorig = np.array((X[~fld.mask],Y[~fld.mask])).T
-        xynew = np.array((X[fld.mask],Y[fld.mask])).T
-        a = cKDTree(xyorig).query(xynew)
-        aa = a[1]
-        fldf[fld.mask] = fld[~fld.mask][aa]
+        mask = np.ma.getmaskarray(fld)
+        xyorig = np.array((X[~mask],Y[~mask])).T
+        xynew = np.array((X[mask],Y[mask])).T
+        aa = ifun.get_nearest(xyorig, xynew, 'hycom_fill')
+        fldf[mask] = fld[~mask][aa]
         fldd = fldf.data
         checknan(fldd)
         return fldd
 
+def extrap_nearest_to_masked_batch(X, Y, fld, fld0):
+    """
+    A batched version of extrap_nearest_to_masked().
+    INPUT: fld is a 3D array (number of fields, M, L) with nans at missing points,
+    and fld0 is a vector of the values to use for each field if it is all missing.
+    OUTPUT: an array of the same size with no missing values.
+    The fields must all have the same missing points, as is the case for all
+    variables and times on a given HYCOM level, so we find the nearest neighbor
+    map once and do the filling for all fields as a single gather.
+    """
+    mask = np.isnan(fld[0,:,:])
+    fldd = fld.copy()
+    if mask.all():
+        fldd[:] = np.array(fld0).reshape((-1,1,1))
+    elif mask.any():
+        xyorig = np.array((X[~mask],Y[~mask])).T
+        xynew = np.array((X[mask],Y[mask])).T
+        aa = ifun.get_nearest(xyorig, xynew, 'hycom_fill')
+        fldd[:,mask] = fld[:,~mask][:,aa]
+    checknan(fldd)
+    return fldd
+
 def get_extrapolated(in_fn, L, M, N, X, Y, lon, lat, z, Ldir, add_CTD=False):
+    """
+    Do get_extrapolated_list() for a single file.
+    """
+    return get_extrapolated_list([in_fn], L, M, N, X, Y, lon, lat, z, Ldir, add_CTD=add_CTD)[0]
+
+def get_extrapolated_list(in_fn_list, L, M, N, X, Y, lon, lat, z, Ldir, add_CTD=False):
     """
     Make use of extrap_nearest_to_masked() to fill fields completely
     before interpolating to the ROMS grid.  It also adds CTD data if asked to,
     creates ubar and vbar, and converts the temperature to potential temperature.
+
+    This works on a list of files (the times) and returns a list of dicts.
+    The land mask on a HYCOM level is the same for t3d and s3d at all times, so
+    these are filled one level at a time, for all variables and times together,
+    using extrap_nearest_to_masked_batch().
     """
-    b = pickle.load(open(in_fn, 'rb'))
-    vn_list = list(b.keys())    
+    b_list = [pickle.load(open(in_fn, 'rb')) for in_fn in in_fn_list]
+    NF = len(b_list)
     # check that things are the expected shape
     def check_coords(shape_tuple, arr_shape):
         if arr_shape != shape_tuple:
             print('WARNING: array shape mismatch')
-    for vn in vn_list:
-        if vn == 'dt':
-            pass
-        elif vn == 'ssh':
-            check_coords((M, L), b[vn].shape)
-        else:
-            check_coords((N, M, L), b[vn].shape)    
-    # creat output array and add dt to it.
-    vn_list.remove('dt')
-    V = dict()
-    for vn in vn_list:
-        V[vn] = np.nan + np.ones(b[vn].shape)
-    V['dt'] = b['dt']    
-    # extrapolate ssh
-    vn = 'ssh'
-    v = b[vn]
-    vv = extrap_nearest_to_masked(X, Y, v)
-    V[vn] = vv
-    vn_list.remove('ssh')    
-    # extrapolate 3D fields
-    for vn in vn_list:
+    for b in b_list:
+        for vn in b.keys():
+            if vn == 'dt':
+                pass
+            elif vn == 'ssh':
+                check_coords((M, L), b[vn].shape)
+            else:
+                check_coords((N, M, L), b[vn].shape)
+    
+    # extrapolate t3d and s3d
+    ts_list = ['t3d', 's3d']
+    if add_CTD==False:
+        # pack all variables and times as (field, N, M, L), with nans at missing points
+        F = np.nan * np.ones((len(ts_list)*NF, N, M, L))
+        F0 = np.nan * np.ones(len(ts_list)*NF)
+        for ii, (vn, b) in enumerate([(vn, b) for vn in ts_list for b in b_list]):
+            v = b[vn]
+            F[ii,:,:,:] = np.ma.filled(np.ma.masked_invalid(v), np.nan)
+            if vn == 't3d':
+                F0[ii] = np.nanmin(v)
+            elif vn == 's3d':
+                F0[ii] = np.nanmax(v)
+        for k in range(N):
+            fld = F[:,k,:,:]
+            miss = np.isnan(fld)
+            if (miss == miss[0,:,:]).all():
+                F[:,k,:,:] = extrap_nearest_to_masked_batch(X, Y, fld, F0)
+            else:
+                # the missing points differ, so do the fields one at a time
+                for ii in range(fld.shape[0]):
+                    F[ii,k,:,:] = extrap_nearest_to_masked(X, Y, fld[ii,:,:], fld0=F0[ii])
+        
+    V_list = []
+    for ff, b in enumerate(b_list):
+        vn_list = list(b.keys())
+        # creat output array and add dt to it.
+        vn_list.remove('dt')
+        V = dict()
+        for vn in vn_list:
+            V[vn] = np.nan + np.ones(b[vn].shape)
+        V['dt'] = b['dt']
+        # extrapolate ssh
+        vn = 'ssh'
         v = b[vn]
-        if vn == 't3d':
-            v0 = np.nanmin(v)
-        elif vn == 's3d':
-            v0 = np.nanmax(v)
-        if vn in ['t3d', 's3d']:
-            # print(' -- extrapolating ' + vn)
-            if add_CTD==False:
-                for k in range(N):
-                    fld = v[k, :, :]
-                    fldf = extrap_nearest_to_masked(X, Y, fld, fld0=v0)
-                    V[vn][k, :, :] = fldf
-            elif add_CTD==True:
-                print(vn + ' Adding CTD data before extrapolating')
-                Cast_dict, sta_df = Ofun_CTD.get_casts(Ldir)
-                for k in range(N):
-                    fld = v[k, :, :]
-                    zz = z[k]
-                    xyorig, fldorig = Ofun_CTD.get_orig(Cast_dict, sta_df,
-                        X, Y, fld, lon, lat, zz, vn)
-                    fldf = Ofun_CTD.extrap_nearest_to_masked_CTD(X,Y,fld,
-                        xyorig=xyorig,fldorig=fldorig,fld0=v0)
-                    V[vn][k, :, :] = fldf
-        elif vn in ['u3d', 'v3d']:
-            # print(' -- extrapolating ' + vn)
+        vv = extrap_nearest_to_masked(X, Y, v)
+        V[vn] = vv
+        vn_list.remove('ssh')
+        # extrapolate 3D fields
+        for vn in vn_list:
+            v = b[vn]
+            if vn == 't3d':
+                v0 = np.nanmin(v)
+            elif vn == 's3d':
+                v0 = np.nanmax(v)
+            if vn in ts_list:
+                if add_CTD==False:
+                    V[vn] = F[ts_list.index(vn)*NF + ff,:,:,:]
+                elif add_CTD==True:
+                    print(vn + ' Adding CTD data before extrapolating')
+                    Cast_dict, sta_df = Ofun_CTD.get_casts(Ldir)
+                    for k in range(N):
+                        fld = v[k, :, :]
+                        zz = z[k]
+                        xyorig, fldorig = Ofun_CTD.get_orig(Cast_dict, sta_df,
+                            X, Y, fld, lon, lat, zz, vn)
+                        fldf = Ofun_CTD.extrap_nearest_to_masked_CTD(X,Y,fld,
+                            xyorig=xyorig,fldorig=fldorig,fld0=v0)
+                        V[vn][k, :, :] = fldf
+            elif vn in ['u3d', 'v3d']:
+                vv = v.copy()
+                vv = np.ma.masked_where(np.isnan(vv), vv)
+                vv[vv.mask] = 0
+                V[vn] = vv.data
+        # Create ubar and vbar.
+        # Note: this is slightly imperfect because the z levels are at the same
+        # position as the velocity levels.
+        dz = np.nan * np.ones((N, 1, 1))
+        dz[1:, 0, 0]= np.diff(z)
+        dz[0, 0, 0] = dz[1, 0, 0]
+        
+        # account for the fact that the new hycom fields do not show up masked
+        u3d = np.ma.masked_where(np.isnan(b['u3d']),b['u3d'])
+        v3d = np.ma.masked_where(np.isnan(b['v3d']),b['v3d'])
+        dz3 = dz * np.ones_like(u3d) # make dz a masked array
+        b['ubar'] = np.sum(u3d*dz3, axis=0) / np.sum(dz3, axis=0)
+        b['vbar'] = np.sum(v3d*dz3, axis=0) / np.sum(dz3, axis=0)
+        
+        for vn in ['ubar', 'vbar']:
+            v = b[vn]
             vv = v.copy()
             vv = np.ma.masked_where(np.isnan(vv), vv)
             vv[vv.mask] = 0
-            V[vn] = vv.data
-    # Create ubar and vbar.
-    # Note: this is slightly imperfect because the z levels are at the same
-    # position as the velocity levels.
-    dz = np.nan * np.ones((N, 1, 1))
-    dz[1:, 0, 0]= np.diff(z)
-    dz[0, 0, 0] = dz[1, 0, 0]
-    
-    # account for the fact that the new hycom fields do not show up masked
-    u3d = np.ma.masked_where(np.isnan(b['u3d']),b['u3d'])
-    v3d = np.ma.masked_where(np.isnan(b['v3d']),b['v3d'])
-    dz3 = dz * np.ones_like(u3d) # make dz a masked array
-    b['ubar'] = np.sum(u3d*dz3, axis=0) / np.sum(dz3, axis=0)
-    b['vbar'] = np.sum(v3d*dz3, axis=0) / np.sum(dz3, axis=0)
-    
-    for vn in ['ubar', 'vbar']:
-        v = b[vn]
-        vv = v.copy()
-        vv = np.ma.masked_where(np.isnan(vv), vv)
-        vv[vv.mask] = 0
-        V[vn] = vv.data  
-    # calculate potential temperature
-    press_db = -z.reshape((N,1,1))
-    V['theta'] = seawater.ptmp(V['s3d'], V['t3d'], press_db)    
-    return V
+            V[vn] = vv.data  
+        # calculate potential temperature
+        press_db = -z.reshape((N,1,1))
+        V['theta'] = seawater.ptmp(V['s3d'], V['t3d'], press_db)
+        V_list.append(V)
+    return V_list
 
 def get_xyr(G, vn):
     """
@@ -612,20 +677,23 @@ def get_zinds(h, S, z):
     This just finds the vertical index in HYCOM z for each ROMS z_rho
     value in the whole 3D array, with the index being the UPPER one of
     the two HYCOM z indices that any ROMS z falls between.
+
+    The result is cached, keyed on the ROMS and HYCOM vertical grids.
     """
     tt0 = time.time()
-    zr = zrfun.get_z(h, 0*h, S, only_rho=True)
-    zrf = zr.flatten()
-    zinds = np.nan * np.ones_like(zrf)
     if isinstance(z, np.ma.MaskedArray):
         z = z.data
-    for ii in range(len(z)-1):
-        zlo = z[ii]; zhi = z[ii+1]
-        mask = (zrf>zlo) & (zrf<=zhi)
-        zinds[mask] = ii+1 # this is where the UPPER index is enforced
+    key = 'hycom_zinds_' + ifun.get_hash(h, S['Cs_r'], S['s_rho'], S['hc'], z)
+    A_dict = ifun.load_arrays(key)
+    if A_dict is not None:
+        return A_dict['zinds']
+    zr = zrfun.get_z(h, 0*h, S, only_rho=True)
+    zrf = zr.flatten()
+    # HYCOM z is increasing (deep to shallow), so searchsorted with side='left'
+    # gives the UPPER index ii+1 for z[ii] < zr <= z[ii+1]
+    zinds = np.searchsorted(z, zrf, side='left')
     zinds = zinds.astype(int)
-    if isinstance(zinds, np.ma.MaskedArray):
-        zinds = zinds.data
+    ifun.save_arrays(key, {'zinds': zinds})
     if verbose:
         print(' --create zinds array took %0.1f seconds' % (time.time() - tt0))
     return zinds
@@ -638,6 +706,9 @@ def get_interpolated(G, S, b, lon, lat, z, N, zinds):
     We use fast nearest neighbor interpolation as much as possible.
     Also we interpolate everything to the ROMS rho grid, and then crudely
     interpolate to the u and v grids at the last moment.  Much simpler.
+
+    The horizontal nearest neighbor indices are cached, keyed on the HYCOM
+    and ROMS grids (see lo_tools/index_functions.py).
     """
     
     # start input dict
@@ -652,7 +723,7 @@ def get_interpolated(G, S, b, lon, lat, z, N, zinds):
     XYin = np.array((Lon.flatten(), Lat.flatten())).T
     XYr = np.array((G['lon_rho'].flatten(), G['lat_rho'].flatten())).T
     h = G['h']
-    IMr = cKDTree(XYin).query(XYr)[1]
+    IMr = ifun.get_nearest(XYin, XYr, 'hycom_rho')
     
     # 2D fields
     for vn in ['ssh', 'ubar', 'vbar']:
@@ -681,9 +752,9 @@ def get_interpolated(G, S, b, lon, lat, z, N, zinds):
         vi_dict[vn] = FF
     
     # do the vertical interpolation from HYCOM to ROMS z positions
+    hinds = np.indices((S['N'], G['M'], G['L']))
     for vn in ['theta', 's3d', 'u3d', 'v3d']:
         vi = vi_dict[vn]
-        hinds = np.indices((S['N'], G['M'], G['L']))
         vvf = vi[zinds, hinds[1].flatten(), hinds[2].flatten()]
         vv = vvf.reshape((S['N'], G['M'], G['L']))
         vvc = vv.copy()
@@ -696,3 +767,63 @@ def get_interpolated(G, S, b, lon, lat, z, N, zinds):
     return c
 
 
+
+# Functions for doing the days in parallel, used by make_forcing_main.py.
+# The pools use the "fork" start method so that the worker functions can be used
+# from make_forcing_main.py, which does all its work at the top level. The grid
+# is shared with the workers by forking, and the interpolation indices are
+# memory-mapped from the index cache.
+
+def get_pool(Nproc, initializer=None, initargs=()):
+    return mp.get_context('fork').Pool(Nproc, initializer=initializer, initargs=initargs)
+
+def do_convert_worker(item):
+    """
+    Convert one hycom NetCDF file and save it as a pickled dict.
+    item = (in_fn, out_dir, out_name), and if out_name is None
+    it is made from the time of the data.
+    """
+    in_fn, out_dir, out_name = item
+    a = convert_extraction_oneday(in_fn)
+    if out_name is None:
+        out_name = 'h' + datetime.strftime(a['dt'], Lfun.ds_fmt) + '.p'
+    pickle.dump(a, open(out_dir / out_name, 'wb'))
+    return out_name
+
+def init_extrap_worker(h_out_dir, L, M, N, X, Y, lon, lat, z, Ldir, add_CTD):
+    W['extrap'] = (h_out_dir, L, M, N, X, Y, lon, lat, z, Ldir, add_CTD)
+
+def do_extrap_worker(fh_list):
+    """
+    Extrapolate a list of fh files, saving the results as xfh files.
+    """
+    h_out_dir, L, M, N, X, Y, lon, lat, z, Ldir, add_CTD = W['extrap']
+    in_fn_list = [h_out_dir / fn for fn in fh_list]
+    V_list = get_extrapolated_list(in_fn_list, L, M, N, X, Y, lon, lat, z, Ldir,
+        add_CTD=add_CTD)
+    for fn, V in zip(fh_list, V_list):
+        pickle.dump(V, open(h_out_dir / ('x' + fn), 'wb'))
+    return fh_list
+
+def init_interp_worker(h_out_dir, G, S, lon, lat, z, N, zinds):
+    W['interp'] = (h_out_dir, G, S, lon, lat, z, N, zinds)
+
+def do_interp_worker(fn):
+    """
+    Interpolate an xfh file to the ROMS grid, saving the fields as .npy files.
+    Returns the time and a dict of the fields, memory-mapped from those files,
+    so that the calling process can write them out without holding all days
+    in memory.
+    """
+    h_out_dir, G, S, lon, lat, z, N, zinds = W['interp']
+    b = pickle.load(open(h_out_dir / fn, 'rb'))
+    c = get_interpolated(G, S, b, lon, lat, z, N, zinds)
+    c_fn_dict = dict()
+    for vn in c.keys():
+        c_fn = h_out_dir / ('c' + fn.replace('.p', '') + '_' + vn + '.npy')
+        np.save(c_fn, c[vn])
+        c_fn_dict[vn] = c_fn
+    return b['dt'], c_fn_dict
+
+def load_interpolated(c_fn_dict):
+    return {vn: np.load(c_fn_dict[vn], mmap_mode='r') for vn in c_fn_dict.keys()}
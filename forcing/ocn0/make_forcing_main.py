@@ -12,6 +12,10 @@ run make_forcing_main.py -g cas6 -t v3 -r backfill -s continuation -d 2016.12.15
 Forecast version:
 run make_forcing_main.py -g cas6 -t v3 -r forecast -s continuation -f ocn0 -d [TODAY]
 
+The steps that are done for each HYCOM day separately (converting the NetCDF files,
+extrapolating, and interpolating to the ROMS grid) are spread over Nproc processes.
+Set Nproc = 1 below to do them one at a time.
+
 NOTE: I haven't yet made much use of the Ldir['testing'] flag, and instead there are some ad hoc
 flags like verbose, testing_ncks, an testing_fmrc.
 
@@ -55,6 +59,8 @@ planC = False
 add_CTD = False
 do_bio = True
 verbose = False
+# number of processes for the steps that are done for each day separately
+Nproc = 8
 
 if Ldir['testing']:
     verbose = True
@@ -138,20 +144,17 @@ if planC == False:
         hnc_short_list = Ofun.get_hnc_short_list(this_dt, Ldir)
         # step through those days and convert them to the same format
         # of pickled dicts as used by the forecast
-        for fn in hnc_short_list:
-            a = Ofun.convert_extraction_oneday(fn)
-            dts = datetime.strftime(a['dt'], Lfun.ds_fmt)
-            out_fn = h_out_dir / ('h' + dts + '.p')
-            pickle.dump(a, open(out_fn, 'wb'))
+        item_list = [(fn, h_out_dir, None) for fn in hnc_short_list]
             
     elif Ldir['run_type'] == 'forecast':
         hnc_list = sorted([item.name for item in h_out_dir.iterdir()
                 if item.name[0]=='h' and item.name[-3:]=='.nc'])
-        for item in hnc_list:
-            a = Ofun.convert_extraction_oneday(h_out_dir / item)
-            out_fn = h_out_dir / item.replace('.nc','.p')
-            pickle.dump(a, open(out_fn, 'wb'))
-            sys.stdout.flush()
+        item_list = [(h_out_dir / item, h_out_dir, item.replace('.nc','.p')) for item in hnc_list]
+    
+    # the days are independent, so we do them in parallel
+    with Ofun.get_pool(Nproc) as pool:
+        pool.map(Ofun.do_convert_worker, item_list)
+    sys.stdout.flush()
             
     hp_list = sorted([item.name for item in h_out_dir.iterdir()
             if (item.name[0]=='h' and item.name[-2:]=='.p')])
@@ -170,12 +173,14 @@ if planC == False:
     lon, lat, z, L, M, N, X, Y = Ofun.get_coords(h_out_dir)
     fh_list = sorted([item.name for item in h_out_dir.iterdir()
             if item.name[:2]=='fh'])
-    for fn in fh_list:
-        print('-Extrapolating ' + fn)
-        in_fn = h_out_dir / fn
-        V = Ofun.get_extrapolated(in_fn, L, M, N, X, Y, lon, lat, z, Ldir,
-            add_CTD=add_CTD)
-        pickle.dump(V, open(h_out_dir / ('x' + fn), 'wb'))
+    # split the days into groups, one for each process, and each group is
+    # extrapolated together (see Ofun.get_extrapolated_list())
+    fh_group_list = [list(item) for item in np.array_split(fh_list, min(Nproc, len(fh_list)))]
+    with Ofun.get_pool(Nproc, initializer=Ofun.init_extrap_worker,
+            initargs=(h_out_dir, L, M, N, X, Y, lon, lat, z, Ldir, add_CTD)) as pool:
+        for fh_group in pool.imap(Ofun.do_extrap_worker, fh_group_list):
+            print('-Extrapolated ' + ', '.join(fh_group))
+            sys.stdout.flush()
 
     # and interpolate to ROMS format
     # get grid and S info
@@ -193,13 +198,16 @@ if planC == False:
     count = 0
     c_dict = dict()
     zinds = Ofun.get_zinds(G['h'], S, z)
-    for fn in xfh_list:
-        print('-Interpolating ' + fn + ' to ROMS grid')
-        b = pickle.load(open(h_out_dir / fn, 'rb'))
-        dt_list.append(b['dt'])
-        c = Ofun.get_interpolated(G, S, b, lon, lat, z, N, zinds)
-        c_dict[count] = c
-        count += 1
+    # the results are put back in order by imap(), and each c is memory-mapped
+    # from files written by the workers
+    with Ofun.get_pool(Nproc, initializer=Ofun.init_interp_worker,
+            initargs=(h_out_dir, G, S, lon, lat, z, N, zinds)) as pool:
+        for fn, (dt, c_fn_dict) in zip(xfh_list, pool.imap(Ofun.do_interp_worker, xfh_list)):
+            print('-Interpolated ' + fn + ' to ROMS grid')
+            sys.stdout.flush()
+            dt_list.append(dt)
+            c_dict[count] = Ofun.load_interpolated(c_fn_dict)
+            count += 1
     # Write to ROMS forcing files
     Ofun_nc.make_clm_file(Ldir, out_dir, h_out_dir, c_dict, dt_list, S, G)
     
@@ -0,0 +1,300 @@
+"""
+Functions for ocnN, used by make_forcing_main.py.
+
+The maps from the parent grid (the one in the history files we interpolate from)
+to the nest grid are found once for each combination of parent grid, nest grid,
+and pad, and cached in LO_output/index_cache (see lo_tools/index_functions.py).
+A map is just a pair of flat index arrays, so that for any field:
+
+nest_field.flat[dst] = parent_field_trimmed.flat[src]
+
+which is the nearest neighbor interpolation that ocnN has always used. Applying it
+to all the vertical levels of a 3-D variable is a single gather.
+
+If the nest has different s-coordinates than the parent (e.g. more vertical levels)
+the 3-D fields are also remapped in the vertical, using indices and weights for
+every nest column found once by get_vertical_maps(), and ubar and vbar are then
+recalculated from the remapped u and v so that they are consistent.
+
+A pool of worker processes then does the history files, each one writing its
+results straight into memory-mapped arrays that hold all the times for each
+variable, which the calling code then writes to ocean_clm.nc.
+
+NOTE: the pool uses the "fork" start method so that the worker functions can
+be used from scripts that do all their work at the top level, like the rest
+of LO.
+"""
+
+import sys
+import multiprocessing as mp
+import numpy as np
+import xarray as xr
+import pandas as pd
+
+from lo_tools import zfun, zrfun
+from lo_tools import index_functions as ifun
+
+# state for each worker process, set by the pool initializer
+W = dict()
+
+tag_list = ['rho', 'u', 'v']
+
+def get_vn_dict(do_bio):
+    # associate variables to process with grids
+    vn_dict = {'salt':('rho',3), 'temp':('rho',3), 'zeta':('rho',2),
+            'u':('u',3), 'v':('v',3), 'ubar':('u',2), 'vbar':('v',2)}
+    if do_bio:
+        # Note: designed to work with updated ROMS 2023.05.14
+        bvn_list = ['NO3', 'NH4', 'chlorophyll', 'phytoplankton', 'zooplankton',
+                'LdetritusN', 'SdetritusN', 'LdetritusC', 'SdetritusC',
+                'TIC', 'alkalinity', 'oxygen']
+        for bvn in bvn_list:
+            vn_dict[bvn] = ('rho',3)
+    return vn_dict
+
+def get_pad(start_type):
+    """
+    The number of grid points around the edge of the nest to fill. Zero means
+    fill everything, which we need for an initial condition.
+    """
+    if start_type in ['continuation','perfect']:
+        pad = 20
+    elif start_type == 'new':
+        pad = 0
+    else:
+        print('Error: Unrecognized start_type')
+        sys.exit()
+    return pad
+
+def get_bounds(x_big, y_big, x_small, y_small, pad=3):
+    """
+    This function takes two pairs of plaid, 2-D, lon, lat arrays:
+    - one pair bigger (that we hope to nest inside) and
+    - one pair smaller (the grid of the nest)
+    and returns the indices to use for making a trimmed version of
+    the bigger grid that the smaller grid still fits inside.
+    We add "pad" around the edges to make sure things fit comfortably.
+    """
+    # First: error checking
+    if (x_small[0,0] < x_big[0,pad]) or (x_small[0,-1] > x_big[0,-pad]):
+        print('ERROR: lon out of bounds ')
+        sys.exit()
+    if (y_small[0,0] < y_big[pad,0]) or (y_small[-1,0] > y_big[-pad,0]):
+        print('ERROR: lat out of bounds ')
+        sys.exit()
+    # Second: get indices
+    ix0 = zfun.find_nearest_ind(x_big[0,:], x_small[0,0]) - pad
+    ix1 = zfun.find_nearest_ind(x_big[0,:], x_small[0,-1]) + pad
+    iy0 = zfun.find_nearest_ind(y_big[:,0], y_small[0,0]) - pad
+    iy1 = zfun.find_nearest_ind(y_big[:,0], y_small[-1,0]) + pad
+    return ix0, ix1, iy0, iy1
+
+def get_nest_maps(grid_fn, his_fn, pad):
+    """
+    Returns a dict with, for each tag in tag_list:
+    'bounds_[tag]' = (ix0, ix1, iy0, iy1) to trim the parent grid
+    'src_[tag]' = flat indices into the trimmed parent grid
+    'dst_[tag]' = flat indices into the nest grid
+    'shape_[tag]' = shape of the nest grid
+    These are cached, keyed on the parent grid, the nest grid, and pad.
+    """
+    key = 'ocnN_maps_' + ifun.get_hash(ifun.get_grid_hash(his_fn),
+        ifun.get_grid_hash(grid_fn), pad)
+    maps = ifun.load_arrays(key)
+    if maps is not None:
+        return {k: np.array(maps[k]) for k in maps.keys()}
+    maps = dict()
+    dsg = xr.open_dataset(grid_fn)
+    ds = xr.open_dataset(his_fn)
+    for tag in tag_list:
+        # the nest grid
+        xx = dsg['lon_' + tag].values
+        yy = dsg['lat_' + tag].values
+        mm = dsg['mask_' + tag].values.copy()
+        if pad > 0:
+            # mask out the inside of the nest fields, since we only use
+            # the edges (unless Ldir['start_type']=='new')
+            mm[pad:-pad, pad:-pad] = 0 # this speeds things up
+        # the parent grid, trimmed before the nearest neighbor search
+        x = ds['lon_' + tag].values
+        y = ds['lat_' + tag].values
+        m = ds['mask_' + tag].values # 1=water
+        ix0, ix1, iy0, iy1 = get_bounds(x, y, xx, yy)
+        xtrim = x[iy0:iy1, ix0:ix1]
+        ytrim = y[iy0:iy1, ix0:ix1]
+        mtrim = m[iy0:iy1, ix0:ix1]
+        xyorig = np.array((xtrim[mtrim==1],ytrim[mtrim==1])).T
+        xynew = np.array((xx[mm==1],yy[mm==1])).T
+        ind = ifun.get_nearest(xyorig, xynew, 'ocnN_' + tag)
+        maps['bounds_' + tag] = np.array([ix0, ix1, iy0, iy1])
+        maps['src_' + tag] = np.flatnonzero(mtrim==1)[ind]
+        maps['dst_' + tag] = np.flatnonzero(mm==1)
+        maps['shape_' + tag] = np.array(xx.shape)
+    ds.close()
+    dsg.close()
+    ifun.save_arrays(key, maps)
+    return maps
+
+def get_S_nest(grid_dir, S):
+    """
+    Returns the S-coordinate info for the nest, from S_COORDINATE_INFO.csv in
+    grid_dir, or S (that of the parent) if there is no such file.
+    """
+    S_fn = grid_dir / 'S_COORDINATE_INFO.csv'
+    if S_fn.is_file():
+        S_info_dict = pd.read_csv(S_fn, index_col='ITEMS').to_dict()['VALUES']
+        return zrfun.get_S(S_info_dict)
+    else:
+        return S
+
+def same_S(S0, S1):
+    """
+    True if the S-coordinate info dicts S0 and S1 give the same z positions.
+    """
+    if S0['N'] != S1['N']:
+        return False
+    return ((int(S0['Vtransform']) == int(S1['Vtransform']))
+        and np.isclose(float(S0['hc']), float(S1['hc']))
+        and np.allclose(S0['Cs_r'], S1['Cs_r']) and np.allclose(S0['s_rho'], S1['s_rho']))
+
+def get_vertical_maps(grid_fn, his_fn, maps, S0, S1):
+    """
+    For a nest with s-coordinates S1 different from those of the parent, S0.
+    Returns a dict with, for each tag in tag_list, arrays that are
+    (nest N) x (number of filled nest points):
+    'vind_[tag]' = index of the parent level below each nest level
+    'vfr_[tag]' = fractional distance from that parent level to the next one
+    'dzf_[tag]' = nest layer thickness divided by depth, for finding ubar and vbar
+    The z positions come from zrfun.get_z() for both grids with zeta = 0, using the
+    parent depth at the point it is interpolated from. Nest levels above or below
+    the parent column get the top or bottom parent value.
+    """
+    dsg = xr.open_dataset(grid_fn)
+    ds = xr.open_dataset(his_fn)
+    h0 = ds.h.values
+    h1 = dsg.h.values
+    ds.close()
+    dsg.close()
+    N0 = S0['N']
+    N1 = S1['N']
+    vmaps = dict()
+    for tag in tag_list:
+        if tag == 'rho':
+            hh0 = h0
+            hh1 = h1
+        elif tag == 'u':
+            hh0 = (h0[:, 1:] + h0[:, :-1])/2
+            hh1 = (h1[:, 1:] + h1[:, :-1])/2
+        elif tag == 'v':
+            hh0 = (h0[1:, :] + h0[:-1, :])/2
+            hh1 = (h1[1:, :] + h1[:-1, :])/2
+        ix0, ix1, iy0, iy1 = maps['bounds_' + tag]
+        hp = hh0[iy0:iy1, ix0:ix1].reshape(-1)[maps['src_' + tag]]
+        hn = hh1.reshape(-1)[maps['dst_' + tag]]
+        # get_z() squeezes singleton dimensions so we reshape
+        zp = zrfun.get_z(hp, 0*hp, S0, only_rho=True).reshape((N0, -1))
+        zn = zrfun.get_z(hn, 0*hn, S1, only_rho=True).reshape((N1, -1))
+        zn_w = zrfun.get_z(hn, 0*hn, S1, only_w=True).reshape((N1+1, -1))
+        ind = np.zeros(zn.shape, dtype=int)
+        for kk in range(N1):
+            # this is searchsorted on every column at once
+            ind[kk, :] = (zp < zn[kk, :]).sum(axis=0) - 1
+        ind = np.clip(ind, 0, N0-2)
+        z0 = np.take_along_axis(zp, ind, axis=0)
+        z1 = np.take_along_axis(zp, ind+1, axis=0)
+        vmaps['vind_' + tag] = ind
+        vmaps['vfr_' + tag] = np.clip((zn - z0)/(z1 - z0), 0, 1)
+        vmaps['dzf_' + tag] = np.diff(zn_w, axis=0)/hn
+    return vmaps
+
+def remap_vertical(vg, tag, vmaps):
+    """
+    Remap vg, a 3-D field on the parent s-coordinates at the filled nest
+    points, shape = (parent N) x (number of points), to the nest s-coordinates.
+    """
+    ind = vmaps['vind_' + tag]
+    fr = vmaps['vfr_' + tag]
+    N1 = ind.shape[0]
+    # one gather for the levels below and above
+    ff = np.take_along_axis(vg, np.concatenate((ind, ind+1), axis=0), axis=0)
+    return ff[:N1, :]*(1 - fr) + ff[N1:, :]*fr
+
+def get_bar(vv, tag, maps, vmaps):
+    """
+    Returns ubar or vbar as the depth average of vv, the u or v field already
+    on the nest grid, so that it is consistent with the remapped velocity.
+    """
+    dst = maps['dst_' + tag]
+    NR, NC = maps['shape_' + tag]
+    N = vv.shape[0]
+    vb = np.nan * np.ones(NR*NC)
+    vb[dst] = (vv.reshape((N, -1))[:, dst] * vmaps['dzf_' + tag]).sum(axis=0)
+    return vb.reshape((NR, NC))
+
+def get_one_time(ds, vn, tag, dm, maps, hh, vmaps=None):
+    """
+    Interpolate variable vn (on grid tag, with dm = 2 or 3 dimensions, not
+    counting time) from the history file Dataset ds to the nest grid. Points
+    that are not filled are nan. 3-D fields are also remapped in the vertical
+    if vmaps (from get_vertical_maps()) is not None.
+    """
+    ix0, ix1, iy0, iy1 = maps['bounds_' + tag]
+    src = maps['src_' + tag]
+    dst = maps['dst_' + tag]
+    NR, NC = maps['shape_' + tag]
+    vtrim = ds[vn][0, ..., iy0:iy1, ix0:ix1].values
+    if dm == 2:
+        vv = np.nan * np.ones(NR*NC)
+        vv[dst] = vtrim.reshape(-1)[src]
+        vv = vv.reshape((NR, NC))
+        if vn == 'zeta':
+            # NOTE: it would be better to automate this instead of hard-coding!
+            # change sea level to match what was used in pgrid for z_offset.
+            z_offset = -1
+            vv = vv + z_offset
+            # enforce a minimum depth
+            min_depth = 0.3
+            zmask = vv+hh <= min_depth
+            vv[zmask] = -hh[zmask] + min_depth
+    elif dm == 3:
+        N = vtrim.shape[0]
+        vg = vtrim.reshape((N, -1))[:, src]
+        if vmaps is not None:
+            vg = remap_vertical(vg, tag, vmaps)
+            N = vg.shape[0]
+        vv = np.nan * np.ones((N, NR*NC))
+        vv[:, dst] = vg
+        vv = vv.reshape((N, NR, NC))
+    return vv
+
+def get_pool(Nproc, initializer=None, initargs=()):
+    return mp.get_context('fork').Pool(Nproc, initializer=initializer, initargs=initargs)
+
+def init_worker(maps, vmaps, vn_dict, hh, out_fn_dict):
+    W['args'] = (maps, vmaps, vn_dict, hh, out_fn_dict)
+
+def do_worker(item):
+    """
+    Do all the variables for one history file, writing them into time index tt
+    of the memory-mapped arrays in out_fn_dict. Returns tt and ocean_time.
+    """
+    tt, his_fn = item
+    maps, vmaps, vn_dict, hh, out_fn_dict = W['args']
+    ds = xr.open_dataset(his_fn, decode_times=False)
+    uv_dict = dict()
+    for vn in vn_dict.keys():
+        tag, dm = vn_dict[vn]
+        if (vmaps is not None) and (vn in ['ubar', 'vbar']):
+            # NOTE: this relies on u and v coming before ubar and vbar in vn_dict
+            fld = get_bar(uv_dict[vn[0]], tag, maps, vmaps)
+        else:
+            fld = get_one_time(ds, vn, tag, dm, maps, hh, vmaps)
+        if vn in ['u', 'v']:
+            uv_dict[vn] = fld
+        A = np.load(out_fn_dict[vn], mmap_mode='r+')
+        A[tt, ...] = fld
+        A.flush()
+        del A
+    ot = ds.ocean_time.values[0]
+    ds.close()
+    return tt, ot
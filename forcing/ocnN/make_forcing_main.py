@@ -7,7 +7,9 @@ Designed to run only as backfill.
 Testing:
 run make_forcing_main.py -g wgh1 -gtx cas6_traps2_x2b -ro 0 -r backfill -s continuation -d 2017.07.04 -f ocnN -do_bio True -test True
 
-Performance: 6 minutes per day on mac for wgh1 grid with do_bio = True and start_type = new.
+Performance: 6 minutes per day on mac for wgh1 grid with do_bio = True and start_type = new,
+before the interpolation maps were cached and the times were done by a pool
+of workers in Nfun.py (see the notes there).
 """
 
 from pathlib import Path
@@ -25,12 +27,11 @@ result_dict['start_dt'] = datetime.now()
 import xarray as xr
 from time import time
 import numpy as np
-from subprocess import Popen as Po
-from subprocess import PIPE as Pi
-import pickle
 
 from lo_tools import Lfun, zfun, zrfun, Ofun_nc
 
+import Nfun
+
 # this directory is created, along with Info and Data subdirectories, by ffun.intro()
 out_dir = Ldir['LOo'] / 'forcing' / Ldir['gridname'] / ('f' + Ldir['date_string']) / Ldir['frc']
 
@@ -48,41 +49,53 @@ if Ldir['testing']:
     verbose = True
     h_list = h_list[:2]
 
-# +++++++++++ parallel subprocess +++++++++++++++++++++++++++++++++++
+# +++++++++++ parallel interpolation +++++++++++++++++++++++++++++++++
 temp_dir = out_dir / 'Data'
 Lfun.make_dir(temp_dir, clean=True)
 Nproc = 10
 NT = len(h_list)
-proc_list = []
 tt0 = time()
-temp_out_fn_list = []
 print('Working on ' + Ldir['frc'] + ' (' + str(NT) + ' times)')
-for ii in range(NT):
-    grid_fn = str(Ldir['grid'] / 'grid.nc')
-    his_fn = str(h_list[ii])
-    count_str = ('000000' + str(ii))[-6:]
-    temp_out_fn = temp_dir / ('data_dict_' + count_str + '.p')
-    temp_out_fn_list.append(temp_out_fn)
-    this_dir = str(Ldir['LO'] / 'forcing' / Ldir['frc']) + '/'
-    cmd_list = ['python', this_dir + 'get_one_time.py', '-grid_fn', grid_fn,
-         '-his_fn', his_fn, '-start_type', Ldir['start_type'], '-out_fn', str(temp_out_fn),
-         '-do_bio', str(Ldir['do_bio'])]
-    proc = Po(cmd_list, stdout=Pi, stderr=Pi)
-    proc_list.append(proc)
-        
-    if ((np.mod(ii,Nproc) == 0) and (ii > 0)) or (ii == NT-1):
-        for proc in proc_list:
-            stdout, stderr = proc.communicate()
-            # make sure everyone is finished before continuing
-            if verbose and (len(stdout) > 0):
-                print('\n'+stdout.decode())
-            if len(stderr) > 0:
-                print('\n'+stderr.decode())
-        proc_list = []
-    ii += 1
+grid_fn = str(Ldir['grid'] / 'grid.nc')
+dsg = xr.open_dataset(grid_fn)
+hh = dsg.h.values
+dsg.close()
+
+# maps from the original grid to the nest grid (cached after the first time)
+pad = Nfun.get_pad(Ldir['start_type'])
+maps = Nfun.get_nest_maps(grid_fn, h_list[0], pad)
+
+# vertical remapping, if the nest has different s-coordinates than the original grid
+S0 = zrfun.get_basic_info(h_list[0], only_S=True)
+S1 = Nfun.get_S_nest(Ldir['grid'], S0)
+if Nfun.same_S(S0, S1):
+    vmaps = None
+else:
+    vmaps = Nfun.get_vertical_maps(grid_fn, h_list[0], maps, S0, S1)
+    print('- Remapping from N = %d to N = %d' % (S0['N'], S1['N']))
+N = S1['N']
+print('- Get maps: %0.2f sec' % (time()-tt0))
+
+# memory-mapped arrays for all times of each variable, filled in by the workers
+vn_dict = Nfun.get_vn_dict(Ldir['do_bio'])
+out_fn_dict = dict()
+for vn in vn_dict.keys():
+    tag, dm = vn_dict[vn]
+    sh = tuple([int(n) for n in maps['shape_' + tag]])
+    if dm == 3:
+        sh = (N,) + sh
+    out_fn_dict[vn] = temp_dir / (vn + '.npy')
+    A = np.lib.format.open_memmap(out_fn_dict[vn], mode='w+', dtype=float, shape=(NT,) + sh)
+    del A
+
+ot_vec = np.nan * np.ones(NT)
+with Nfun.get_pool(min(Nproc, NT), initializer=Nfun.init_worker,
+        initargs=(maps, vmaps, vn_dict, hh, out_fn_dict)) as pool:
+    for tt, ot in pool.imap_unordered(Nfun.do_worker, enumerate(h_list)):
+        ot_vec[tt] = ot
 print('Time to run all extractions = %0.1f sec' % (time()-tt0))
 sys.stdout.flush()
-# +++++++++ end parallel subprocess +++++++++++++++++++++++++++++++++
+# +++++++++ end parallel interpolation +++++++++++++++++++++++++++++++++
 
 # Write files to NetCDF.
 
@@ -91,47 +104,21 @@ tt0 = time()
 out_fn = out_dir / 'ocean_clm.nc'
 out_fn.unlink(missing_ok=True)
 ds = xr.Dataset()
-# Initialize Dataset and save variable names to loop over
-dd0 = pickle.load(open(temp_out_fn_list[0], 'rb'))
-ddk = dd0.keys()
-for vn in ddk:
-    if vn == 'ocean_time':
-        pass
-    else:
-        vinfo = zrfun.get_varinfo(vn, vartype='climatology')
-        dims = (vinfo['time_name'],) + vinfo['space_dims_tup']
-        ds[vn] = (dims, np.nan * np.ones((NT,) + dd0[vn].shape))
-        ds[vn].attrs['units'] = vinfo['units']
-        ds[vn].attrs['long_name'] = vinfo['long_name']
-# loop over the temp files
-ot_vec = np.nan * np.ones(NT)
-ii = 0
-for temp_out_fn in temp_out_fn_list:
-    dd = pickle.load(open(temp_out_fn, 'rb'))
-    for vn in ddk:
-        ddv = dd[vn]
-        if verbose: # debugging
-            print('\n%d %s max = %0.1f' % (ii,vn,np.nanmax(ddv)))
-        if vn == 'ocean_time':
-            ot_vec[ii] = ddv
-        else:
-            if ddv.ndim == 2:
-                ds[vn][ii, :, :] = ddv
-            elif ddv.ndim == 3:
-                ds[vn][ii, :, :, :] = ddv
-            else:
-                print('problem with ndim?')
-    ii += 1
+for vn in vn_dict.keys():
+    vinfo = zrfun.get_varinfo(vn, vartype='climatology')
+    dims = (vinfo['time_name'],) + vinfo['space_dims_tup']
+    ds[vn] = (dims, np.load(out_fn_dict[vn], mmap_mode='r'))
+    ds[vn].attrs['units'] = vinfo['units']
+    ds[vn].attrs['long_name'] = vinfo['long_name']
+    if verbose: # debugging
+        print('%s max = %0.1f' % (vn, np.nanmax(ds[vn].values)))
 # Add the time coordinates
-for vn in ddk:
-    if vn == 'ocean_time':
-        pass
-    else:
-        vinfo = zrfun.get_varinfo(vn, vartype='climatology')
-        tname = vinfo['time_name']
-        # time coordinate
-        ds[tname] = ((tname,), ot_vec)
-        ds[tname].attrs['units'] = Lfun.roms_time_units
+for vn in vn_dict.keys():
+    vinfo = zrfun.get_varinfo(vn, vartype='climatology')
+    tname = vinfo['time_name']
+    # time coordinate
+    ds[tname] = ((tname,), ot_vec)
+    ds[tname].attrs['units'] = Lfun.roms_time_units
 # and save to NetCDF
 Enc_dict = {vn:zrfun.enc_dict for vn in ds.data_vars}
 ds.to_netcdf(out_fn, encoding=Enc_dict)
@@ -50,6 +50,10 @@ roms_time_units = 'seconds since 1970-01-01 00:00:00'
 # format used for naming day folders
 ds_fmt = '%Y.%m.%d'
 
+# sentinel file written in a day folder of history files when they have all been
+# copied (by driver_roms3.py), used by post-processing to know the day is ready
+his_done_name = 'his_done.txt'
+
 def Lstart(gridname='BLANK', tag='BLANK', ex_name='BLANK'):
     """
     This adds more run-specific entries to Ldir.
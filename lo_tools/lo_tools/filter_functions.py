@@ -0,0 +1,204 @@
+"""
+Functions for filtering time series along axis 0, used by zfun.lowpass() and
+zfun.filt_AB8d(), and available for streaming long records.
+
+A filter is described by the dict F from get_filter_info(). The output at time
+index i is the convolution
+
+    out[i] = sum_k F['w'][k] * data[i + F['shift'] - k]
+
+except for the first F['n0'] and last F['n1'] times, which are padded with nan
+(or with the original data if nanpad=False). This reproduces exactly what the
+original zfun.lowpass() (np.convolve(mode='same') on the flattened array) and
+zfun.filt_AB8d() (a loop over hours) returned, to round-off.
+
+The data are reshaped (without copying) to (time, column) and worked through
+in blocks of columns, so memory use is one output array plus a block. Each
+block is done either directly with np.convolve, which is fastest for short
+filters like Godin, or by FFT convolution, which is much faster for long ones. As with np.convolve, a nan
+anywhere in the window of a time gives a nan there.
+
+For records that do not fit in memory, stream_filter() takes an iterator of
+blocks of times and yields the filtered blocks as soon as they can be made.
+
+Typical use:
+
+from lo_tools import filter_functions as ffun
+F = ffun.get_filter_info('godin')
+lp = ffun.filter_axis0(data, F)
+# lp is the same as zfun.lowpass(data, f='godin')
+
+"""
+
+import numpy as np
+from lo_tools import zfun
+
+def get_filter_info(f='hanning', n=40):
+    """
+    Returns the dict F for the filter f:
+    'hanning' = Hanning window of length n
+    'godin' = Godin 24-24-25 filter (hourly data only)
+    'ab8d' = Austin-Barth 8 day filter, which only uses past times (hourly data only)
+    F has:
+    'w' = convolution weights, 'shift' = offset of the output time (see above),
+    'n0', 'n1' = number of times padded at the start and end.
+    """
+    if f == 'hanning':
+        w = zfun.hanning_shape(n=n)
+    elif f == 'godin':
+        w = zfun.godin_shape()
+    elif f == 'ab8d':
+        # weights decaying from 1 to 1/e over the previous 8 days, with the
+        # largest weight on the current time
+        fl = 8*24
+        w = np.exp(np.linspace(-1,0,fl))
+        w = w[::-1] / w.sum()
+        # filt_AB8d() only filled in times from fl+1 on
+        return {'w':w, 'shift':0, 'n0':fl+1, 'n1':0}
+    else:
+        print('ERROR in get_filter_info(): unsupported filter ' + str(f))
+        return None
+    L = len(w)
+    npad = L//2
+    return {'w':w, 'shift':(L-1)//2, 'n0':npad, 'n1':npad}
+
+def get_method(L, NT):
+    """
+    Choose 'direct' or 'fft' for a filter of length L and NT times. FFT only
+    pays for itself with long filters (e.g. a 30 day Hanning window of hourly
+    data); for the Godin filter np.convolve is faster.
+    """
+    if (L >= 160) and (NT >= 4*L):
+        return 'fft'
+    else:
+        return 'direct'
+
+def convolve_valid(x, w, method='auto'):
+    """
+    Convolution of the array x (time, ...) with the weights w along
+    axis 0, keeping only the times where the window is fully inside x, so the
+    result has len(x) - len(w) + 1 times.
+    """
+    L = len(w)
+    NV = x.shape[0] - L + 1
+    if NV <= 0:
+        return np.zeros((0,) + x.shape[1:])
+    if method == 'auto':
+        method = get_method(L, x.shape[0])
+    sh = (NV,) + x.shape[1:]
+    if method == 'direct':
+        # put the columns end to end and do a single np.convolve, keeping
+        # only the part of each column where the window does not overlap
+        # the next one
+        x = x.reshape((x.shape[0], -1))
+        NT, NC = x.shape
+        yf = np.convolve(x.flatten('F'), w, mode='valid')
+        # a (NV, NC) view: column cc starts at yf[cc*NT]
+        y = np.lib.stride_tricks.as_strided(yf, shape=(NV, NC),
+            strides=(yf.strides[0], NT*yf.strides[0]), writeable=False)
+    elif method == 'fft':
+        # imported here because it is slow to import and only needed for long filters
+        from scipy import signal
+        isnan = np.isnan(x)
+        has_nan = isnan.any()
+        if has_nan:
+            x = np.where(isnan, 0, x)
+        y = signal.fftconvolve(x, w.reshape((L,) + (1,)*(x.ndim-1)), mode='valid', axes=0)
+        if has_nan:
+            # any nan in the window gives nan, as in np.convolve
+            cs = np.zeros((x.shape[0]+1,) + x.shape[1:])
+            np.cumsum(isnan, axis=0, out=cs[1:])
+            y[(cs[L:] - cs[:NV]) > 0] = np.nan
+    else:
+        print('ERROR in convolve_valid(): unsupported method ' + str(method))
+        return None
+    return y.reshape(sh)
+
+def get_col_blocks(NC, NT, chunk_bytes):
+    """
+    Slices of columns so that each block of (NT, ncol) float64 values is
+    about chunk_bytes.
+    """
+    ncol = max(1, int(chunk_bytes / (8*max(NT,1))))
+    return [slice(c0, min(c0 + ncol, NC)) for c0 in range(0, NC, ncol)]
+
+def filter_axis0(data, F, nanpad=True, method='auto', chunk_bytes=2**24):
+    """
+    Filter the N-D array data along axis 0 with the filter F from
+    get_filter_info(). Returns a float array of the same shape.
+    """
+    w = F['w']
+    L = len(w)
+    shift = F['shift']
+    n0 = F['n0']
+    n1 = F['n1']
+    sh = data.shape
+    NT = sh[0]
+    x = np.asarray(data).reshape((NT, -1))
+    NC = x.shape[1]
+    # time is the fast axis of out (as in the original lowpass), so each
+    # column is contiguous
+    buf = np.empty(sh[1:] + (NT,), dtype=np.result_type(x.dtype, np.float64))
+    out = buf.reshape((NC, NT)).T
+    # the times we can filter, and the input times they need
+    i0 = n0
+    i1 = max(n0, NT - n1)
+    for cc in get_col_blocks(NC, NT, chunk_bytes):
+        if i1 > i0:
+            out[i0:i1, cc] = convolve_valid(x[i0+shift-L+1 : i1+shift, cc], w, method=method)
+    # pad the ends
+    for ii in [slice(0, min(n0, NT)), slice(i1, NT)]:
+        if nanpad:
+            out[ii] = np.nan
+        else:
+            out[ii] = x[ii]
+    return np.moveaxis(buf, -1, 0)
+
+def stream_filter(block_iter, F, nanpad=True, method='auto'):
+    """
+    Generator that filters a long record along axis 0, given as an iterator
+    of arrays that are consecutive blocks of times (any number of times in
+    each, and the same shape otherwise). It yields blocks of the filtered
+    record, and putting these together with np.concatenate() gives the same
+    result as filter_axis0() on the whole record. Only about len(F['w'])
+    times are kept in memory between blocks.
+    """
+    w = F['w']
+    L = len(w)
+    shift = F['shift']
+    n0 = F['n0']
+    n1 = F['n1']
+    X = None # the input times we still need
+    x0 = 0 # time index of X[0]
+    t_in = 0 # number of input times so far
+    t_out = 0 # number of output times so far
+    def pad(ii):
+        # output for the times in range ii at the ends of the record
+        if nanpad:
+            return np.nan * np.ones((len(ii),) + X.shape[1:])
+        else:
+            return X[ii.start - x0 : ii.stop - x0].astype(np.float64)
+    for block in block_iter:
+        block = np.asarray(block)
+        X = block if X is None else np.concatenate((X, block), axis=0)
+        t_in += block.shape[0]
+        # times that are known not to be in the padding at the end
+        t_end = t_in - n1
+        if t_end <= t_out:
+            continue
+        y_list = []
+        if t_out < n0:
+            ii = range(t_out, min(n0, t_end))
+            y_list.append(pad(ii))
+            t_out = ii.stop
+        if t_end > t_out:
+            y_list.append(convolve_valid(X[t_out+shift-L+1-x0 : t_end+shift-x0], w,
+                method=method))
+            t_out = t_end
+        # drop the input times that are no longer needed
+        x1 = max(x0, t_out + shift - L + 1)
+        X = X[x1 - x0:]
+        x0 = x1
+        yield np.concatenate(y_list, axis=0)
+    if (X is not None) and (t_in > t_out):
+        yield pad(range(t_out, t_in))
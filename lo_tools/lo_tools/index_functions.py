@@ -0,0 +1,119 @@
+"""
+Functions for a persistent cache of grid index arrays, such as the result of
+nearest neighbor searches between two fixed sets of points.
+
+This replaces making and pickling cKDTrees by hand. Results are saved as plain
+.npy files in LO_output/index_cache/v[cache_version]/[name]_[hash], where the
+hash is made from the actual coordinate values used, so a cached result can never
+be stale: if the grid changes you just get a new entry. The arrays are loaded
+with memory mapping, so using a cached index takes milliseconds.
+
+Typical use:
+
+from lo_tools import index_functions as ifun
+ind = ifun.get_nearest(xy_src, xy_dst, 'atm_d2')
+# ind is the same as cKDTree(xy_src).query(xy_dst)[1]
+
+"""
+
+import os, shutil
+import hashlib
+import numpy as np
+from scipy.spatial import cKDTree
+from lo_tools import Lfun
+
+# Increment this if the format or meaning of anything in the cache changes.
+cache_version = 1
+
+# trees made during this session, so we only build each one once
+tree_dict = dict()
+
+def get_hash(*args):
+    """
+    Returns a short hex string that uniquely identifies the contents of any
+    number of numpy arrays (or things that can be made into arrays).
+    """
+    hh = hashlib.sha1()
+    for a in args:
+        a = np.ascontiguousarray(a)
+        hh.update(str((a.dtype.str, a.shape)).encode())
+        hh.update(a.data)
+    return hh.hexdigest()[:16]
+
+def get_grid_hash(fn):
+    """
+    Returns a hash of the grid and s-coordinate info in a ROMS grid or history
+    file: lon/lat/mask on rho, u, v grids, h, and the s-coordinate vectors if present.
+    """
+    import xarray as xr
+    ds = xr.open_dataset(fn, decode_times=False)
+    vn_list = []
+    for tag in ['rho', 'u', 'v']:
+        vn_list += ['lon_' + tag, 'lat_' + tag, 'mask_' + tag]
+    vn_list += ['h', 's_rho', 's_w', 'Cs_r', 'Cs_w', 'hc', 'Vtransform']
+    a_list = [ds[vn].values for vn in vn_list if vn in ds.variables]
+    ds.close()
+    return get_hash(*a_list)
+
+def get_cache_dir():
+    Ldir = Lfun.Lstart()
+    return Ldir['LOo'] / 'index_cache' / ('v' + str(cache_version))
+
+def save_arrays(key, A_dict):
+    """
+    Save a dict of numpy arrays to the cache under the string key.
+    We write to a temporary directory and then rename it so that many
+    processes can safely try to create the same entry at once.
+    """
+    out_dir = get_cache_dir() / key
+    if out_dir.is_dir():
+        return
+    temp_dir = get_cache_dir() / (key + '_temp_' + str(os.getpid()))
+    Lfun.make_dir(temp_dir, clean=True)
+    for vn in A_dict.keys():
+        np.save(temp_dir / (vn + '.npy'), A_dict[vn])
+    try:
+        os.rename(temp_dir, out_dir)
+    except OSError:
+        # another process made it first
+        shutil.rmtree(str(temp_dir), ignore_errors=True)
+
+def load_arrays(key):
+    """
+    Returns a dict of memory-mapped arrays from the cache, or None if the
+    key is not in the cache.
+    """
+    in_dir = get_cache_dir() / key
+    if not in_dir.is_dir():
+        return None
+    A_dict = dict()
+    for fn in in_dir.glob('*.npy'):
+        A_dict[fn.stem] = np.load(fn, mmap_mode='r')
+    return A_dict
+
+def get_tree(xy):
+    """
+    Returns a cKDTree for the points xy (shape = (number of points, dimensions)),
+    made once per session.
+    """
+    key = get_hash(xy)
+    if key not in tree_dict.keys():
+        tree_dict[key] = cKDTree(xy)
+    return tree_dict[key]
+
+def get_nearest(xy_src, xy_dst, name='nn'):
+    """
+    Returns an integer array of the index into xy_src of the nearest point
+    to each point in xy_dst, i.e. cKDTree(xy_src).query(xy_dst)[1].
+    Both inputs are shaped (number of points, dimensions).
+
+    The result is cached on disk, and the tree is only made if needed.
+    """
+    key = name + '_' + get_hash(xy_src, xy_dst)
+    A_dict = load_arrays(key)
+    if A_dict is None:
+        ind = get_tree(xy_src).query(xy_dst, workers=-1)[1]
+        save_arrays(key, {'ind': ind})
+        return ind
+    else:
+        return A_dict['ind']
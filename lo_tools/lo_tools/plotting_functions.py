@@ -399,8 +399,7 @@ def get_laym(ds, zfull, mask, vn, zlev):
 
 def get_layer(fld, zfull, which_z):
     """
-    Creates a horizontal slice through a 3D ROMS data field.  It is very fast
-    because of the use of "choose"
+    Creates a horizontal slice through a 3D ROMS data field.
     Input:
         fld (3D ndarray) of the data field to slice
         z (3D ndarray) of z values (like from make_full)
@@ -408,52 +407,62 @@ def get_layer(fld, zfull, which_z):
     Output:
         lay (2D ndarray) fld on z == which_z,
             with np.nan where it is not defined
+    NOTE: to get several layers, or layers of several fields on the same grid, it
+    is much faster to use get_layer_weights() once and then apply_layer_weights()
+    for each field.
     """
-    N, M, L = fld.shape # updates N for full fields
-    Nmax = 30
-    ii = np.arange(0,N,Nmax)
-    ii = np.concatenate((ii,np.array([N,])))
-    fld0 = np.nan * np.zeros((M, L), dtype=int)
-    fld1 = np.nan * np.zeros((M, L), dtype=int)
-    z0 = np.nan * np.zeros((M, L), dtype=int)
-    z1 = np.nan * np.zeros((M, L), dtype=int)
-    # NOTE: need fewer than 32 layers to use "choose"
-    # so we split the operation into steps in this loop
-    j = 0
-    while j < len(ii)-1:
-        i_lo = ii[j]
-        i_hi = min(ii[j+1] + 1, ii[-1]) # overlap by 1
-        NN = i_hi - i_lo # the number of levels in this chunk
-        this_zr = zfull[i_lo:i_hi].copy()
-        this_fld = fld[i_lo:i_hi].copy()
-        zm = this_zr < which_z
-        ind0 = np.zeros((M, L), dtype=int)
-        ind1 = np.zeros((M, L), dtype=int)
-        ind0 = (zm == True).sum(0) - 1 # index of points below which_z
-        ind1 = ind0 + 1 # index of points above which_z
-        # dealing with out-of-bounds issues
-        # note 0 <= ind0 <= NN-1
-        # and  1 <= ind1 <= NN
-        # make ind1 = ind0 for out of bounds cases
-        ind0[ind0 == -1] = 0 # fix bottom case
-        ind1[ind1 == NN] = NN-1 # fix top case
-        # and now cells that should be masked have equal indices
-        this_mask = ind0 != ind1
-        this_fld0 = ind0.choose(this_fld)
-        this_fld1 = ind1.choose(this_fld)
-        this_z0 = ind0.choose(this_zr)
-        this_z1 = ind1.choose(this_zr)
-        fld0[this_mask] = this_fld0[this_mask]
-        fld1[this_mask] = this_fld1[this_mask]
-        z0[this_mask] = this_z0[this_mask]
-        z1[this_mask] = this_z1[this_mask]
-        j += 1
-    # do the interpolation
+    LW = get_layer_weights(zfull, np.array(which_z).flatten()[:1])
+    lay = apply_layer_weights(fld, LW)[0,:,:]
+    return lay
+
+def get_layer_weights(zfull, z_list):
+    """
+    Finds the indices and weights to do linear interpolation of a 3D ROMS data
+    field to a list of z values, so that they can be used with any number of fields.
+    Input:
+        zfull (3D ndarray) of z values (like from make_full), increasing along axis 0
+        z_list (list or 1D ndarray) of the z values for the layers
+    Output:
+        LW (dict) with:
+            'ind' (3D int ndarray, NZ x M x L) the index of the level below each z value
+            'fr' (3D ndarray) the fractional distance from that level to the next
+            'good' (3D Boolean ndarray) False where the z value is outside the column
+    """
+    z_arr = np.array(z_list, dtype=float).flatten()
+    N, M, L = zfull.shape
+    NZ = len(z_arr)
+    ind = np.zeros((NZ, M, L), dtype=int)
+    for kk in range(NZ):
+        # this is searchsorted (side='left') on every column at once
+        ind[kk,:,:] = (zfull < z_arr[kk]).sum(axis=0) - 1
+    # the level below and the level above must both be in the column
+    good = (ind >= 0) & (ind <= N-2)
+    ind = np.clip(ind, 0, N-2)
+    z0 = np.take_along_axis(zfull, ind, axis=0)
+    z1 = np.take_along_axis(zfull, ind+1, axis=0)
     dz = z1 - z0
-    dzf = which_z - z0
-    dz[dz == 0] = np.nan
-    fr = dzf / dz
-    lay = fld0*(1 - fr) + fld1*fr
+    good = good & (dz != 0)
+    dz[dz == 0] = 1
+    fr = (z_arr.reshape(NZ, 1, 1) - z0) / dz
+    LW = {'ind':ind, 'fr':fr, 'good':good}
+    return LW
+
+def apply_layer_weights(fld, LW):
+    """
+    Interpolates a 3D ROMS data field to the layers defined by LW, which came from
+    get_layer_weights() using a zfull on the same grid as fld.
+    Input:
+        fld (3D ndarray) of the data field to slice
+        LW (dict) from get_layer_weights()
+    Output:
+        lay (3D ndarray, NZ x M x L) fld on the layers,
+            with np.nan where it is not defined
+    """
+    NZ = LW['ind'].shape[0]
+    # one gather for the levels below and above, for all layers
+    ff = np.take_along_axis(fld, np.concatenate((LW['ind'], LW['ind']+1), axis=0), axis=0)
+    lay = ff[:NZ,:,:]*(1 - LW['fr']) + ff[NZ:,:,:]*LW['fr']
+    lay[~LW['good']] = np.nan
     return lay
 
 def make_full(flt):
@@ -174,18 +174,14 @@ def filt_AB8d(data):
     % with the weighting decaying from 1 to 1/e at t - 8 days.  There are 192
     % hours in 8 days.
     Input:
-        assumed to be a 1D numpy array
+        assumed to be a 1D numpy array (or ND with time on axis 0)
     Output:
         a vector of the same size you started with,
         padded with NaN's at the ends.
+    The work is done by filter_functions.filter_axis0().
     """
-    fl = 8*24;
-    filt = np.exp(np.linspace(-1,0,fl))
-    filt = filt/filt.sum();
-    smooth = np.nan*data
-    for ii in range(fl+1, len(data)):
-        smooth[ii] = (filt*data[ii-fl+1: ii + 1]).sum()
-    return smooth
+    from lo_tools import filter_functions as ffun
+    return ffun.filter_axis0(data, ffun.get_filter_info('ab8d'))
     
 def lowpass(data, f='hanning', n=40, nanpad=True):
     """
@@ -196,31 +192,18 @@ def lowpass(data, f='hanning', n=40, nanpad=True):
     
     Output: Array of the same size, filtered with Hanning window of length n,
         or the Godin filter (hourly data only) padded with nan's.
+
+    The work is done by filter_functions.filter_axis0(), which filters along
+    axis 0 in blocks of columns, using FFT convolution for long filters.
     """
     if n == 1:
         return data
+    elif f not in ['hanning', 'godin']:
+        print('ERROR in filt_general(): unsupported filter ' + f)
+        return np.nan * data
     else:
-        if f == 'hanning':
-            filt = hanning_shape(n=n)
-        elif f == 'godin':
-            filt = godin_shape()
-        else:
-            print('ERROR in filt_general(): unsupported filter ' + f)
-            filt = np.nan
-        npad = np.floor(len(filt)/2).astype(int)
-        sh = data.shape
-        df = data.flatten('F')
-        dfs = np.convolve(df, filt, mode = 'same')
-        smooth = dfs.reshape(sh, order='F')
-        # note that the indexing below defaults to being on axis 0,
-        # and correctly broadcasts without having to mention the other axes
-        if nanpad:
-            smooth[:npad] = np.nan
-            smooth[-npad:] = np.nan
-        else:
-            smooth[:npad] = data[:npad]
-            smooth[-npad:] = data[-npad:]
-        return smooth
+        from lo_tools import filter_functions as ffun
+        return ffun.filter_axis0(data, ffun.get_filter_info(f, n=n), nanpad=nanpad)
     
 def godin_shape():
     """
@@ -231,7 +214,7 @@ def godin_shape():
     ** use ONLY with hourly data! **
     """
     k = np.arange(12)
-    filt = np.NaN * np.ones(71)
+    filt = np.nan * np.ones(71)
     filt[35:47] = (0.5/(24*24*25))*(1200-(12-k)*(13-k)-(12+k)*(13+k))
     k = np.arange(12,36)
     filt[47:71] = (0.5/(24*24*25))*(36-k)*(37-k)
@@ -61,7 +61,7 @@ def get_basic_info(fn, only_G=False, only_S=False, only_T=False):
         return make_G(ds), make_S(ds), make_T(ds)
     ds.close()
 
-def get_z(h, zeta, S, only_rho=False, only_w=False):
+def get_z(h, zeta, S, only_rho=False, only_w=False, ind=None, dtype=None, out=None):
     """
     Used to calculate the z position of fields in a ROMS history file
 
@@ -74,6 +74,20 @@ def get_z(h, zeta, S, only_rho=False, only_w=False):
     vectors of length VL, the output array (e.g. z_rho) will have size (N, VL)
     (i.e. it will never return an array with size (N, VL, 1), even if (VL, 1) was
     the input shape).  This is a result of the initial and final squeeze calls.
+
+    Optional arguments:
+    zeta can also be a stack of times, with size (NT,) + h.shape, and then the
+    output has size (NT, N) + h.shape (squeezed as above).
+    ind = an index into the last dimensions of h and zeta, e.g. a tuple (jj, ii)
+    of index arrays or a boolean mask, so that only those columns are done.
+    dtype = the output dtype (default float64); np.float32 halves the memory.
+    out = an array (or a tuple of two arrays if we return both z_rho and z_w)
+    to write the result into. It must be contiguous with the size of the
+    output, and it is returned as is, without squeezing.
+
+    The levels are done by broadcasting (N,1) vectors of the stretching
+    functions against h and zeta, so the only full-size arrays are the output
+    and one temporary.
     """
     # input error checking
     if ( (not isinstance(h, np.ndarray))
@@ -83,71 +97,70 @@ def get_z(h, zeta, S, only_rho=False, only_w=False):
         print('WARNING from get_z(): S must be a dict')
     # number of vertical levels
     N = S['N']
-    # remove singleton dimensions
-    h = h.squeeze()
-    zeta = zeta.squeeze()
-    # ensure that we have enough dimensions
-    h = np.atleast_2d(h)
-    zeta = np.atleast_2d(zeta)
-    # check that the dimensions are the same
-    if h.shape != zeta.shape:
+    dtype = np.dtype(dtype if dtype is not None else np.float64)
+    # subset columns
+    if ind is not None:
+        h = np.asarray(h)[ind]
+        if isinstance(ind, tuple):
+            zeta = zeta[(Ellipsis,) + ind]
+        else:
+            zeta = zeta[..., ind]
+    # remove singleton dimensions and ensure that we have enough dimensions
+    h = np.atleast_2d(np.asarray(h, dtype=dtype).squeeze())
+    # zeta is either the same size as h or a stack of times
+    zeta = np.ma.filled(zeta, np.nan).astype(dtype)
+    if zeta.size == h.size:
+        zeta = zeta.reshape((1,) + h.shape)
+    elif zeta.size % h.size == 0:
+        zeta = zeta.reshape((-1,) + h.shape)
+    else:
         print('WARNING from get_z(): h and zeta must be the same shape')
-    M, L = h.shape
-    def make_z_rho(h, zeta, S, N, M, L):
-        # rho
-        # create some useful arrays
-        csr = S['Cs_r']
-        csrr = csr.reshape(N, 1, 1).copy()
-        Cs_r = np.tile(csrr, [1, M, L])
-        H_r = np.tile(h.reshape(1, M, L).copy(), [N, 1, 1])
-        Zeta_r = np.tile(zeta.reshape(1, M, L).copy(), [N, 1, 1])
-        if S['hc'] == 0: # if hc = 0 the transform is simpler (and faster)
-            z_rho = H_r*Cs_r + Zeta_r + Zeta_r*Cs_r
-        elif S['hc'] != 0: # need to calculate a few more useful arrays
-            sr = S['s_rho'] # PM edit 2019.01.24
-            srr = sr.reshape(N, 1, 1).copy()
-            S_rho = np.tile(srr, [1, M, L])
-            Hc_r = np.tile(S['hc'], [N, M, L])
-            if S['Vtransform'] == 1:
-                zr0 = (S_rho - Cs_r) * Hc_r + Cs_r*H_r
-                z_rho = zr0 + Zeta_r * (1 + zr0/H_r)
-            elif S['Vtransform'] == 2:
-                zr0 = (S_rho*Hc_r + Cs_r*H_r) / (Hc_r + H_r)
-                z_rho = Zeta_r + (Zeta_r + H_r)*zr0
-        z_rho = z_rho.squeeze()
-        return z_rho
-    def make_z_w(h, zeta, S, N, M, L):
-        # w
-        # create some useful arrays
-        csw = S['Cs_w']
-        csww = csw.reshape(N+1, 1, 1).copy()
-        Cs_w = np.tile(csww, [1, M, L])
-        H_w = np.tile(h.reshape(1, M, L).copy(), [N+1, 1, 1])
-        Zeta_w = np.tile(zeta.reshape(1, M, L).copy(), [N+1, 1, 1])
+    NT = zeta.shape[0]
+    # add a vertical axis to h and zeta: (1, ...) and (NT, 1, ...)
+    h = h[np.newaxis, ...]
+    zeta = zeta[:, np.newaxis, ...]
+    def make_z(Cs, s, out):
+        # Cs and s are the stretching function and s-coordinate vectors
+        NZ = len(Cs)
+        full_shape = (NT, NZ) + h.shape[1:]
+        if out is None:
+            z = np.empty(full_shape, dtype=dtype)
+        else:
+            # this raises an error if out cannot be reshaped without a copy
+            z = out.view()
+            z.shape = full_shape
+        vshape = (NZ,) + (1,)*(h.ndim - 1)
+        Cs = Cs.astype(dtype).reshape(vshape)
+        s = s.astype(dtype).reshape(vshape)
+        hc = dtype.type(S['hc'])
+        # the same operations as the original tiled version, done in place
         if S['hc'] == 0: # if hc = 0 the transform is simpler (and faster)
-            z_w = H_w*Cs_w + Zeta_w + Zeta_w*Cs_w
-        elif S['hc'] != 0: # need to calculate a few more useful arrays
-            #sw = S['s_w']
-            sw = S['s_w'] # PM edit 2019.01.24
-            sww = sw.reshape(N+1, 1, 1).copy()
-            S_w = np.tile(sww, [1, M, L])    #
-            Hc_w = np.tile(S['hc'], [N+1, M, L])
-            if S['Vtransform'] == 1:
-                zw0 = (S_w - Cs_w) * Hc_w + Cs_w*H_w
-                z_w = zw0 + Zeta_w * (1 + zw0/H_w)
-            elif S['Vtransform'] == 2:
-                zw0 = (S_w*Hc_w  + Cs_w*H_w) / (Hc_w + H_w)
-                z_w = Zeta_w + (Zeta_w + H_w)*zw0
-        z_w = z_w.squeeze()
-        return z_w
+            np.add(h*Cs, zeta, out=z)
+            z += zeta*Cs
+        elif S['Vtransform'] == 1:
+            zr0 = (s - Cs)*hc + Cs*h
+            np.divide(zr0, h, out=z[0])
+            fac = z[0] + 1
+            np.multiply(zeta, fac, out=z)
+            z += zr0
+        elif S['Vtransform'] == 2:
+            zr0 = (s*hc + Cs*h) / (hc + h)
+            np.multiply(zeta + h, zr0, out=z)
+            z += zeta
+        if out is None:
+            return z.squeeze()
+        else:
+            return out
     # return results
     if only_rho:
-        return make_z_rho(h, zeta, S, N, M, L)
+        return make_z(S['Cs_r'], S['s_rho'], out)
     elif only_w:
-        return make_z_w(h, zeta, S, N, M, L)
-    else :
-        return make_z_rho(h, zeta, S, N, M, L), make_z_w(h, zeta, S, N, M, L)
-    
+        return make_z(S['Cs_w'], S['s_w'], out)
+    else:
+        if out is None:
+            out = (None, None)
+        return make_z(S['Cs_r'], S['s_rho'], out[0]), make_z(S['Cs_w'], S['s_w'], out[1])
+
 def get_S(S_info_dict):
     """
     Code to calculate S-coordinate vectors from the parameters
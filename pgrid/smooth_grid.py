@@ -1,9 +1,9 @@
 """
 Smooth the grid.
 
-This is slow-ish. I wish I could vectorize the
-gfu.GRID_PlusMinusScheme_rx0().  But still it only takes a
-minute for a grid with 3 million points, so not bad.
+The smoothing is done by the vectorized gfu.GRID_PlusMinusScheme_rx0(),
+which takes a few seconds for a grid with 3 million points. It prints the
+number of pairs of cells adjusted and the max rx0 for each iteration.
 """
 import numpy as np
 import pickle
@@ -61,7 +61,7 @@ elif dch['min_depth'] <= 0:
     
 # Do the smoothing.
 Hnew = gfu.GRID_PlusMinusScheme_rx0(MSK, Hobs, rx0max, AreaMatrix,
-            fjord_cliff_edges=True, shift=shift)
+            fjord_cliff_edges=True, shift=shift, verbose=True)
 
 print('Smoothing took %0.1f seconds' % (time() - tt0))
 
@@ -84,22 +84,34 @@ do_carbon = True
 if 'TIC' not in vn_in_list:
     do_carbon = False
 
-# create zfull to use with the pfun.get_laym() function
+# create zfull to use with the pfun.get_layer_weights() function
 zfull = pfun.get_zfull(in_ds, in_fn, 'rho')
 in_mask_rho = in_ds.mask_rho.values # 1 = water, 0 = land
 # account for WET_DRY
 if 'wetdry_mask_rho' in in_ds.data_vars:
     in_mask_rho = in_ds.wetdry_mask_rho[0,:,:].values.squeeze()
 
-def get_layer(vn, depth, in_ds, zfull, in_mask_rho):
-    if depth == 'surface':
-        L = in_ds[vn][0,-1,:,:].values
-    elif depth == 'bottom':
-        L = in_ds[vn][0,0,:,:].values
-    else:
-        L = pfun.get_laym(in_ds, zfull, in_mask_rho, vn, -float(depth))
-            
-    return L
+# Find the interpolation indices and weights for all the depths once,
+# because they are the same for every variable.
+z_depth_list = [depth for depth in depth_list if depth not in ['surface', 'bottom']]
+LW = pfun.get_layer_weights(zfull, [-float(depth) for depth in z_depth_list])
+
+def get_layers(vn, in_ds, LW, in_mask_rho):
+    # returns a dict of the layers of variable vn for every depth in depth_list
+    fld = in_ds[vn][0,:,:,:].values
+    L_dict = dict()
+    # copies, so that L_all does not keep the whole 3-D fld of every variable
+    if 'surface' in depth_list:
+        L_dict['surface'] = fld[-1,:,:].copy()
+    if 'bottom' in depth_list:
+        L_dict['bottom'] = fld[0,:,:].copy()
+    if len(z_depth_list) > 0:
+        lay = pfun.apply_layer_weights(pfun.make_full((fld,)), LW)
+        for kk, depth in enumerate(z_depth_list):
+            L = lay[kk,:,:]
+            L[in_mask_rho == 0] = np.nan
+            L_dict[depth] = L
+    return L_dict
 
 def get_Ld(depth, in_ds, in_mask_rho):
     # makes a field of layer depth (m)
@@ -112,17 +124,21 @@ def get_Ld(depth, in_ds, in_mask_rho):
     Ld[in_mask_rho == 0] = np.nan
     return Ld
 
-# Fill the layers
+# Fill the layers for all variables and depths
+tt0 = time()
+L_all = dict()
+for vn in vn_in_list:
+    L_all[vn] = get_layers(vn, in_ds, LW, in_mask_rho)
+if testing:
+    print(' - fill layers took %0.2f sec' % (time()-tt0))
+
 for depth in depth_list:
     if testing:
         print(' - Depth = ' + depth)
     suffix = '_' + depth
     v_dict = dict()
-    tt0 = time()
     for vn in vn_in_list:
-        v_dict[vn] = get_layer(vn, depth, in_ds, zfull, in_mask_rho)
-    if testing:
-        print('   -- fill v_dict took %0.2f sec' % (time()-tt0))
+        v_dict[vn] = L_all[vn][depth]
         
     if do_carbon:
         # ------------- the CO2SYS steps -------------------------
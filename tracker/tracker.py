@@ -5,7 +5,8 @@ This results is significantly (36x) faster runtimes compared with old version.
 
 PERFORMANCE: about 3 minutes per day for a 3D cas6 experiment with 10k particles.
 
-NOTE: You have to have run make_KDTrees.py for the grid (e.g. cas6) before running.
+NOTE: You no longer have to run make_KDTrees.py before running. The index maps
+for a grid are made the first time it is used and kept in LO_output/index_cache.
 
 NOTE: There is some issue, perhaps with garbage collection, which causes
 the loading of NetCDF files to happen slower after running a few times
@@ -108,6 +109,9 @@ parser.add_argument('-nsd', '--number_of_start_days', default=1, type=int)
 parser.add_argument('-dbs', '--days_between_starts', default=1, type=int)
 parser.add_argument('-dtt', '--days_to_track', default=1, type=int)
 parser.add_argument('-sh', '--start_hour', default=0, type=int)
+# Use batch True to track all the releases together in one pass through the days,
+# which reads each history file once (instead of once per release).
+parser.add_argument('-batch', default=False, type=zfun.boolean_string)
 
 # number of divisions to make between saves for the integration
 # e.g. if ndiv = 12 and we have hourly saves, we use a 300 sec step
@@ -117,6 +121,10 @@ parser.add_argument('-ndiv', default=12, type=int)
 parser.add_argument('-sph', default=1, type=int)
 # sph = saves per hour, a new argument to allow more frequent writing of output.
 
+# interpolation of fields to particle positions: 'nn' = nearest neighbor,
+# 'linear' = bilinear (surface) or trilinear (3d)
+parser.add_argument('-interp', default='nn', type=str)
+
 args = parser.parse_args()
 TR = args.__dict__ 
 # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -179,6 +187,8 @@ if TR['no_advection'] == True:
     out_name += '_nadv'
 if TR['ndiv'] != 12: # only mention ndiv if it is NOT 12
     out_name += '_ndiv' + str(TR['ndiv'])
+if TR['interp'] == 'linear':
+    out_name += '_lin'
 if len(TR['sub_tag']) > 0:
     out_name += '_' + TR['sub_tag']
 
@@ -233,67 +243,143 @@ plon00, plat00, pcs00 = exp.get_ic(TR)
 # save this in case cust.update_TR() changes it.
 TR_orig = TR.copy()
 
-# step through the releases, one for each start day
 write_grid = True
-for idt0 in idt_list:
+if TR['batch']:
+    # Batched mode: make one time-ordered pass through the days, and on each day
+    # advance the particles of all active releases together in a single call to
+    # get_tracks(), so each history file is read once instead of once per release.
+    # Releases are only combined if their customized TR and history file list
+    # are the same on that day.
     tt0 = time() # monitor integration time
-    
-    # Start each release with original TR.
-    TR = TR_orig.copy()
-    
-    # name the release file by start day
-    idt0_str = datetime.strftime(idt0,'%Y.%m.%d')
-    outname = ('release_' + idt0_str + '.nc')
-    print('-- ' + outname)
-    sys.stdout.flush()
-    out_fn = outdir / outname
-    
-    # we do the calculation in one-day segments, but write complete
-    # output for a release to a single NetCDF file.
-    for nd in range(TR['days_to_track']):
-        
-        # get or replace the history file list for this day
-        idt = idt0 + timedelta(days=nd)
+    # remove particles on land from the initial condition (same for all releases)
+    plon00, plat00, pcs00 = tfun.trim_ic(plon00, plat00, pcs00)
+    NP0 = len(plon00)
+    R_list = [] # one dict per release
+    for idt0 in idt_list:
+        idt0_str = datetime.strftime(idt0,'%Y.%m.%d')
+        R = {'idt0':idt0, 'out_fn':outdir / ('release_' + idt0_str + '.nc'),
+            'plon':plon00.copy(), 'plat':plat00.copy(), 'pcs':pcs00.copy()}
+        R_list.append(R)
+    idt = idt_list[0]
+    idt_end = idt_list[-1] + timedelta(days=TR_orig['days_to_track'])
+    while idt < idt_end:
         idt_str = datetime.strftime(idt,'%Y.%m.%d')
-        print(' - working on ' + idt_str)
-        sys.stdout.flush()
-        fn_list = tfun.get_fn_list(idt, Ldir)
+        fn_list_day = tfun.get_fn_list(idt, Ldir)
         
         # write the grid file (once per experiment) for plotting
         if write_grid == True:
-            g_infile = fn_list[0]
-            g_outfile = outdir / 'grid.nc'
-            tfnc.write_grid(g_infile, g_outfile)
+            tfnc.write_grid(fn_list_day[0], outdir / 'grid.nc')
             write_grid = False
             
-        # apply customizations, if any
-        cust.update_TR(nd, TR)
-        # Note that because TR is a dictionary, changing it in the function
-        # changes it everywhere. No need to return it.
-
+        # group the active releases
+        group_list = [] # items are (TR, fn_list, list of releases)
+        for R in R_list:
+            nd = (idt - R['idt0']).days
+            if (nd < 0) or (nd >= TR_orig['days_to_track']):
+                continue
+            R['nd'] = nd
+            TR = TR_orig.copy()
+            cust.update_TR(nd, TR)
+            if (nd == 0) and (TR['start_hour'] > 0):
+                fn_list = fn_list_day[TR['start_hour']:]
+            else:
+                fn_list = fn_list_day
+            for group in group_list:
+                if (group[0] == TR) and (group[1] == fn_list):
+                    group[2].append(R)
+                    break
+            else:
+                group_list.append((TR, fn_list, [R]))
+        print(' - working on %s: %d release(s) in %d batch(es)' %
+            (idt_str, sum([len(group[2]) for group in group_list]), len(group_list)))
+        sys.stdout.flush()
+            
         # DO THE TRACKING
-        if nd == 0: # first day
-            # set IC
-            plon0 = plon00.copy()
-            plat0 = plat00.copy()
-            pcs0 = pcs00.copy()
-            # do the tracking
-            if TR['start_hour'] > 0:
-                fn_list = fn_list[TR['start_hour']:]
-            P = tfun.get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=True)
-            # save the results to NetCDF
-            tfnc.start_outfile(out_fn, P)
-        else: # subsequent days
-            # set IC
-            plon0 = P['lon'][-1,:]
-            plat0 = P['lat'][-1,:]
-            pcs0 = P['cs'][-1,:]
-            # do the tracking
+        for TR, fn_list, RR_list in group_list:
+            plon0 = np.concatenate([R['plon'] for R in RR_list])
+            plat0 = np.concatenate([R['plat'] for R in RR_list])
+            pcs0 = np.concatenate([R['pcs'] for R in RR_list])
             P = tfun.get_tracks(fn_list, plon0, plat0, pcs0, TR)
-            tfnc.append_to_outfile(out_fn, P)
+            # split the results by release and save to NetCDF
+            for ii, R in enumerate(RR_list):
+                PR = dict()
+                for vn in P.keys():
+                    if vn == 'ot':
+                        PR[vn] = P[vn]
+                    else:
+                        PR[vn] = P[vn][:, ii*NP0:(ii+1)*NP0]
+                if R['nd'] == 0:
+                    tfnc.start_outfile(R['out_fn'], PR)
+                else:
+                    tfnc.append_to_outfile(R['out_fn'], PR)
+                R['plon'] = PR['lon'][-1,:]
+                R['plat'] = PR['lat'][-1,:]
+                R['pcs'] = PR['cs'][-1,:]
+        idt = idt + timedelta(days=1)
         
-    print(' - Took %0.1f sec for %s day(s)' %
-            (time() - tt0, str(TR['days_to_track'])))
+    print(' - Took %0.1f sec for %d release(s)' % (time() - tt0, len(R_list)))
     print(50*'=')
+else:
+    # step through the releases, one for each start day
+    for idt0 in idt_list:
+        tt0 = time() # monitor integration time
+    
+        # Start each release with original TR.
+        TR = TR_orig.copy()
+    
+        # name the release file by start day
+        idt0_str = datetime.strftime(idt0,'%Y.%m.%d')
+        outname = ('release_' + idt0_str + '.nc')
+        print('-- ' + outname)
+        sys.stdout.flush()
+        out_fn = outdir / outname
+    
+        # we do the calculation in one-day segments, but write complete
+        # output for a release to a single NetCDF file.
+        for nd in range(TR['days_to_track']):
+        
+            # get or replace the history file list for this day
+            idt = idt0 + timedelta(days=nd)
+            idt_str = datetime.strftime(idt,'%Y.%m.%d')
+            print(' - working on ' + idt_str)
+            sys.stdout.flush()
+            fn_list = tfun.get_fn_list(idt, Ldir)
+        
+            # write the grid file (once per experiment) for plotting
+            if write_grid == True:
+                g_infile = fn_list[0]
+                g_outfile = outdir / 'grid.nc'
+                tfnc.write_grid(g_infile, g_outfile)
+                write_grid = False
+            
+            # apply customizations, if any
+            cust.update_TR(nd, TR)
+            # Note that because TR is a dictionary, changing it in the function
+            # changes it everywhere. No need to return it.
+
+            # DO THE TRACKING
+            if nd == 0: # first day
+                # set IC
+                plon0 = plon00.copy()
+                plat0 = plat00.copy()
+                pcs0 = pcs00.copy()
+                # do the tracking
+                if TR['start_hour'] > 0:
+                    fn_list = fn_list[TR['start_hour']:]
+                P = tfun.get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=True)
+                # save the results to NetCDF
+                tfnc.start_outfile(out_fn, P)
+            else: # subsequent days
+                # set IC
+                plon0 = P['lon'][-1,:]
+                plat0 = P['lat'][-1,:]
+                pcs0 = P['cs'][-1,:]
+                # do the tracking
+                P = tfun.get_tracks(fn_list, plon0, plat0, pcs0, TR)
+                tfnc.append_to_outfile(out_fn, P)
+        
+        print(' - Took %0.1f sec for %s day(s)' %
+                (time() - tt0, str(TR['days_to_track'])))
+        print(50*'=')
 print(50*'*' + '\nWrote to ' + str(outdir))
 
@@ -7,16 +7,19 @@ LO_output/tracks/exp_info.csv.
 """
 # setup (assume path to alpha set by calling code)
 from lo_tools import Lfun, zfun, zrfun
+from lo_tools import index_functions as ifun
 
 import numpy as np
 import xarray as xr
-from scipy.spatial import cKDTree
-import pickle
 from time import time
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 verbose = False
 
+# read the next history file in a background thread while tracking
+prefetch = True
+
 # this is the full list of tracers we want to find on the track and write to output
 tracer_list_full = ['salt', 'temp']#, 'oxygen']
 # we trim the list below so that it only includes tracers that are present
@@ -48,18 +51,6 @@ Maskr3 = np.tile(Maskr.reshape(1,G['M'],G['L']),[S['N'],1,1])
 Masku3 = np.tile(Masku.reshape(1,G['M'],G['L']-1),[S['N'],1,1])
 Maskv3 = np.tile(Maskv.reshape(1,G['M']-1,G['L']),[S['N'],1,1])
 Maskw3 = np.tile(Maskr.reshape(1,G['M'],G['L']),[S['N']+1,1,1])
-# load pre-made trees
-tree_dir = Ldir['LOo'] / 'tracker_trees' / TR0['gridname']
-# 2D
-xyT_rho = pickle.load(open(tree_dir / 'xyT_rho.p', 'rb'))
-xyT_u = pickle.load(open(tree_dir / 'xyT_u.p', 'rb'))
-xyT_v = pickle.load(open(tree_dir / 'xyT_v.p', 'rb'))
-xyT_rho_un = pickle.load(open(tree_dir / 'xyT_rho_un.p', 'rb'))
-# 3D
-xyzT_rho = pickle.load(open(tree_dir / 'xyzT_rho.p', 'rb'))
-xyzT_u = pickle.load(open(tree_dir / 'xyzT_u.p', 'rb'))
-xyzT_v = pickle.load(open(tree_dir / 'xyzT_v.p', 'rb'))
-xyzT_w = pickle.load(open(tree_dir / 'xyzT_w.p', 'rb'))
 # the "f" below refers to flattened, which is the result of passing
 # a Boolean array like Maskr to an array.
 lonrf = G['lon_rho'][Maskr]
@@ -70,6 +61,58 @@ maskr = Maskr.flatten()
 dxg = np.diff(G['lon_rho'][0,:]).min()
 dyg = np.diff(G['lat_rho'][:,0]).min()
 
+# NEW CODE for cell-aware interpolation (replaces the 3D KDTrees)
+# Because the LO grids are plaid in lon,lat we can find the fractional (i,j)
+# position of a particle on each C-grid staggering directly from the coordinate
+# vectors, and we do this once per substep for all fields. We also need maps
+# from each full-grid (j,i) to the index of the nearest water point in the
+# flattened fields. These, and the fractional depth of the s-levels, are kept
+# in the index cache, keyed on a hash of the grid, and are only computed
+# the first time a grid is used.
+IX = dict() # lon vectors for each staggering
+IY = dict() # lat vectors
+for tag in ['rho', 'u', 'v']:
+    IX[tag] = G['lon_' + tag][0,:]
+    IY[tag] = G['lat_' + tag][:,0]
+cache_key = 'tracker_' + ifun.get_grid_hash(TR0['fn00'])
+A_dict = ifun.load_arrays(cache_key)
+if A_dict is None:
+    A_dict = dict()
+    for tag, Mask in [('rho', Maskr), ('u', Masku), ('v', Maskv)]:
+        x = G['lon_' + tag]
+        y = G['lat_' + tag]
+        xyT = ifun.get_tree(np.array((x[Mask],y[Mask])).T)
+        xy = np.array((x.flatten(),y.flatten())).T
+        A_dict['IW_' + tag] = xyT.query(xy, workers=-1)[1].reshape(x.shape)
+        if tag == 'u':
+            hh = (G['h'][:,:-1] + G['h'][:,1:])/2
+        elif tag == 'v':
+            hh = (G['h'][:-1,:] + G['h'][1:,:])/2
+        elif tag == 'rho':
+            hh = G['h']
+        z_rho, z_w = zrfun.get_z(hh, 0*hh, S)
+        A_dict['ZS_' + tag] = (z_rho/hh)[:,Mask]
+        if tag == 'rho':
+            A_dict['ZS_w'] = (z_w/hh)[:,Mask]
+    ifun.save_arrays(cache_key, A_dict)
+IW = dict() # (M,L) maps to the index of the nearest water point in flattened fields
+ZS = dict() # fractional depth z/h at zeta=0 of each level, packed as (N, NW)
+for tag in ['rho', 'u', 'v']:
+    IW[tag] = A_dict['IW_' + tag]
+    ZS[tag] = A_dict['ZS_' + tag]
+ZS['w'] = A_dict['ZS_w']
+IX['w'] = IX['rho']; IY['w'] = IY['rho']; IW['w'] = IW['rho']
+
+# flat indices of the water points, used to pack fields into reused arrays
+IND = dict()
+IND['rho'] = np.flatnonzero(Maskr)
+IND['u'] = np.flatnonzero(Masku)
+IND['v'] = np.flatnonzero(Maskv)
+IND['rho3'] = np.flatnonzero(Maskr3)
+IND['u3'] = np.flatnonzero(Masku3)
+IND['v3'] = np.flatnonzero(Maskv3)
+IND['w3'] = np.flatnonzero(Maskw3)
+
 def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
     """
     This is the main function doing the particle tracking.
@@ -79,6 +122,7 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
     turb = TR['turb']
     ndiv = TR['ndiv']
     windage = TR['windage']
+    interp = TR['interp']
     
     # get time vector of history files
     NT = len(fn_list)
@@ -107,6 +151,20 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
     # plist_main is what ends up written to output
     plist_main = ['lon', 'lat', 'cs', 'ot', 'z'] + vn_list_other
     
+    h = G['h']
+    hf = h[Maskr]
+    
+    # Each history file is read once, by a background thread that prepares the
+    # flattened fields of hour N+1 while the RK4 integration runs on hour N.
+    # We cycle through three sets of output arrays: two are in use by the
+    # integration (ds0 and ds1) and the third is being filled.
+    Fbuf = [dict(), dict(), dict()]
+    if prefetch:
+        pool = ThreadPoolExecutor(max_workers=1)
+    F1 = get_fields(fn_list[0], TR, Fbuf[0])
+    if prefetch:
+        fut = pool.submit(get_fields, fn_list[1], TR, Fbuf[1])
+    
     # Step through times.
     #
     for counter_his in range(len(fn_list)-1):
@@ -117,185 +175,35 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
                 
         it0 = TR['sph']*counter_his
         
-        # get Datasets
-        fn0 = fn_list[counter_his]
-        fn1 = fn_list[counter_his+1]
-        
-        ds0 = xr.open_dataset(fn0)
-        ds1 = xr.open_dataset(fn1)
-        
-        # prepare the fields for nearest neighbor interpolation
+        # get the fields for this pair of history files
         tt0 = time()
-        if counter_his == 0:
-            h = G['h']
-            hf = h[Maskr]
-            if surface == True:
-                u0 = ds0['u'][0,-1,:,:].values
-                u1 = ds1['u'][0,-1,:,:].values
-                uf0 = u0[Masku]
-                uf1 = u1[Masku]
-                v0 = ds0['v'][0,-1,:,:].values
-                v1 = ds1['v'][0,-1,:,:].values
-                vf0 = v0[Maskv]
-                vf1 = v1[Maskv]
-                wf0 = 0; wf1 = 0
-                
-                trf0_dict = dict()
-                trf1_dict = dict()
-                for vn in tracer_list:
-                    tr0 = ds0[vn][0,-1,:,:].values
-                    tr1 = ds1[vn][0,-1,:,:].values
-                    trf0_dict[vn] = tr0[Maskr]
-                    trf1_dict[vn] = tr1[Maskr]
-                
-                if windage > 0:
-                    Uwind0 = ds0['Uwind'][0,:,:].values
-                    Uwind1 = ds1['Uwind'][0,:,:].values
-                    Uwindf0 = Uwind0[Maskr]
-                    Uwindf1 = Uwind1[Maskr]
-                    Vwind0 = ds0['Vwind'][0,:,:].values
-                    Vwind1 = ds1['Vwind'][0,:,:].values
-                    Vwindf0 = Vwind0[Maskr]
-                    Vwindf1 = Vwind1[Maskr]
-            else:
-                u0 = ds0['u'][0,:,:,:].values
-                u1 = ds1['u'][0,:,:,:].values
-                uf0 = u0[Masku3]
-                uf1 = u1[Masku3]
-                v0 = ds0['v'][0,:,:,:].values
-                v1 = ds1['v'][0,:,:,:].values
-                vf0 = v0[Maskv3]
-                vf1 = v1[Maskv3]
-                w0 = ds0['w'][0,:,:,:].values
-                w1 = ds1['w'][0,:,:,:].values
-                wf0 = w0[Maskw3]
-                wf1 = w1[Maskw3]
-                
-                trf0_dict = dict()
-                trf1_dict = dict()
-                for vn in tracer_list:
-                    tr0 = ds0[vn][0,:,:,:].values
-                    tr1 = ds1[vn][0,:,:,:].values
-                    trf0_dict[vn] = tr0[Maskr3]
-                    trf1_dict[vn] = tr1[Maskr3]
-                    
-                if turb == True:
-                    AKs0_temp = ds0['AKs'][0,:,:,:].values
-                    # modify top and bottom AKs to be non-negligible
-                    AKs0_temp[0,:,:] = AKs0_temp[1,:,:]
-                    AKs0_temp[-1,:,:] = AKs0_temp[-2,:,:]
-                    AKs0 = AKs0_temp.copy()
-                    AKs0[1:-1,:,:] = 0.25*AKs0_temp[:-2,:,:] + 0.5*AKs0_temp[1:-1,:,:] + 0.25*AKs0_temp[2:,:,:]
-                    AKsf0 = AKs0[Maskw3]
-                    #
-                    AKs1_temp = ds1['AKs'][0,:,:,:].values
-                    # modify top and bottom AKs to be non-negligible
-                    AKs1_temp[0,:,:] = AKs1_temp[1,:,:]
-                    AKs1_temp[-1,:,:] = AKs1_temp[-2,:,:]
-                    AKs1 = AKs1_temp.copy()
-                    AKs1[1:-1,:,:] = 0.25*AKs1_temp[:-2,:,:] + 0.5*AKs1_temp[1:-1,:,:] + 0.25*AKs1_temp[2:,:,:]
-                    AKsf1 = AKs1[Maskw3]
-                    #
-                    # New 2022.11.14 use time-varying dz
-                    zeta0 = ds0['zeta'].values #jx
-                    zeta1 = ds1['zeta'].values #jx
-                    zw0 = zrfun.get_z(G['h'], zeta0, S, only_w=True) #jx
-                    zw1 = zrfun.get_z(G['h'], zeta1, S, only_w=True) #jx
-                    dz0 = np.diff(zw0, axis=0) #jx
-                    dz1 = np.diff(zw1, axis=0) #jx
-                    dKdz0 = np.diff(AKs0, axis=0)/dz0 #jx
-                    dKdz1 = np.diff(AKs1, axis=0)/dz1 #jx
-                    dKdzf0 = dKdz0[Maskr3]
-                    dKdzf1 = dKdz1[Maskr3]
-                    
-                    
-            z0 = ds0['zeta'][0,:,:].values
-            z1 = ds1['zeta'][0,:,:].values
-            zf0 = z0[Maskr]
-            zf1 = z1[Maskr]
-            if verbose:
-                print('   > Prepare fields for tree %0.4f sec' % (time()-tt0))
+        F0 = F1
+        if prefetch:
+            F1 = fut.result()
+            if counter_his + 2 < len(fn_list):
+                fut = pool.submit(get_fields, fn_list[counter_his+2], TR,
+                    Fbuf[(counter_his+2) % 3])
         else:
-            # subsequent time steps
-            if surface == True:
-                u1 = ds1['u'][0,-1,:,:].values
-                uf0 = uf1.copy()
-                uf1 = u1[Masku]
-                v1 = ds1['v'][0,-1,:,:].values
-                vf0 = vf1.copy()
-                vf1 = v1[Maskv]
-                wf0 = 0; wf1 = 0
-                
-                for vn in tracer_list:
-                    tr1 = ds1[vn][0,-1,:,:].values
-                    trf0_dict[vn] = trf1_dict[vn].copy()
-                    trf1_dict[vn] = tr1[Maskr]
-                
-                if windage > 0:
-                    Uwind1 = ds1['Uwind'][0,:,:].values
-                    Uwindf0 = Uwindf1
-                    Uwindf1 = Uwind1[Maskr]
-                    Vwind1 = ds1['Vwind'][0,:,:].values
-                    Vwindf0 = Vwindf1
-                    Vwindf1 = Vwind1[Maskr]
-            else:
-                if TR['no_advection'] == False:
-                    u1 = ds1['u'][0,:,:,:].values
-                    uf0 = uf1.copy()
-                    uf1 = u1[Masku3]
-                    v1 = ds1['v'][0,:,:,:].values
-                    vf0 = vf1.copy()
-                    vf1 = v1[Maskv3]
-                    w1 = ds1['w'][0,:,:,:].values
-                    wf0 = wf1.copy()
-                    wf1 = w1[Maskw3]
-                    
-                    for vn in tracer_list:
-                        tr1 = ds1[vn][0,:,:,:].values
-                        trf0_dict[vn] = trf1_dict[vn].copy()
-                        trf1_dict[vn] = tr1[Maskr3]
-                    
-                if turb == True:
-                    AKsf0 = AKsf1.copy()
-                    #
-                    AKs1_temp = ds1['AKs'][0,:,:,:].values
-                    # modify top and bottom AKs to be non-negligible
-                    AKs1_temp[0,:,:] = AKs1_temp[1,:,:]
-                    AKs1_temp[-1,:,:] = AKs1_temp[-2,:,:]
-                    AKs1 = AKs1_temp.copy()
-                    AKs1[1:-1,:,:] = 0.25*AKs1_temp[:-2,:,:] + 0.5*AKs1_temp[1:-1,:,:] + 0.25*AKs1_temp[2:,:,:]
-                    AKsf1 = AKs1[Maskw3]
-                    #
-                    dKdzf0 = dKdzf1.copy()
-                    # new 2022.11.14 Use time-varying dz
-                    zeta1 = ds1['zeta'].values #jx
-                    zw1 = zrfun.get_z(G['h'], zeta1, S, only_w=True) #jx
-                    dz1 = np.diff(zw1, axis=0) #jx 
-                    dKdz1 = np.diff(AKs1, axis=0)/dz1
-                    dKdzf1 = dKdz1[Maskr3]
-                    
-            z1 = ds1['zeta'][0,:,:].values
-            zf0 = zf1.copy()
-            zf1 = z1[Maskr]
-            if verbose:
-                print('   > Prepare subsequent fields for tree %0.4f sec' % (time()-tt0))
-        ds0.close()
-        ds1.close()
+            F1 = get_fields(fn_list[counter_his+1], TR, Fbuf[(counter_his+1) % 3])
+        uf0 = F0['u']; uf1 = F1['u']
+        vf0 = F0['v']; vf1 = F1['v']
+        wf0 = F0['w']; wf1 = F1['w']
+        zf0 = F0['zeta']; zf1 = F1['zeta']
+        trf0_dict = {vn: F0[vn] for vn in tracer_list}
+        trf1_dict = {vn: F1[vn] for vn in tracer_list}
+        if windage > 0:
+            Uwindf0 = F0['Uwind']; Uwindf1 = F1['Uwind']
+            Vwindf0 = F0['Vwind']; Vwindf1 = F1['Vwind']
+        if turb == True:
+            AKsf0 = F0['AKs']; AKsf1 = F1['AKs']
+            dKdzf0 = F0['dKdz']; dKdzf1 = F1['dKdz']
+        if verbose:
+            print('   > Wait for fields %0.4f sec' % (time()-tt0))
 
         if counter_his == 0:
             if trim_loc == True:
                 # remove points on land
-                xy = np.array((plon0,plat0)).T
-                #print(' ++ making pmask')
-                #print(maskr.shape)
-                pmask = maskr[xyT_rho_un.query(xy, workers=-1)[1]]
-                #print(pmask)
-                # keep only points with pmask >= maskr_crit
-                pcond = pmask >= maskr_crit
-                #print(pcond.sum())
-                plon = plon0[pcond]
-                plat = plat0[pcond]
-                pcs = pcs0[pcond]
+                plon, plat, pcs = trim_ic(plon0, plat0, pcs0)
             else:
                 plon = plon0.copy()
                 plat = plat0.copy()
@@ -314,11 +222,12 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
                 pcs[:] = S['Cs_r'][-1]
             P['cs'][it0,:] = pcs
             
+            I = get_index(plon, plat, pcs, surface, interp)
             for vn in tracer_list:
-                P[vn][it0,:] = get_VR(trf0_dict[vn], trf1_dict[vn], plon, plat, pcs, 0, surface)
+                P[vn][it0,:] = get_VR(trf0_dict[vn], trf1_dict[vn], I, 0, surface)
                 
-            V = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon, plat, pcs, 0, surface)
-            ZH = get_zh(zf0,zf1,hf, plon, plat, 0)
+            V = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, I, 0, surface)
+            ZH = get_zh(zf0,zf1,hf, I, 0)
             P['u'][it0,:] = V[:,0]
             P['v'][it0,:] = V[:,1]
             P['w'][it0,:] = V[:,2]
@@ -336,24 +245,30 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
             
             if TR['no_advection'] == False:
                 # RK4 integration
-                V0 = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon, plat, pcs, fr0, surface)
-                ZH0 = get_zh(zf0,zf1,hf, plon, plat, fr0)
+                # (the cell index and weights are found once for each stage and
+                # used for all fields)
+                I0 = get_index(plon, plat, pcs, surface, interp)
+                V0 = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, I0, fr0, surface)
+                ZH0 = get_zh(zf0,zf1,hf, I0, fr0)
                 plon1, plat1, pcs1 = update_position(dxg, dyg, maskr, V0, ZH0, S, delt/2,
                                                      plon, plat, pcs, surface)
-                V1 = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon1, plat1, pcs1, frmid, surface)
-                ZH1 = get_zh(zf0,zf1,hf, plon1, plat1, frmid)
+                I1 = get_index(plon1, plat1, pcs1, surface, interp)
+                V1 = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, I1, frmid, surface)
+                ZH1 = get_zh(zf0,zf1,hf, I1, frmid)
                 plon2, plat2, pcs2 = update_position(dxg, dyg, maskr, V1, ZH1, S, delt/2,
                                                      plon, plat, pcs, surface)
-                V2 = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon2, plat2, pcs2, frmid, surface)
-                ZH2 = get_zh(zf0,zf1,hf, plon2, plat2, frmid)
+                I2 = get_index(plon2, plat2, pcs2, surface, interp)
+                V2 = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, I2, frmid, surface)
+                ZH2 = get_zh(zf0,zf1,hf, I2, frmid)
                 plon3, plat3, pcs3 = update_position(dxg, dyg, maskr, V2, ZH2, S, delt,
                                                      plon, plat, pcs, surface)
-                V3 = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon3, plat3, pcs3, fr1, surface)
-                ZH3 = get_zh(zf0,zf1,hf, plon3, plat3, fr1)
+                I3 = get_index(plon3, plat3, pcs3, surface, interp)
+                V3 = get_vel(uf0,uf1,vf0,vf1,wf0,wf1, I3, fr1, surface)
+                ZH3 = get_zh(zf0,zf1,hf, I3, fr1)
                 
                 # add windage, calculated from the middle time
                 if (surface == True) and (windage > 0):
-                    Vwind3 = get_wind(Uwindf0, Uwindf1, Vwindf0, Vwindf1, plon, plat, frmid, windage)
+                    Vwind3 = get_wind(Uwindf0, Uwindf1, Vwindf0, Vwindf1, I0, frmid, windage)
                 else:
                     Vwind3 = np.zeros((NP,3))
                 
@@ -388,20 +303,23 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
                 
             elif TR['no_advection'] == True:
                 V3 = np.zeros((NP,3))
-                ZH3 = get_zh(zf0,zf1,hf, plon, plat, frmid)
+                I = get_index(plon, plat, pcs, surface, interp)
+                ZH3 = get_zh(zf0,zf1,hf, I, frmid)
                                               
             # add turbulence to vertical position change (advection already added above)
             if turb == True:
                 # pull values of VdAKs and add up to 3-dimensions
-                VdAKs = get_dAKs_new(dKdzf0, dKdzf1, plon, plat, pcs, frmid)
+                I = get_index(plon, plat, pcs, surface, interp)
+                VdAKs = get_dAKs_new(dKdzf0, dKdzf1, I, frmid)
                 VdAKs3 = np.zeros((NP,3))
                 VdAKs3[:,2] = VdAKs
                 # update position advecting vertically with 1/2 of AKs gradient
-                ZH = get_zh(zf0,zf1,hf, plon, plat, frmid)
+                ZH = get_zh(zf0,zf1,hf, I, frmid)
                 plon_junk, plat_junk, pcs_half = update_position(dxg, dyg, maskr,
                                 VdAKs3/2, ZH, S, delt/2, plon, plat, pcs, surface)
                 # get AKs at this height, and thence the turbulent perturbation velocity
-                Vturb = get_turb(VdAKs, AKsf0, AKsf1, delt, plon, plat, pcs_half, frmid)
+                Ih = get_index(plon, plat, pcs_half, surface, interp)
+                Vturb = get_turb(VdAKs, AKsf0, AKsf1, delt, Ih, frmid)
                 Vturb3 = np.zeros((NP,3))
                 Vturb3[:,2] = Vturb
                 # update vertical position for real
@@ -419,8 +337,9 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
                     pcs[:] = S['Cs_r'][-1]
                 P['cs'][it1,:] = pcs
                 
+                I = get_index(plon, plat, pcs, surface, interp)
                 for vn in tracer_list:
-                    P[vn][it1,:] = get_VR(trf0_dict[vn], trf1_dict[vn], plon, plat, pcs, fr1, surface)
+                    P[vn][it1,:] = get_VR(trf0_dict[vn], trf1_dict[vn], I, fr1, surface)
 
                 P['u'][it1,:] = V3[:,0]
                 P['v'][it1,:] = V3[:,1]
@@ -431,11 +350,70 @@ def get_tracks(fn_list, plon0, plat0, pcs0, TR, trim_loc=False):
         if verbose:
             print('   > RK4 integration took %0.4f sec' % (time()-tt00))
         
+    if prefetch:
+        pool.shutdown()
+        
     # and save the time vector (seconds in whatever the model reports)
     P['ot'] = rot_save
 
     return P
     
+def trim_ic(plon0, plat0, pcs0):
+    # remove initial positions that are on land
+    xi, yi = get_ij(plon0, plat0, 'rho')
+    pmask = Maskr[np.rint(yi).astype(int), np.rint(xi).astype(int)]
+    # keep only points with pmask >= maskr_crit
+    pcond = pmask >= maskr_crit
+    plon = plon0[pcond]
+    plat = plat0[pcond]
+    pcs = pcs0[pcond]
+    return plon, plat, pcs
+
+def get_fields(fn, TR, F):
+    """
+    Read the fields needed for tracking from one history file and pack them
+    into the dict F as flattened water-only arrays, e.g. F['u'] = u[Masku3].
+    The arrays already in F are reused as the output buffers.
+    """
+    surface = not TR['3d']
+    ds = xr.open_dataset(fn)
+    def pack(vn, a, ind):
+        if vn not in F.keys():
+            F[vn] = np.empty(len(ind), dtype=a.dtype)
+        np.take(a.ravel(), ind, out=F[vn])
+    if surface == True:
+        pack('u', ds['u'][0,-1,:,:].values, IND['u'])
+        pack('v', ds['v'][0,-1,:,:].values, IND['v'])
+        F['w'] = 0
+        for vn in tracer_list:
+            pack(vn, ds[vn][0,-1,:,:].values, IND['rho'])
+        if TR['windage'] > 0:
+            pack('Uwind', ds['Uwind'][0,:,:].values, IND['rho'])
+            pack('Vwind', ds['Vwind'][0,:,:].values, IND['rho'])
+    else:
+        pack('u', ds['u'][0,:,:,:].values, IND['u3'])
+        pack('v', ds['v'][0,:,:,:].values, IND['v3'])
+        pack('w', ds['w'][0,:,:,:].values, IND['w3'])
+        for vn in tracer_list:
+            pack(vn, ds[vn][0,:,:,:].values, IND['rho3'])
+        if TR['turb'] == True:
+            AKs_temp = ds['AKs'][0,:,:,:].values
+            # modify top and bottom AKs to be non-negligible
+            AKs_temp[0,:,:] = AKs_temp[1,:,:]
+            AKs_temp[-1,:,:] = AKs_temp[-2,:,:]
+            AKs = AKs_temp.copy()
+            AKs[1:-1,:,:] = 0.25*AKs_temp[:-2,:,:] + 0.5*AKs_temp[1:-1,:,:] + 0.25*AKs_temp[2:,:,:]
+            pack('AKs', AKs, IND['w3'])
+            # New 2022.11.14 use time-varying dz
+            zeta = ds['zeta'].values #jx
+            zw = zrfun.get_z(G['h'], zeta, S, only_w=True) #jx
+            dz = np.diff(zw, axis=0) #jx
+            dKdz = np.diff(AKs, axis=0)/dz #jx
+            pack('dKdz', dKdz, IND['rho3'])
+    pack('zeta', ds['zeta'][0,:,:].values, IND['rho'])
+    ds.close()
+    return F
+
 def update_position(dxg, dyg, maskr, V, ZH, S, dt_sec, plon, plat, pcs, surface):
     
     # find the new position
@@ -458,8 +436,8 @@ def update_position(dxg, dyg, maskr, V, ZH, S, dt_sec, plon, plat, pcs, surface)
     # ## * minimum grid sizes used when particles approach land boundaries
     # Experiments with "trap0" to explore trapping in the Skokomish
     # showed that ## = 0.5 is a reasonable choice.
-    xy = np.array((Plon,Plat)).T
-    pmask = maskr[xyT_rho_un.query(xy, workers=-1)[1]]
+    xi, yi = get_ij(Plon, Plat, 'rho')
+    pmask = Maskr[np.rint(yi).astype(int), np.rint(xi).astype(int)]
     pcond = pmask < maskr_crit # a Boolean mask
     if len(pcond) > 0:
         # these randint calls give random vectors of -1,0,1 (note the 2!)
@@ -469,12 +447,14 @@ def update_position(dxg, dyg, maskr, V, ZH, S, dt_sec, plon, plat, pcs, surface)
         Plat[pcond] = plat[pcond] + 0.5*riy[pcond]*dyg
         
     # move any particles on land to the middle of the nearest good rho point.
-    xy = np.array((Plon,Plat)).T
-    pmask = maskr[xyT_rho_un.query(xy, workers=-1)[1]]
+    xi, yi = get_ij(Plon, Plat, 'rho')
+    jj = np.rint(yi).astype(int)
+    ii = np.rint(xi).astype(int)
+    pmask = Maskr[jj, ii]
     pcond = pmask < maskr_crit # a Boolean mask
     if len(pcond) > 0:
-        Plon_NEW = lonrf[xyT_rho.query(xy, workers=-1)[1]]
-        Plat_NEW = latrf[xyT_rho.query(xy, workers=-1)[1]]
+        Plon_NEW = lonrf[IW['rho'][jj, ii]]
+        Plat_NEW = latrf[IW['rho'][jj, ii]]
         Plon[pcond] = Plon_NEW[pcond]
         Plat[pcond] = Plat_NEW[pcond]
         
@@ -511,31 +491,104 @@ def update_position(dxg, dyg, maskr, V, ZH, S, dt_sec, plon, plat, pcs, surface)
 
     return Plon, Plat, Pcs
 
-def get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon, plat, pcs, frac, surface):
+def get_ij(plon, plat, tag):
+    # Get the fractional column (xi) and row (yi) index of all points on the
+    # plaid grid of a given staggering. Points outside the grid are clamped to the edge.
+    xi = np.interp(plon, IX[tag], np.arange(len(IX[tag])))
+    yi = np.interp(plat, IY[tag], np.arange(len(IY[tag])))
+    return xi, yi
+
+def get_index(plon, plat, pcs, surface, interp='nn'):
+    """
+    Find the grid cell each particle is in, and the indices and weights needed to
+    interpolate any field to the particle positions. This is done once per substep
+    and then reused for every field.
+    
+    interp = 'nn' (nearest neighbor) or 'linear' (bilinear in 2D, trilinear in 3D)
+    
+    Output: a dict I of tuples (inds, wts) of arrays shaped (NP, K), where inds
+    point into the flattened water-only fields (e.g. uf0 = u0[Masku3]) and
+    K = 1 for nearest neighbor, and 4 (2D) or 8 (3D) for linear. The keys are:
+    'rho', 'u', 'v' for 2D fields, and if surface == False also
+    'rho3', 'u3', 'v3', 'w3' for 3D fields.
+    
+    Corners of a cell that are on land are replaced by the nearest water point.
+    The vertical position uses the s-levels of the nearest water column.
+    """
+    NP = len(plon)
+    rr = np.arange(NP)
+    I = dict()
+    for tag in ['rho', 'u', 'v']:
+        xi, yi = get_ij(plon, plat, tag)
+        M, L = IW[tag].shape
+        if interp == 'nn':
+            ii = np.rint(xi).astype(int)
+            jj = np.rint(yi).astype(int)
+            iw = IW[tag][jj, ii].reshape(NP,1)
+            w2 = np.ones((NP,1))
+        elif interp == 'linear':
+            i0 = np.minimum(np.floor(xi).astype(int), L-2)
+            j0 = np.minimum(np.floor(yi).astype(int), M-2)
+            fx = xi - i0
+            fy = yi - j0
+            iw = np.array((IW[tag][j0,i0], IW[tag][j0,i0+1],
+                IW[tag][j0+1,i0], IW[tag][j0+1,i0+1])).T
+            w2 = np.array(((1-fy)*(1-fx), (1-fy)*fx, fy*(1-fx), fy*fx)).T
+        else:
+            print('ERROR in get_index(): unsupported interp ' + interp)
+            sys.exit()
+        I[tag] = (iw, w2)
+        if surface == False:
+            icol = iw[rr, w2.argmax(axis=1)]
+            if tag == 'rho':
+                vtag_list = ['rho', 'w']
+            else:
+                vtag_list = [tag]
+            for vtag in vtag_list:
+                NW = ZS[vtag].shape[1]
+                Z = ZS[vtag][:, icol].T # (NP, number of levels)
+                NZ = Z.shape[1]
+                k0 = np.clip((Z <= pcs.reshape(NP,1)).sum(axis=1) - 1, 0, NZ-2)
+                z0 = Z[rr, k0]
+                z1 = Z[rr, k0+1]
+                fz = np.clip((pcs - z0)/(z1 - z0), 0, 1).reshape(NP,1)
+                k0 = k0.reshape(NP,1)
+                if interp == 'nn':
+                    inds = (k0 + (fz >= 0.5))*NW + iw
+                    wts = w2
+                elif interp == 'linear':
+                    inds = np.concatenate((k0*NW + iw, (k0+1)*NW + iw), axis=1)
+                    wts = np.concatenate((w2*(1-fz), w2*fz), axis=1)
+                I[vtag + '3'] = (inds, wts)
+    return I
+
+def interp_field(ff, ind):
+    # apply a tuple (inds, wts) from get_index() to a flattened field
+    inds, wts = ind
+    return (ff[inds]*wts).sum(axis=1)
+
+def get_vel(uf0,uf1,vf0,vf1,wf0,wf1, I, frac, surface):
     # Get the velocity at all points, at an arbitrary time between two saves
     # "frac" is the fraction of the way between the times of ds0 and ds1, 0 <= frac <= 1.
     # NOTE: with ndiv=1 this gets called 4 times per hour, or 96 times per day.
-    NP = len(plon)
+    NP = I['rho'][0].shape[0]
     V = np.zeros((NP,3))
     if surface == True:
-        xy = np.array((plon,plat)).T
-        # use workers=-1 to use all available cores
-        ui0 = uf0[xyT_u.query(xy, workers=-1)[1]]
-        vi0 = vf0[xyT_v.query(xy, workers=-1)[1]]
-        ui1 = uf1[xyT_u.query(xy, workers=-1)[1]]
-        vi1 = vf1[xyT_v.query(xy, workers=-1)[1]]
+        ui0 = interp_field(uf0, I['u'])
+        vi0 = interp_field(vf0, I['v'])
+        ui1 = interp_field(uf1, I['u'])
+        vi1 = interp_field(vf1, I['v'])
         ui = (1 - frac)*ui0 + frac*ui1
         vi = (1 - frac)*vi0 + frac*vi1
         V[:,0] = ui
         V[:,1] = vi
     else:
-        xys = np.array((plon,plat,pcs)).T
-        ui0 = uf0[xyzT_u.query(xys, workers=-1)[1]]
-        vi0 = vf0[xyzT_v.query(xys, workers=-1)[1]]
-        wi0 = wf0[xyzT_w.query(xys, workers=-1)[1]]
-        ui1 = uf1[xyzT_u.query(xys, workers=-1)[1]]
-        vi1 = vf1[xyzT_v.query(xys, workers=-1)[1]]
-        wi1 = wf1[xyzT_w.query(xys, workers=-1)[1]]
+        ui0 = interp_field(uf0, I['u3'])
+        vi0 = interp_field(vf0, I['v3'])
+        wi0 = interp_field(wf0, I['w3'])
+        ui1 = interp_field(uf1, I['u3'])
+        vi1 = interp_field(vf1, I['v3'])
+        wi1 = interp_field(wf1, I['w3'])
         ui = (1 - frac)*ui0 + frac*ui1
         vi = (1 - frac)*vi0 + frac*vi1
         wi = (1 - frac)*wi0 + frac*wi1
@@ -546,64 +599,58 @@ def get_vel(uf0,uf1,vf0,vf1,wf0,wf1, plon, plat, pcs, frac, surface):
     V[np.isnan(V)] = 0.0
     return V
     
-def get_zh(zf0,zf1,hf, plon, plat, frac):
+def get_zh(zf0,zf1,hf, I, frac):
     # Get zeta and h at all points, at an arbitrary time between two saves
-    NP = len(plon)
-    xy = np.array((plon,plat)).T
-    zi0 = zf0[xyT_rho.query(xy, workers=-1)[1]]
-    zi1 = zf1[xyT_rho.query(xy, workers=-1)[1]]
-    hi = hf[xyT_rho.query(xy, workers=-1)[1]]
+    NP = I['rho'][0].shape[0]
+    zi0 = interp_field(zf0, I['rho'])
+    zi1 = interp_field(zf1, I['rho'])
+    hi = interp_field(hf, I['rho'])
     zi = (1 - frac)*zi0 + frac*zi1
     ZH = np.zeros((NP,2))
     ZH[:,0] = zi
     ZH[:,1] = hi
     return ZH
     
-def get_VR(tf0,tf1, plon, plat, pcs, frac, surface):
+def get_VR(tf0,tf1, I, frac, surface):
     # Get a variable on the z_rho grid at all points.
     if surface == True:
-        xy = np.array((plon,plat)).T
-        ti0 = tf0[xyT_rho.query(xy, workers=-1)[1]]
-        ti1 = tf1[xyT_rho.query(xy, workers=-1)[1]]
+        ti0 = interp_field(tf0, I['rho'])
+        ti1 = interp_field(tf1, I['rho'])
     else:
-        xys = np.array((plon,plat,pcs)).T
-        ti0 = tf0[xyzT_rho.query(xys, workers=-1)[1]]
-        ti1 = tf1[xyzT_rho.query(xys, workers=-1)[1]]
+        ti0 = interp_field(tf0, I['rho3'])
+        ti1 = interp_field(tf1, I['rho3'])
     ti = (1 - frac)*ti0 + frac*ti1
     return ti
     
-def get_wind(Uwindf0, Uwindf1, Vwindf0, Vwindf1, plon, plat, frac, windage):
+def get_wind(Uwindf0, Uwindf1, Vwindf0, Vwindf1, I, frac, windage):
     # creates the windage correction to the surface velocity (u,v only)
-    NP = len(plon)
+    NP = I['rho'][0].shape[0]
     Vwind3 = np.zeros((NP,3))
-    xy = np.array((plon,plat)).T
-    Uwind00 = Uwindf0[xyT_rho.query(xy, workers=-1)[1]]
-    Uwind11 = Uwindf1[xyT_rho.query(xy, workers=-1)[1]]
+    Uwind00 = interp_field(Uwindf0, I['rho'])
+    Uwind11 = interp_field(Uwindf1, I['rho'])
     Uwind = (1 - frac)*Uwind00 + frac*Uwind11
-    Vwind00 = Vwindf0[xyT_rho.query(xy, workers=-1)[1]]
-    Vwind11 = Vwindf1[xyT_rho.query(xy, workers=-1)[1]]
+    Vwind00 = interp_field(Vwindf0, I['rho'])
+    Vwind11 = interp_field(Vwindf1, I['rho'])
     Vwind = (1 - frac)*Vwind00 + frac*Vwind11
     Vwind3[:,0] = windage*Uwind
     Vwind3[:,1] = windage*Vwind
     return Vwind3
     
-def get_AKs(AKsf, plon, plat, pcs):
+def get_AKs(AKsf, I):
     # Get AKs at all points, at one time.
-    xys = np.array((plon,plat,pcs)).T
-    AKsi = AKsf[xyzT_w.query(xys, workers=-1)[1]]
+    AKsi = interp_field(AKsf, I['w3'])
     return AKsi
     
-def get_dAKs_new(dKdzf0, dKdzf1, plon, plat, pcs, frac):
-    xys = np.array((plon,plat,pcs)).T
-    dKdzi0 = dKdzf0[xyzT_rho.query(xys, workers=-1)[1]]
-    dKdzi1 = dKdzf1[xyzT_rho.query(xys, workers=-1)[1]]
+def get_dAKs_new(dKdzf0, dKdzf1, I, frac):
+    dKdzi0 = interp_field(dKdzf0, I['rho3'])
+    dKdzi1 = interp_field(dKdzf1, I['rho3'])
     dKdzi = (1 - frac)*dKdzi0 + frac*dKdzi1
     return dKdzi
 
-def get_turb(dAKs, AKsf0, AKsf1, delta_t, plon, plat, pcs, frac):
+def get_turb(dAKs, AKsf0, AKsf1, delta_t, I, frac):
     # get the vertical turbulence correction components
-    V0 = get_AKs(AKsf0, plon, plat, pcs)
-    V1 = get_AKs(AKsf1, plon, plat, pcs)
+    V0 = get_AKs(AKsf0, I)
+    V1 = get_AKs(AKsf1, I)
     # create weighted average diffusivity
     Vave = (1 - frac)*V0 + frac*V1
     # turbulence calculation from Banas, MacCready, and Hickey (2009)